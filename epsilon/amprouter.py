@@ -4,21 +4,117 @@
 """
 This module provides an implementation of I{Routes}, a system for multiplexing
 multiple L{IBoxReceiver}/I{IBoxSender} pairs over a single L{AMP} connection.
+
+A L{Router} created with a C{window} applies flow control to its routes, so
+that one busy route cannot monopolize the connection.  Boxes sent through
+each route are queued, and sent in turn with the boxes of the other routes by
+a deficit round robin scheduler, and a route may have at most as many boxes
+in flight as the router on the other end has granted it credit for.  When it
+is started, such a router tells the router on the other end how many boxes
+each route may send before it is granted credit; until it has been told the
+same, it sends no boxes through its routes and grants no credit, and if the
+router on the other end does not apply flow control, neither does it.  The
+router on the other end must be a L{Router} too, with a C{window} or not.
+
+What a L{Router} does with a box for a route which is not bound is decided by
+its C{unknownRoute} policy: it may raise L{KeyError}, which drops the
+connection, or drop the box, answer it with an error, or hold on to it until
+a route with that name is started.  Holding on to boxes lets a peer send
+boxes through a route as soon as it has asked for the route to be set up,
+without waiting for an answer; boxes received for a route which is bound but
+not yet started are held on to in the same way.
+
+A L{Router} created with C{recordMetrics} counts the boxes and bytes sent and
+received through each of its routes.  L{topRoutes} finds the busiest routes
+of every such router in the process, and L{logTopRoutes} logs them; to log
+them on demand from a running process, install it as a signal handler, for
+example with L{epsilon.spewer.SignalService}::
+
+    SignalService({signal.SIGUSR1: lambda *a: logTopRoutes()})
+
+A L{Router} created with C{compactRouteIds} identifies its routes with small
+integers, reused once their routes are unbound, written in base 64, rather
+than with a count written in decimal, so that the route names in boxes stay
+short however many routes a connection has had.  An identifier is only
+reused once the router on the other end of the connection has acknowledged
+that its route was unbound, so that nothing it sent to the old route reaches
+the new one.  When it is started, such a router asks the router on the other
+end whether it will acknowledge this, and until it has agreed, identifiers
+are not reused.  As with flow control, the router on the other end must be a
+L{Router} from this module, with C{compactRouteIds} or not.
 """
 
+import weakref, heapq
+from array import array
+from collections import deque, OrderedDict
 from itertools import count
 
 from zope.interface import implements
 
 from twisted.protocols.amp import IBoxReceiver, IBoxSender
+from twisted.protocols.amp import (
+    ASK, ERROR, ERROR_CODE, ERROR_DESCRIPTION, UNKNOWN_ERROR_CODE)
+from twisted.python import log
 
 from epsilon.structlike import record
 
 __metaclass__ = type
 
 _ROUTE = '_route'
+_CREDIT = '_credit'
+_UNKNOWN_ROUTE = '_unknown_route'
+# The route errors for unknown routes are sent to.  It cannot be encoded by
+# _encodeRouteName, so cannot be bound.
+_UNKNOWN = '\x80unknown'
+# The route through which routers say whether they apply flow control, and
+# with how much initial credit, and which compact route identifiers they are
+# done with; it cannot be bound either.
+_CONTROL = '\x80control'
+_FLOW_CONTROL = '_flow_control'
+_NO_FLOW_CONTROL = 'off'
+_RELEASE_ROUTE = '_release_route'
+_ROUTE_RELEASED = '_route_released'
+_ROUTE_RELEASES = '_route_releases'
+_RELEASES_ASKED = 'ask'
+_RELEASES_AGREED = 'ok'
 _unspecified = object()
 
+# The digits of compact route identifiers.
+_ID_DIGITS = (
+    '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_')
+
+# Policies for boxes received for routes which are not bound.
+RAISE = 'raise'
+DROP = 'drop'
+ANSWER_ERROR = 'error'
+BUFFER = 'buffer'
+
+
+
+def _encodeRouteId(routeId):
+    """
+    Return the compact route identifier for the integer C{routeId}.
+    """
+    digits = []
+    while True:
+        routeId, digit = divmod(routeId, len(_ID_DIGITS))
+        digits.append(_ID_DIGITS[digit])
+        if not routeId:
+            break
+    digits.reverse()
+    return intern(''.join(digits))
+
+
+
+def _encodeRouteName(routeName):
+    """
+    Return C{routeName} as the interned byte string which is put in boxes
+    sent to it, or C{None} if it is C{None}.
+    """
+    if routeName is None:
+        return None
+    return intern(routeName.encode('ascii'))
+
 
 class RouteNotConnected(Exception):
     """
@@ -48,14 +144,51 @@ class Route(record('router receiver localRouteName remoteRouteName',
     @type remoteRouteName: C{unicode} or L{NoneType}
     @ivar remoteRouteName: The name of the route which will be added to all
         boxes sent to this sender.  If C{None}, no route will be added.
+
+    @ivar _remoteName: L{remoteRouteName}, encoded by L{_encodeRouteName}.
+
+    @ivar _queue: If the router applies flow control, a C{deque} of the boxes
+        sent through this route which have not yet been passed to the
+        router's sender.
+
+    @ivar _credit: The number of boxes this route may yet send before the
+        other end of the connection grants it more credit.
+
+    @ivar _deficit: The number of bytes this route may send in its current
+        turn of the router's scheduler.
+
+    @ivar _scheduled: C{True} if this route is waiting for a turn of the
+        router's scheduler.
+
+    @ivar _consumed: The number of boxes received through this route since
+        more credit was last granted for it.
+
+    @ivar _started: C{True} once L{start} has been called.
+
+    @ivar _slot: If the router records metrics, the index of this route's
+        counters in the router's L{_RouteMetrics}.
+
+    @ivar _id: If the router uses compact route identifiers and this route's
+        name is one, the integer it stands for.
     """
     implements(IBoxSender)
 
+    _remoteName = _unspecified
+    _queue = None
+    _credit = 0
+    _deficit = 0
+    _scheduled = False
+    _consumed = 0
+    _started = False
+    _slot = None
+    _id = None
+
     def connectTo(self, remoteRouteName):
         """
         Set the name of the route which will be added to outgoing boxes.
         """
         self.remoteRouteName = remoteRouteName
+        self._remoteName = _encodeRouteName(remoteRouteName)
         # This route must not be started before its router is started.  If
         # sender is None, then the router is not started.  When the router is
         # started, it will start this route.
@@ -68,13 +201,27 @@ class Route(record('router receiver localRouteName remoteRouteName',
         Remove the association between this route and its router.
         """
         del self.router._routes[self.localRouteName]
+        if self._queue:
+            self._queue.clear()
+        if self._slot is not None:
+            self.router._metrics.release(self._slot)
+            self._slot = None
+        if self._id is not None:
+            self.router._releaseRouteId(self._id)
+            self._id = None
 
 
     def start(self):
         """
         Associate this object with a receiver as its L{IBoxSender}.
         """
+        self._started = True
+        router = self.router
+        if router.window is not None:
+            router._grant(self, router.window - router.initialCredit)
         self.receiver.startReceivingBoxes(self)
+        if router._early:
+            router._replay(self)
 
 
     def stop(self, reason):
@@ -86,13 +233,22 @@ class Route(record('router receiver localRouteName remoteRouteName',
 
     def sendBox(self, box):
         """
-        Add the route and send the box.
+        Add the route and send the box, or, if the router applies flow
+        control, queue it to be sent.
         """
-        if self.remoteRouteName is _unspecified:
+        remoteName = self._remoteName
+        if remoteName is _unspecified:
             raise RouteNotConnected()
-        if self.remoteRouteName is not None:
-            box[_ROUTE] = self.remoteRouteName.encode('ascii')
-        self.router._sender.sendBox(box)
+        if self._slot is not None:
+            self.router._metrics.sent(self._slot, _boxSize(box))
+        if remoteName is not None:
+            box[_ROUTE] = remoteName
+        if self._queue is None:
+            self.router._sender.sendBox(box)
+        else:
+            self._queue.append(box)
+            if not self._scheduled and self._credit:
+                self.router._schedule(self)
 
 
     def unhandledError(self, failure):
@@ -103,12 +259,212 @@ class Route(record('router receiver localRouteName remoteRouteName',
         self.router._sender.unhandledError(failure)
 
 
+    def metrics(self):
+        """
+        Return the traffic through this route, if its router records metrics.
+
+        @return: C{None}, or a C{dict} like those returned by
+            L{Router.topRoutes}.
+        """
+        if self._slot is None:
+            return None
+        return self.router._routeMetrics(self)
+
+
+
+def _boxSize(box):
+    """
+    Return the number of bytes C{box} takes up on the wire.
+    """
+    size = 2
+    for key, value in box.iteritems():
+        size += len(key) + len(value) + 4
+    return size
+
+
+
+class _RouteMetrics:
+    """
+    Traffic counters for the routes of a L{Router}, kept in arrays indexed by
+    small integer slots which are reused once their routes are unbound.
+
+    Byte counts are of boxes as they would be on the wire, without their
+    route names.
+
+    @ivar boxesIn: An C{array} of the number of boxes received for each slot.
+
+    @ivar bytesIn: An C{array} of the number of bytes received for each slot.
+
+    @ivar boxesOut: An C{array} of the number of boxes sent for each slot.
+
+    @ivar bytesOut: An C{array} of the number of bytes sent for each slot.
+
+    @ivar lastActivity: An C{array} of the times at which a box was last sent
+        or received for each slot.
+
+    @ivar retired: A C{dict} of the totals of the counters of the routes
+        which have been unbound.
+
+    @ivar routesBound: The number of slots which have been allocated.
+
+    @ivar routesUnbound: The number of slots which have been released.
+
+    @ivar _free: A C{list} of the slots which have been released.
+
+    @ivar _slots: The number of slots which have ever been allocated.
+    """
+    _counters = ('boxesIn', 'bytesIn', 'boxesOut', 'bytesOut')
+
+    routesBound = 0
+    routesUnbound = 0
+    _slots = 0
+
+    def __init__(self, clock, size=64):
+        self._seconds = clock.seconds
+        self._free = []
+        for name in self._counters:
+            setattr(self, name, array('l', [0]) * size)
+        self.lastActivity = array('d', [0.0]) * size
+        self.retired = dict.fromkeys(self._counters, 0)
+
+
+    def allocate(self):
+        """
+        Return a slot with zeroed counters.
+        """
+        self.routesBound += 1
+        if self._free:
+            return self._free.pop()
+        slot = self._slots
+        self._slots += 1
+        size = len(self.lastActivity)
+        if slot == size:
+            for name in self._counters:
+                getattr(self, name).extend(array('l', [0]) * size)
+            self.lastActivity.extend(array('d', [0.0]) * size)
+        return slot
+
+
+    def release(self, slot):
+        """
+        Add the counters of C{slot} to L{retired}, zero them, and make the
+        slot available to be allocated again.
+        """
+        self.routesUnbound += 1
+        for name in self._counters:
+            counters = getattr(self, name)
+            self.retired[name] += counters[slot]
+            counters[slot] = 0
+        self.lastActivity[slot] = 0.0
+        self._free.append(slot)
+
+
+    def received(self, slot, size):
+        self.boxesIn[slot] += 1
+        self.bytesIn[slot] += size
+        self.lastActivity[slot] = self._seconds()
+
+
+    def sent(self, slot, size):
+        self.boxesOut[slot] += 1
+        self.bytesOut[slot] += size
+        self.lastActivity[slot] = self._seconds()
+
+
+    def snapshot(self, slot):
+        """
+        Return the counters of C{slot}.
+        """
+        result = {'lastActivity': self.lastActivity[slot]}
+        for name in self._counters:
+            result[name] = getattr(self, name)[slot]
+        return result
+
+
+    def totals(self):
+        """
+        Return the totals of the counters of every route, bound or not.
+        """
+        result = {}
+        for name in self._counters:
+            result[name] = self.retired[name] + sum(getattr(self, name))
+        return result
+
+
 
 class Router:
     """
     An L{IBoxReceiver} implementation which demultiplexes boxes from an AMP
     connection being used with zero, one, or more routes.
 
+    @ivar window: C{None}, or the number of boxes which the other end of the
+        connection may send through each route before this router grants it
+        more credit, if this router applies flow control.  More credit is
+        granted as soon as half of the window has been delivered.  It is set
+        to C{None} if the router on the other end says that it does not apply
+        flow control.
+
+    @ivar initialCredit: The number of boxes each route on the other end of
+        the connection may send to a route of this router before this router
+        has granted it any credit.  It is sent to the router on the other end
+        when this router is started; C{window} may not be smaller.
+
+    @ivar _peerCredit: C{None} until the router on the other end of the
+        connection has said that it applies flow control, and then its
+        C{initialCredit}, with which each route starts.
+
+    @ivar quantum: The number of bytes each route with queued boxes may send
+        in each turn of the scheduler.
+
+    @ivar unknownRoute: What to do with a box for a route which is not bound:
+        L{RAISE} L{KeyError}; L{DROP} it; if it asks a question, answer it
+        with an error, if L{ANSWER_ERROR}; or, if L{BUFFER}, deliver it once
+        a route with that name has been started.  L{ANSWER_ERROR} requires
+        the router on the other end of the connection to be one of these, to
+        deliver the error to the route which asked, as does L{BUFFER} if any
+        box which asks a question is evicted.  Flow control credit granted to
+        a route which is not bound is not subject to the policy: it is
+        ignored, unless the policy is L{BUFFER}, in which case it is held on
+        to like any other box, since the route may yet be bound.
+
+    @ivar unknownRouteBoxes: The number of boxes received for routes which
+        were not bound.
+
+    @ivar maxEarlyBoxesPerRoute: The number of boxes held on to for each
+        route which is not started, if C{unknownRoute} is L{BUFFER}.  Boxes
+        received for the route after that many are evicted.
+
+    @ivar maxEarlyBoxes: The number of boxes held on to for all routes which
+        are not started, if C{unknownRoute} is L{BUFFER}.  When there would
+        be more, all of the boxes for the route which has had boxes held on
+        to for longest are evicted.
+
+    @ivar earlyBoxesEvicted: The number of boxes which were held on to, or
+        would have been, but were evicted.  Evicted boxes are answered with
+        an error, if they ask a question, and otherwise dropped.
+
+    @ivar _early: An C{OrderedDict} mapping the names of routes which are not
+        started, in the order boxes were first held on to for them, to lists
+        of the boxes received for them, if C{unknownRoute} is L{BUFFER}.
+
+    @ivar _earlyBoxes: The number of boxes in the lists in C{_early}.
+
+    @ivar recordMetrics: If C{True}, count the boxes and bytes sent and
+        received through each route; see L{Route.metrics}, L{metrics} and
+        L{topRoutes}.
+
+    @ivar _metrics: C{None}, or the L{_RouteMetrics} recording the traffic
+        through each route, if C{recordMetrics} is C{True}.
+
+    @ivar _clock: The L{IReactorTime} provider used to schedule sending of
+        queued boxes and to time activity.
+
+    @ivar _active: A C{deque} of the routes which have boxes queued and credit
+        to send them with, in the order in which they will get turns to send.
+
+    @ivar _drainCall: C{None}, or the delayed call which will send queued
+        boxes.
+
     @ivar _sender: An L{IBoxSender} provider which is used to allow
         L{IBoxReceiver}s added to this router to send boxes.
 
@@ -123,15 +479,88 @@ class Router:
 
     @ivar _routeCounter: A L{itertools.count} instance used to generate unique
         identifiers for routes in this router.
+
+    @ivar compactRouteIds: If C{True}, L{createRouteIdentifier} returns
+        compact identifiers: small integers, written in base 64, which are
+        reused once the routes they identify are unbound, least recently
+        released first.  An identifier is released when the router on the
+        other end of the connection acknowledges that its route was unbound,
+        and boxes held on to for the route until then are evicted.  The
+        router on the other end is asked when this router is started
+        whether it will acknowledge unbound routes, and must be a L{Router}
+        too, to answer; until it has agreed, no identifier is released.  A
+        route should only be unbound once the other end of the connection
+        will send nothing more to it, since what it sends after the
+        acknowledgement reaches the next route with the same identifier.
+
+    @ivar _idNames: If C{compactRouteIds}, a C{list} of the compact route
+        identifiers created so far, indexed by the integers they stand for.
+
+    @ivar _ids: If C{compactRouteIds}, a C{dict} mapping the compact route
+        identifiers which have been created but not yet bound to the
+        integers they stand for.
+
+    @ivar _freeIds: If C{compactRouteIds}, a C{deque} of the integers whose
+        identifiers are no longer in use, in the order they were released.
+
+    @ivar _releasing: If C{compactRouteIds}, an C{OrderedDict} mapping the
+        compact route identifiers of routes which have been unbound, but
+        which the router on the other end of the connection has not yet
+        acknowledged, in the order they were unbound, to the integers they
+        stand for.
+
+    @ivar _releasesAgreed: C{True} once the router on the other end of the
+        connection has agreed to acknowledge unbound routes, if
+        C{compactRouteIds}.  Until then, routes which are unbound are only
+        added to C{_releasing}.
     """
     implements(IBoxReceiver)
 
     _routes = None
     _sender = None
+    window = None
+    initialCredit = 16
+    _peerCredit = None
+    quantum = 8192
+    _drainCall = None
+    unknownRoute = RAISE
+    unknownRouteBoxes = 0
+    maxEarlyBoxesPerRoute = 64
+    maxEarlyBoxes = 1024
+    earlyBoxesEvicted = 0
+    _earlyBoxes = 0
+    recordMetrics = False
+    _metrics = None
+    compactRouteIds = False
+    _releasesAgreed = False
 
-    def __init__(self):
+    def __init__(self, window=None, clock=None, unknownRoute=RAISE,
+                 recordMetrics=False, compactRouteIds=False):
         self._routeCounter = count()
         self._unstarted = {}
+        if compactRouteIds:
+            self.compactRouteIds = True
+            self._idNames = []
+            self._ids = {}
+            self._freeIds = deque()
+            self._releasing = OrderedDict()
+        if unknownRoute not in (RAISE, DROP, ANSWER_ERROR, BUFFER):
+            raise ValueError("Unknown policy %r" % (unknownRoute,))
+        self.unknownRoute = unknownRoute
+        self._early = OrderedDict()
+        if window is not None and window < self.initialCredit:
+            raise ValueError(
+                "window must be at least %d" % (self.initialCredit,))
+        if clock is None and (window is not None or recordMetrics):
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        if window is not None:
+            self.window = window
+            self._active = deque()
+        if recordMetrics:
+            self.recordMetrics = True
+            self._metrics = _RouteMetrics(clock)
+            _meteredRouters.add(self)
 
 
     def createRouteIdentifier(self):
@@ -141,7 +570,44 @@ class Router:
 
         @rtype: C{unicode}
         """
-        return str(next(self._routeCounter))
+        if not self.compactRouteIds:
+            return str(next(self._routeCounter))
+        if self._freeIds:
+            routeId = self._freeIds.popleft()
+        else:
+            routeId = len(self._idNames)
+            self._idNames.append(_encodeRouteId(routeId))
+        routeName = self._idNames[routeId]
+        self._ids[routeName] = routeId
+        return routeName
+
+
+    def _releaseRouteId(self, routeId):
+        """
+        Allow the compact route identifier for C{routeId} to be reused, once
+        the router on the other end of the connection has acknowledged that
+        its route was unbound.
+        """
+        routeName = self._idNames[routeId]
+        self._releasing[routeName] = routeId
+        if self._releasesAgreed:
+            self._sender.sendBox({_ROUTE: _CONTROL, _RELEASE_ROUTE: routeName})
+
+
+    def _routeIdReleased(self, routeName):
+        """
+        Allow the compact route identifier C{routeName} to be reused, now that
+        the router on the other end of the connection has acknowledged that
+        its route was unbound, and give up on the boxes held on to for it.
+        """
+        routeId = self._releasing.pop(routeName, None)
+        if routeId is None:
+            return
+        boxes = self._early.pop(routeName, None)
+        if boxes is not None:
+            self._earlyBoxes -= len(boxes)
+            self._evict(routeName, boxes)
+        self._freeIds.append(routeId)
 
 
     def bindRoute(self, receiver, routeName=_unspecified):
@@ -158,9 +624,20 @@ class Router:
         """
         if routeName is _unspecified:
             routeName = self.createRouteIdentifier()
+        if type(routeName) is str:
+            # Boxes are looked up by this name, as it is the dict key.
+            routeName = intern(routeName)
         # self._sender may yet be None; if so, this route goes into _unstarted
         # and will have its sender set correctly in startReceivingBoxes below.
         route = Route(self, receiver, routeName)
+        if self.compactRouteIds:
+            route._id = self._ids.pop(routeName, None)
+        if self.window is not None:
+            route._queue = deque()
+            if self._peerCredit is not None:
+                route._credit = self._peerCredit
+        if self._metrics is not None:
+            route._slot = self._metrics.allocate()
         mapping = self._routes
         if mapping is None:
             mapping = self._unstarted
@@ -181,6 +658,12 @@ class Router:
                 route.start()
         self._routes = self._unstarted
         self._unstarted = None
+        if self.window is not None:
+            sender.sendBox({_ROUTE: _CONTROL,
+                            _FLOW_CONTROL: str(self.initialCredit)})
+        if self.compactRouteIds:
+            sender.sendBox({_ROUTE: _CONTROL,
+                            _ROUTE_RELEASES: _RELEASES_ASKED})
 
 
     def ampBoxReceived(self, box):
@@ -188,8 +671,271 @@ class Router:
         Dispatch the given box to the L{IBoxReceiver} associated with the route
         indicated by the box, or handle it directly if there is no route.
         """
-        route = box.pop(_ROUTE, None)
-        self._routes[route].receiver.ampBoxReceived(box)
+        routeName = box.pop(_ROUTE, None)
+        try:
+            route = self._routes[routeName]
+        except KeyError:
+            self._unknownRouteReceived(routeName, box)
+            return
+        if not route._started and self.unknownRoute is BUFFER:
+            self._hold(routeName, box)
+            return
+        if self._metrics is not None:
+            self._metrics.received(route._slot, _boxSize(box))
+        if self.window is None:
+            route.receiver.ampBoxReceived(box)
+        else:
+            self._flowControlledBoxReceived(route, box)
+
+
+    def _flowControlledBoxReceived(self, route, box):
+        """
+        Count C{box}, received for C{route}, against the route's window, or
+        add to the route's credit if it is a grant.
+        """
+        credit = box.pop(_CREDIT, None)
+        if credit is not None:
+            route._credit += int(credit)
+            if route._queue and not route._scheduled:
+                self._schedule(route)
+            return
+        route.receiver.ampBoxReceived(box)
+        route._consumed += 1
+        if route._consumed * 2 >= self.window:
+            self._grant(route, route._consumed)
+            route._consumed = 0
+
+
+    def _unknownRouteReceived(self, routeName, box):
+        """
+        Handle C{box}, received for the route named C{routeName} which is not
+        bound, according to C{unknownRoute}.
+        """
+        if routeName == _UNKNOWN:
+            self._unknownRouteAnswered(box)
+            return
+        if routeName == _CONTROL:
+            self._controlReceived(box)
+            return
+        policy = self.unknownRoute
+        if _CREDIT in box and policy is not BUFFER:
+            # The router on the other end grants credit to a route whether or
+            # not it has been unbound here, so this is not an error; unless
+            # the route may yet be bound, the credit is of no use.
+            return
+        if policy is RAISE:
+            raise KeyError(routeName)
+        self.unknownRouteBoxes += 1
+        if policy is BUFFER:
+            self._hold(routeName, box)
+        elif policy is ANSWER_ERROR and ASK in box:
+            self._answerUnknown(routeName, box)
+
+
+    def _controlReceived(self, box):
+        """
+        Start or stop applying flow control, as the router on the other end
+        of the connection says it does, or tell it that this router does not;
+        or agree to acknowledge that its routes were unbound, or acknowledge
+        that one was, or release the identifier of one of this router's
+        routes once that is acknowledged.
+        """
+        releases = box.get(_ROUTE_RELEASES)
+        if releases is not None:
+            if releases == _RELEASES_ASKED:
+                self._sender.sendBox({_ROUTE: _CONTROL,
+                                      _ROUTE_RELEASES: _RELEASES_AGREED})
+            elif (releases == _RELEASES_AGREED and self.compactRouteIds
+                  and not self._releasesAgreed):
+                self._releasesAgreed = True
+                for routeName in self._releasing:
+                    self._sender.sendBox(
+                        {_ROUTE: _CONTROL, _RELEASE_ROUTE: routeName})
+            return
+        released = box.get(_RELEASE_ROUTE)
+        if released is not None:
+            # Every box sent by the route before it was unbound has been
+            # received and dealt with by now, so any credit granted or error
+            # sent for it goes ahead of the acknowledgement.
+            self._sender.sendBox({_ROUTE: _CONTROL, _ROUTE_RELEASED: released})
+            return
+        released = box.get(_ROUTE_RELEASED)
+        if released is not None:
+            if self.compactRouteIds:
+                self._routeIdReleased(released)
+            return
+        flowControl = box.get(_FLOW_CONTROL)
+        if flowControl is None:
+            return
+        if self.window is None:
+            if flowControl != _NO_FLOW_CONTROL:
+                self._sender.sendBox({_ROUTE: _CONTROL,
+                                      _FLOW_CONTROL: _NO_FLOW_CONTROL})
+        elif self._peerCredit is None:
+            if flowControl == _NO_FLOW_CONTROL:
+                self._stopFlowControl()
+            else:
+                self._startFlowControl(int(flowControl))
+
+
+    def _startFlowControl(self, credit):
+        """
+        Give each route the initial credit granted by the router on the other
+        end of the connection, and grant the routes started so far the rest
+        of their windows.
+        """
+        self._peerCredit = credit
+        for route in self._routes.values():
+            route._credit += credit
+            if route._queue and not route._scheduled:
+                self._schedule(route)
+            if route._started:
+                self._grant(route, self.window - self.initialCredit)
+
+
+    def _stopFlowControl(self):
+        """
+        Send the boxes queued by each route, and send the boxes sent through
+        them from now on at once, since the router on the other end of the
+        connection does not apply flow control.
+        """
+        self.window = None
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+            self._drainCall = None
+        self._active.clear()
+        for route in self._routes.values():
+            queue, route._queue = route._queue, None
+            route._credit = route._deficit = 0
+            route._scheduled = False
+            for box in queue:
+                self._sender.sendBox(box)
+
+
+    def _answerUnknown(self, routeName, box):
+        """
+        Answer C{box}, which asks a question and was received for the route
+        named C{routeName}, with an error.
+        """
+        self._sender.sendBox({
+                _ROUTE: _UNKNOWN,
+                _UNKNOWN_ROUTE: routeName,
+                ERROR: box[ASK],
+                ERROR_CODE: UNKNOWN_ERROR_CODE,
+                ERROR_DESCRIPTION: 'Unknown route %r' % (routeName,)})
+
+
+    def _hold(self, routeName, box):
+        """
+        Hold on to C{box}, received for the route named C{routeName} which is
+        not started, until the route is started, evicting boxes if there are
+        too many.
+        """
+        boxes = self._early.get(routeName)
+        if boxes is None:
+            boxes = self._early[routeName] = []
+        elif len(boxes) >= self.maxEarlyBoxesPerRoute:
+            self._evict(routeName, [box])
+            return
+        boxes.append(box)
+        self._earlyBoxes += 1
+        while self._earlyBoxes > self.maxEarlyBoxes:
+            oldestName, oldest = self._early.popitem(last=False)
+            self._earlyBoxes -= len(oldest)
+            self._evict(oldestName, oldest)
+
+
+    def _evict(self, routeName, boxes):
+        """
+        Give up on delivering C{boxes}, received for the route named
+        C{routeName}.
+        """
+        self.earlyBoxesEvicted += len(boxes)
+        for box in boxes:
+            if ASK in box:
+                self._answerUnknown(routeName, box)
+
+
+    def _unknownRouteAnswered(self, box):
+        """
+        Deliver an error answer sent by the router on the other end of the
+        connection, for a box sent to one of its routes which is not bound,
+        to the route which sent it.
+        """
+        remoteName = box.pop(_UNKNOWN_ROUTE)
+        for route in self._routes.itervalues():
+            if route._remoteName == remoteName:
+                route.receiver.ampBoxReceived(box)
+                return
+        log.msg("Dropping error for unknown route %r" % (remoteName,))
+
+
+    def _replay(self, route):
+        """
+        Deliver the boxes received for C{route} before it was started.
+        """
+        boxes = self._early.pop(route.localRouteName, ())
+        self._earlyBoxes -= len(boxes)
+        for box in boxes:
+            if self._metrics is not None:
+                self._metrics.received(route._slot, _boxSize(box))
+            if self.window is None:
+                route.receiver.ampBoxReceived(box)
+            else:
+                self._flowControlledBoxReceived(route, box)
+
+
+    def _grant(self, route, credit):
+        """
+        Allow the route on the other end of the connection which sends to
+        C{route} to send C{credit} more boxes, once it has said that it
+        applies flow control.
+        """
+        if credit > 0 and self._peerCredit is not None:
+            box = {_CREDIT: str(credit)}
+            if route._remoteName is not None:
+                box[_ROUTE] = route._remoteName
+            self._sender.sendBox(box)
+
+
+    def _schedule(self, route):
+        """
+        Give C{route} a turn to send its queued boxes, and arrange for turns
+        to be taken if they are not already going to be.
+        """
+        route._scheduled = True
+        self._active.append(route)
+        if self._drainCall is None:
+            self._drainCall = self._clock.callLater(0, self._drain)
+
+
+    def _drain(self):
+        """
+        Send queued boxes, giving each route with boxes and credit turns to
+        send up to C{quantum} bytes in round robin order, until no route has
+        both.  A route whose next box is too big for its turn keeps what it
+        did not use of its turn for the next one.
+        """
+        self._drainCall = None
+        active = self._active
+        sender = self._sender
+        quantum = self.quantum
+        while active:
+            route = active.popleft()
+            queue = route._queue
+            route._deficit += quantum
+            while queue and route._credit:
+                size = _boxSize(queue[0])
+                if size > route._deficit:
+                    break
+                route._deficit -= size
+                route._credit -= 1
+                sender.sendBox(queue.popleft())
+            if queue and route._credit:
+                active.append(route)
+            else:
+                route._deficit = 0
+                route._scheduled = False
 
 
     def stopReceivingBoxes(self, reason):
@@ -199,7 +945,122 @@ class Router:
         for routeName, route in self._routes.items():
             route.stop(reason)
         self._routes = None
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+            self._drainCall = None
+        if self.window is not None:
+            self._active.clear()
+        self._early.clear()
+        self._earlyBoxes = 0
+
+
+    def _allRoutes(self):
+        """
+        Return the routes bound to this router.
+        """
+        if self._routes is None:
+            return self._unstarted.values()
+        return self._routes.values()
+
+
+    def _routeMetrics(self, route):
+        """
+        Return the traffic through C{route}, which has a slot.
+        """
+        result = self._metrics.snapshot(route._slot)
+        result['route'] = route.localRouteName
+        if route._queue is None:
+            result['queued'] = 0
+        else:
+            result['queued'] = len(route._queue)
+        return result
+
+
+    def metrics(self):
+        """
+        Return the traffic through all of this router's routes, bound now or
+        before, if it records metrics.
+
+        @return: C{None}, or a C{dict} with the totals of the counts of the
+            boxes and bytes sent and received, as C{boxesIn}, C{bytesIn},
+            C{boxesOut} and C{bytesOut}; the number of routes, as C{routes};
+            the number which have been bound and unbound, as C{routesBound}
+            and C{routesUnbound}; the number of boxes queued, as C{queued};
+            and C{unknownRouteBoxes} and C{earlyBoxesEvicted}.
+        """
+        metrics = self._metrics
+        if metrics is None:
+            return None
+        result = metrics.totals()
+        routes = self._allRoutes()
+        result['routes'] = len(routes)
+        result['routesBound'] = metrics.routesBound
+        result['routesUnbound'] = metrics.routesUnbound
+        result['queued'] = sum([len(route._queue) for route in routes
+                                if route._queue is not None])
+        result['unknownRouteBoxes'] = self.unknownRouteBoxes
+        result['earlyBoxesEvicted'] = self.earlyBoxesEvicted
+        return result
+
+
+    def topRoutes(self, n=10):
+        """
+        Return the traffic through the C{n} bound routes which have sent and
+        received the most bytes, if this router records metrics.
+
+        @return: A C{list}, busiest first, of C{dict}s with the route's name,
+            as C{route}; the counts of boxes and bytes sent and received
+            through it, as C{boxesIn}, C{bytesIn}, C{boxesOut} and
+            C{bytesOut}; the number of boxes queued, as C{queued}; and the
+            time of its last activity, as C{lastActivity}.
+        """
+        if self._metrics is None:
+            return []
+        metrics = self._metrics
+        bytesIn = metrics.bytesIn
+        bytesOut = metrics.bytesOut
+        busiest = heapq.nlargest(
+            n, self._allRoutes(),
+            key=lambda route: bytesIn[route._slot] + bytesOut[route._slot])
+        return [self._routeMetrics(route) for route in busiest]
+
+
+
+_meteredRouters = weakref.WeakSet()
+
+def topRoutes(n=10):
+    """
+    Return the traffic through the C{n} routes which have sent and received
+    the most bytes, of all the routers in this process which record metrics.
+
+    @return: A C{list} like that returned by L{Router.topRoutes}, with the
+        C{id} of each route's router added as C{router}.
+    """
+    candidates = []
+    for router in list(_meteredRouters):
+        for result in router.topRoutes(n):
+            result['router'] = id(router)
+            candidates.append(result)
+    return heapq.nlargest(
+        n, candidates,
+        key=lambda result: result['bytesIn'] + result['bytesOut'])
+
+
+
+def logTopRoutes(n=10):
+    """
+    Log the traffic through the C{n} busiest routes in this process, as found
+    by L{topRoutes}.
+    """
+    log.msg("Busiest AMP routes:")
+    for result in topRoutes(n):
+        log.msg("  router 0x%(router)x route %(route)r: "
+                "%(boxesIn)d boxes/%(bytesIn)d bytes in, "
+                "%(boxesOut)d boxes/%(bytesOut)d bytes out, "
+                "%(queued)d queued, last active at %(lastActivity).3f"
+                % result)
 
 
 
-__all__ = ['Router', 'Route']
+__all__ = ['Router', 'Route', 'topRoutes', 'logTopRoutes',
+           'RAISE', 'DROP', 'ANSWER_ERROR', 'BUFFER']
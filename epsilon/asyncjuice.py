@@ -0,0 +1,318 @@
+# -*- test-case-name: epsilon.test.test_asyncjuice -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Juice on an C{asyncio} event loop, without the Twisted reactor.
+
+L{AsyncJuice} is an C{asyncio.Protocol} which uses the same parsers,
+serializers, dispatching and L{juice.Command}s as L{juice.Juice}, so it can
+talk to one.  L{juice.Command.do} returns an C{asyncio} future for a command
+sent over it, and its responders may return coroutines or futures as well as
+results.  The responders of commands with C{threaded} set run in the event
+loop's executor.  For example::
+
+    server = loop.run_until_complete(
+        loop.create_server(lambda: MyAsyncJuice(loop), host, port))
+
+On Python 2, the C{trollius} backport of C{asyncio} is used, if it is
+installed.
+"""
+
+__metaclass__ = type
+
+import functools, weakref
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+
+from epsilon.juice import (
+    JuiceParserBase, JuiceFrameParser, JuiceBoxSerializer, JuiceBox, Juice,
+    HandlerPool)
+
+
+class _DelayedCall:
+    """
+    The part of L{twisted.internet.interfaces.IDelayedCall} which Juice uses,
+    for a call scheduled on an C{asyncio} event loop.
+    """
+    def __init__(self, loop, delay, f, args, kw):
+        self.called = False
+        self._handle = loop.call_later(delay, self._run, f, args, kw)
+
+
+    def _run(self, f, args, kw):
+        self.called = True
+        f(*args, **kw)
+
+
+    def active(self):
+        return not self.called and self._handle is not None
+
+
+    def cancel(self):
+        self._handle.cancel()
+        self._handle = None
+
+
+
+class _LoopClock:
+    """
+    The part of L{twisted.internet.interfaces.IReactorTime} which Juice uses,
+    implemented with an C{asyncio} event loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+
+    def seconds(self):
+        return self.loop.time()
+
+
+    def callLater(self, delay, f, *args, **kw):
+        return _DelayedCall(self.loop, delay, f, args, kw)
+
+
+
+class _TransportAdapter:
+    """
+    The part of L{twisted.internet.interfaces.ITransport} and
+    L{twisted.internet.interfaces.IPushProducer} which Juice uses,
+    implemented with an C{asyncio} transport.
+
+    @ivar disconnecting: C{True} once L{loseConnection} has been called.
+    """
+    disconnecting = False
+
+    def __init__(self, transport):
+        self._transport = transport
+
+
+    def write(self, data):
+        self._transport.write(data)
+
+
+    def writeSequence(self, data):
+        self._transport.writelines(data)
+
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self._transport.close()
+
+
+    def getPeer(self):
+        return self._transport.get_extra_info('peername')
+
+
+    def getHost(self):
+        return self._transport.get_extra_info('sockname')
+
+
+    def pauseProducing(self):
+        self._transport.pause_reading()
+
+
+    def resumeProducing(self):
+        self._transport.resume_reading()
+
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+
+def deferredFromFuture(future):
+    """
+    Return a L{Deferred} which fires with the result of an C{asyncio} future,
+    or fails with its exception.
+    """
+    d = Deferred()
+    def done(future):
+        if future.cancelled():
+            d.errback(Failure(asyncio.CancelledError()))
+        elif future.exception() is not None:
+            d.errback(Failure(future.exception()))
+        else:
+            d.callback(future.result())
+    future.add_done_callback(done)
+    return d
+
+
+
+def futureFromDeferred(d, loop):
+    """
+    Return an C{asyncio} future on C{loop} which has the result of a
+    L{Deferred}, or its exception.
+    """
+    future = asyncio.Future(loop=loop)
+    def succeeded(result):
+        if not future.cancelled():
+            future.set_result(result)
+    def failed(reason):
+        if not future.cancelled():
+            future.set_exception(reason.value)
+    d.addCallbacks(succeeded, failed)
+    return future
+
+
+
+class LoopHandlerPool(HandlerPool):
+    """
+    A L{HandlerPool} which runs responders in the executor of an C{asyncio}
+    event loop, and delivers their results on the loop, without the Twisted
+    reactor.
+
+    @ivar loop: the event loop.
+
+    @ivar executor: the C{concurrent.futures.Executor} which responders run
+        in, or C{None} for the loop's default one.
+    """
+    def __init__(self, loop, executor=None):
+        HandlerPool.__init__(self)
+        self.loop = loop
+        self.executor = executor
+
+
+    def _callInThread(self, responder, kw):
+        return deferredFromFuture(self.loop.run_in_executor(
+                self.executor, functools.partial(responder, **kw)))
+
+
+
+# The LoopHandlerPool of each event loop, shared by the connections on it.
+_handlerPools = weakref.WeakKeyDictionary()
+
+def _handlerPoolFor(loop):
+    """
+    Return the L{LoopHandlerPool} for C{loop}, creating it if necessary.
+    """
+    pool = _handlerPools.get(loop)
+    if pool is None:
+        pool = _handlerPools[loop] = LoopHandlerPool(loop)
+    return pool
+
+
+
+class AsyncJuice(asyncio.Protocol, JuiceParserBase):
+    """
+    A Juice connection on an C{asyncio} event loop.
+
+    Protocol version negotiation requested by the peer is supported, but
+    switching to another protocol and starting TLS are not.
+
+    @ivar transport: C{None}, or the connection's transport, adapted to the
+        interface which Juice expects of a Twisted transport.
+
+    @ivar loop: the event loop which I run on, and which schedules request
+        timeouts.
+
+    @ivar handlerPool: the L{HandlerPool} which runs the responders of
+        threaded commands.  Unless one is set, it is the L{LoopHandlerPool}
+        shared by every connection on my event loop, so that a command's
+        C{threadLimit} applies to the whole loop.
+    """
+
+    transport = None
+    handlerPool = None
+
+    # Set this to True to receive box bodies as memoryviews rather than
+    # strings, saving a copy of each large body.
+    memoryviewBodies = False
+
+    # The type of the boxes received.
+    boxType = JuiceBox
+
+    maxBodyLength = Juice.maxBodyLength
+
+    _framings = Juice._framings
+    protocolVersion = 0
+
+    def __init__(self, loop=None):
+        JuiceParserBase.__init__(self)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.clock = _LoopClock(loop)
+        if self.handlerPool is None:
+            self.handlerPool = _handlerPoolFor(loop)
+        self._serializer = JuiceBoxSerializer()
+        self._parser = self._makeParser(JuiceFrameParser)
+
+
+    def __repr__(self):
+        return '<%s at 0x%x>' % (self.__class__.__name__, id(self))
+
+
+    def _makeParser(self, parserType):
+        return parserType(self._frameReceived, self.memoryviewBodies,
+                          self._streamFor, self.boxType, self.maxBodyLength)
+
+
+    def connection_made(self, transport):
+        self.transport = _TransportAdapter(transport)
+
+
+    def data_received(self, data):
+        parser = self._parser
+        data = parser.dataReceived(data)
+        while self._parser is not parser:
+            # A box changed the framing; parse the rest in the new one.
+            parser = self._parser
+            data = parser.dataReceived(data)
+
+
+    def connection_lost(self, exc):
+        if exc is None:
+            reason = Failure(ConnectionDone())
+        else:
+            reason = Failure(ConnectionLost(str(exc)))
+        self._parser.connectionLost(reason)
+        self.failAllOutgoing(reason)
+
+
+    def _frameReceived(self, box):
+        self.juiceBoxReceived(box)
+        if self.transport is not None and self.transport.disconnecting:
+            self._parser.stop()
+
+
+    def sendPacket(self, completeBox):
+        """
+        Send a box to my peer.
+        """
+        self.transport.write(self._serializer.serialize(completeBox))
+
+
+    def sendCommand(self, command, __content='', __answer=True, **kw):
+        box = JuiceBox(__content, **kw)
+        d = self.sendBoxCommand(command, box, requiresAnswer=__answer)
+        if d is not None:
+            d = futureFromDeferred(d, self.loop)
+        return d
+
+
+    def _commandResult(self, result):
+        return futureFromDeferred(result, self.loop)
+
+
+    def _callResponder(self, responder, kw):
+        try:
+            result = responder(**kw)
+        except:
+            return fail()
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            return deferredFromFuture(
+                asyncio.ensure_future(result, loop=self.loop))
+        return succeed(result)
+
+
+    # Boxes are framed, and bodies streamed, just as they are by Juice.
+    _streamFor = Juice.__dict__['_streamFor']
+    _setProtocolVersion = Juice.__dict__['_setProtocolVersion']
+    command_NEGOTIATE = Juice.__dict__['command_NEGOTIATE']
@@ -3,16 +3,21 @@
 
 __metaclass__ = type
 
-import warnings, pprint
+import warnings, pprint, math, weakref, struct, json
 
+from collections import deque, MutableMapping
+
+from zope.interface import implements
+
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.main import CONNECTION_LOST
 from twisted.internet.defer import Deferred, maybeDeferred, fail
-from twisted.internet.protocol import ServerFactory, ClientFactory
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet.protocol import Protocol, ServerFactory, ClientFactory
 from twisted.internet.ssl import Certificate
 from twisted.python.failure import Failure
 from twisted.python import log, filepath
 
-from epsilon.liner import LineReceiver
 from epsilon import extime
 
 ASK = '_ask'
@@ -23,6 +28,7 @@ ERROR_CODE = '_error_code'
 ERROR_DESCRIPTION = '_error_description'
 LENGTH = '_length'
 BODY = 'body'
+PARTS = '_parts'
 
 debug = False
 
@@ -69,7 +75,10 @@ class JuiceBox(dict):
 
         L.append(delimiter)
         if BODY in self:
-            L.append(self[BODY])
+            body = self[BODY]
+            if isinstance(body, memoryview):
+                body = body.tobytes()
+            L.append(body)
 
         bytes = ''.join(L)
         return bytes
@@ -92,6 +101,463 @@ class JuiceBox(dict):
 
 Box = JuiceBox
 
+_RESERVED_KEYS = frozenset([
+    ASK, ANSWER, COMMAND, ERROR, ERROR_CODE, ERROR_DESCRIPTION, BODY])
+
+_MISSING = object()
+
+class CompactJuiceBox:
+    """
+    I am a box which behaves like a L{JuiceBox} but takes much less memory,
+    for applications which hold very many boxes at once.  The keys reserved
+    for the protocol, and the body, are kept in slots, and any other keys and
+    their values alternate in one C{tuple}, which is searched in order rather
+    than hashed, and replaced when it changes; boxes rarely have more than a
+    few such keys.
+
+    @ivar _fields: C{None}, or a C{tuple} of keys other than the reserved
+        ones, each followed by its value.  Copies of a box share it.
+    """
+
+    __slots__ = tuple(_RESERVED_KEYS) + ('_fields',)
+
+    def __init__(self, __body='', **kw):
+        self._fields = None
+        if kw:
+            self.update(kw)
+        if __body:
+            assert isinstance(__body, str), "body must be a string: %r" % ( repr(__body),)
+            self[BODY] = __body
+
+    def _find(self, key):
+        """
+        Return the index of C{key} in C{_fields}, or -1 if it is not there.
+        """
+        fields = self._fields
+        if fields is None:
+            return -1
+        i = 0
+        while True:
+            try:
+                i = fields.index(key, i)
+            except ValueError:
+                return -1
+            if not i % 2:
+                return i
+            i += 1
+
+    def __getitem__(self, key):
+        if key in _RESERVED_KEYS:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self._fields[i + 1]
+
+    def __setitem__(self, key, value):
+        if key in _RESERVED_KEYS:
+            setattr(self, key, value)
+            return
+        fields = self._fields
+        i = self._find(key)
+        if i != -1:
+            self._fields = fields[:i + 1] + (value,) + fields[i + 2:]
+        elif fields is None:
+            self._fields = (key, value)
+        else:
+            self._fields = fields + (key, value)
+
+    def __delitem__(self, key):
+        if key in _RESERVED_KEYS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            return
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        fields = self._fields[:i] + self._fields[i + 2:]
+        self._fields = fields or None
+
+    def __contains__(self, key):
+        if key in _RESERVED_KEYS:
+            return getattr(self, key, _MISSING) is not _MISSING
+        return self._find(key) != -1
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def items(self):
+        result = []
+        for key in _RESERVED_KEYS:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                result.append((key, value))
+        fields = self._fields
+        if fields is not None:
+            result.extend(zip(fields[::2], fields[1::2]))
+        return result
+
+    def keys(self):
+        return [key for (key, value) in self.items()]
+
+    def values(self):
+        return [value for (key, value) in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def __len__(self):
+        return len(self.items())
+
+    def update(self, other=(), **kw):
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for (key, value) in other:
+            self[key] = value
+        for (key, value) in kw.items():
+            self[key] = value
+
+    def clear(self):
+        for key in _RESERVED_KEYS:
+            if hasattr(self, key):
+                delattr(self, key)
+        self._fields = None
+
+    def copy(self):
+        newBox = self.__class__()
+        for key in _RESERVED_KEYS:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                setattr(newBox, key, value)
+        newBox._fields = self._fields
+        return newBox
+
+    def __eq__(self, other):
+        if not isinstance(other, MutableMapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    serialize = JuiceBox.__dict__['serialize']
+    sendTo = JuiceBox.__dict__['sendTo']
+
+MutableMapping.register(CompactJuiceBox)
+
+class JuiceBoxSerializer:
+    """
+    I produce the same bytes as L{JuiceBox.serialize}, with less work per
+    box: the wire form of each header name is computed once and cached,
+    values are only escaped if they contain a line break, and boxes are
+    written directly into a C{bytearray}.
+
+    @ivar cacheSize: the greatest number of header names to cache.  When the
+        cache is full it is emptied; a connection uses few enough distinct
+        header names that this is rare, and tracking the recency of every
+        lookup would cost more than it saves.
+
+    @ivar _names: a C{dict} mapping box keys to their wire form, including
+        the C{': '} which follows them.
+
+    @ivar _buffer: the C{bytearray} used by L{serialize}.
+    """
+
+    def __init__(self, cacheSize=1024):
+        self.cacheSize = cacheSize
+        self._names = {}
+        self._buffer = bytearray()
+
+    def _headerName(self, key):
+        names = self._names
+        if len(names) >= self.cacheSize:
+            names.clear()
+        name = names[key] = key.replace('_', '-').title() + ': '
+        return name
+
+    def serializeInto(self, box, buf):
+        """
+        Append the serialized form of C{box} to the C{bytearray} C{buf}.
+        """
+        assert LENGTH not in box
+        names = self._names
+        for (k, v) in box.items():
+            if k == BODY:
+                k = LENGTH
+                v = str(len(v))
+            elif '\r\n' in v:
+                v = v.replace('\r\n', '\r\n ')
+            name = names.get(k)
+            if name is None:
+                name = self._headerName(k)
+            buf += name
+            buf += v
+            buf += '\r\n'
+        buf += '\r\n'
+        if BODY in box:
+            buf += box[BODY]
+
+    def serialize(self, box):
+        """
+        Return the serialized form of C{box}, as L{JuiceBox.serialize} would.
+        """
+        buf = self._buffer
+        try:
+            self.serializeInto(box, buf)
+            data = bytes(buf)
+        finally:
+            # Leave nothing of a box which could not be serialized in front
+            # of the next one.
+            del buf[:]
+        return data
+
+# The binary framing of protocol version 2: each header is a key length, a
+# value length, the key and the value, and the header block ends with a
+# zero key length followed by the length of the body.
+_binaryPair = struct.Struct('!HI')
+
+# The length of the longest key the binary framings can send.
+_MAX_KEY_LENGTH = 0xffff
+
+class BinaryJuiceBoxSerializer:
+    """
+    I serialize boxes in the binary framing of protocol version 2.  Keys and
+    values are written exactly as they are, each preceded by its length, so
+    nothing needs escaping or case conversion.
+
+    @ivar _buffer: the C{bytearray} used by L{serialize}.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def serializeInto(self, box, buf):
+        """
+        Append the serialized form of C{box} to the C{bytearray} C{buf}.
+        """
+        assert LENGTH not in box
+        pack = _binaryPair.pack
+        body = None
+        for (k, v) in box.items():
+            if k == BODY:
+                body = v
+                continue
+            keyLength = len(k)
+            if not 0 < keyLength <= _MAX_KEY_LENGTH:
+                # An empty key would end the header block.
+                raise MalformedJuiceBox(
+                    "Cannot send a key of %d bytes" % (keyLength,))
+            buf += pack(keyLength, len(v))
+            buf += k
+            buf += v
+        if body is None:
+            buf += pack(0, 0)
+        else:
+            buf += pack(0, len(body))
+            buf += body
+
+    def serialize(self, box):
+        """
+        Return the serialized form of C{box}.
+        """
+        buf = self._buffer
+        try:
+            self.serializeInto(box, buf)
+            data = bytes(buf)
+        finally:
+            del buf[:]
+        return data
+
+# The framing of protocol version 3 is that of version 2, except that each
+# header is preceded by an opcode, and may refer to a header name or a whole
+# header in a table which each end keeps for each direction of the
+# connection.  The tables are filled as literal headers are sent and
+# received, so both ends agree on their contents without ever sending them.
+_HEADER_END = 0             # body length follows
+_HEADER_LITERAL = 1         # key length, value length, key, value
+_HEADER_LITERAL_INDEXED = 2 # the same, also adding the header to the table
+_HEADER_NAMED = 3           # name index, value length, value
+_HEADER_NAMED_INDEXED = 4   # the same, also adding the header to the table
+_HEADER_INDEXED = 5         # header index
+
+_headerOp = struct.Struct('!BHI')
+_headerIndex = struct.Struct('!BH')
+
+_NAME_TABLE_SIZE = 256
+_HEADER_TABLE_SIZE = 1024
+
+class _HeaderTable:
+    """
+    A fixed number of entries, each of which, once the table is full,
+    replaces the oldest one.
+
+    @ivar entries: a C{list} of the entries, by index.
+
+    @ivar indexes: a C{dict} mapping each entry to its index.
+
+    @ivar _next: the index of the next entry added.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = []
+        self.indexes = {}
+        self._next = 0
+
+    def add(self, entry):
+        index = self._next
+        self._next = (index + 1) % self.size
+        entries = self.entries
+        if len(entries) < self.size:
+            entries.append(entry)
+        else:
+            old = entries[index]
+            if self.indexes.get(old) == index:
+                del self.indexes[old]
+            entries[index] = entry
+        self.indexes[entry] = index
+
+class HeaderTableJuiceBoxSerializer:
+    """
+    I serialize boxes in the framing of protocol version 3, sending header
+    names and whole headers which I have sent before as indexes into tables
+    of them.  I keep the tables for one direction of one connection.
+
+    @ivar maxIndexedLength: the length of the longest value of a header
+        which is added to the table of whole headers.  Longer values are
+        unlikely to be sent again.
+
+    @ivar unindexedKeys: keys whose headers are never added to the table of
+        whole headers, since their values are request tags, which are not
+        repeated.
+    """
+
+    maxIndexedLength = 64
+    unindexedKeys = frozenset([ASK, ANSWER, ERROR])
+
+    def __init__(self):
+        self._names = _HeaderTable(_NAME_TABLE_SIZE)
+        self._headers = _HeaderTable(_HEADER_TABLE_SIZE)
+        self._buffer = bytearray()
+
+    def _check(self, box):
+        """
+        Raise an exception if C{box} cannot be serialized, so that it does
+        not change the tables, which the peer's would then not match.
+        """
+        for (k, v) in box.items():
+            if k == BODY:
+                continue
+            if not (isinstance(k, str) and isinstance(v, str)):
+                raise TypeError(
+                    "Cannot send a header which is not strings: %r: %r"
+                    % (k, v))
+            if len(k) > _MAX_KEY_LENGTH:
+                raise MalformedJuiceBox(
+                    "Cannot send a key of %d bytes" % (len(k),))
+
+    def serializeInto(self, box, buf):
+        """
+        Append the serialized form of C{box} to the C{bytearray} C{buf}.
+        """
+        assert LENGTH not in box
+        self._check(box)
+        packOp = _headerOp.pack
+        packIndex = _headerIndex.pack
+        names = self._names
+        headers = self._headers
+        nameIndexes = names.indexes
+        headerIndexes = headers.indexes
+        body = None
+        for (k, v) in box.items():
+            if k == BODY:
+                body = v
+                continue
+            index = headerIndexes.get((k, v))
+            if index is not None:
+                buf += packIndex(_HEADER_INDEXED, index)
+                continue
+            indexed = (len(v) <= self.maxIndexedLength and
+                       k not in self.unindexedKeys)
+            if indexed:
+                headers.add((k, v))
+            index = nameIndexes.get(k)
+            if index is None:
+                names.add(k)
+                if indexed:
+                    op = _HEADER_LITERAL_INDEXED
+                else:
+                    op = _HEADER_LITERAL
+                buf += packOp(op, len(k), len(v))
+                buf += k
+            else:
+                if indexed:
+                    op = _HEADER_NAMED_INDEXED
+                else:
+                    op = _HEADER_NAMED
+                buf += packOp(op, index, len(v))
+            buf += v
+        if body is None:
+            buf += packOp(_HEADER_END, 0, 0)
+        else:
+            buf += packOp(_HEADER_END, 0, len(body))
+            buf += body
+
+    def serialize(self, box):
+        """
+        Return the serialized form of C{box}.
+        """
+        buf = self._buffer
+        try:
+            self.serializeInto(box, buf)
+            data = bytes(buf)
+        finally:
+            del buf[:]
+        return data
+
 class TLSBox(JuiceBox):
     def __repr__(self):
         return 'TLS(**%s)' % (super(TLSBox, self).__repr__(),)
@@ -119,6 +585,7 @@ class QuitBox(JuiceBox):
 
     def sendTo(self, proto):
         super(QuitBox, self).sendTo(proto)
+        proto.flushWrites()
         proto.transport.loseConnection()
 
 class _SwitchBox(JuiceBox):
@@ -147,6 +614,18 @@ class NegotiateBox(JuiceBox):
 
 
 
+class _NegotiateRequestBox(JuiceBox):
+    """
+    A L{Negotiate} request.  Once it has been written, L{Juice.sendPacket}
+    holds back everything else until the answer arrives, since until then it
+    is not known which framing the peer will expect.
+    """
+    def __repr__(self):
+        return 'NegotiateRequest(**%s)' % (
+            super(_NegotiateRequestBox, self).__repr__(),)
+
+
+
 class JuiceError(Exception):
     pass
 
@@ -181,6 +660,17 @@ class UnhandledCommand(JuiceError):
 class IncompatibleVersions(JuiceError):
     pass
 
+class NegotiationInProgress(JuiceError):
+    """
+    A L{Negotiate} command was refused because it arrived while one sent the
+    other way was awaiting its answer.
+    """
+
+class RequestTimedOut(JuiceError):
+    """
+    No answer to a command arrived within its timeout.
+    """
+
 class _Transactor:
     def __init__(self, store, callable):
         self.store = store
@@ -192,12 +682,197 @@ class _Transactor:
     def __repr__(self):
         return '<Transaction in: %s of: %s>' % (self.store, self.callable)
 
+class _DispatchTable:
+    """
+    The results of looking up command names on one L{DispatchMixin}
+    subclass.
+
+    @ivar commands: a C{dict} mapping commands, as received, to their
+        L{_Handler}s.  Only commands which have handlers are included.
+
+    @ivar handlers: a C{dict} mapping normalized command names to their
+        L{_Handler}s, or to C{None} if the class has no handler for the
+        command.
+
+    @ivar direct: C{True} if the class uses L{DispatchMixin}'s own
+        C{lookupFunction} and C{_auto}, so that responders may be called
+        without them.
+
+    @ivar maxSize: the greatest number of entries either C{dict} may hold
+        before it is emptied, since both are keyed by names chosen by the
+        peer.
+    """
+
+    maxSize = 1024
+
+    def __init__(self, cls):
+        self.commands = {}
+        self.handlers = {}
+        self.direct = (
+            cls.lookupFunction.im_func is DispatchMixin.lookupFunction.im_func
+            and cls._auto.im_func is DispatchMixin._auto.im_func)
+
+class _Handler:
+    """
+    The handler for one command on a L{DispatchMixin} subclass, ready to be
+    bound to an instance without looking it up again.
+
+    @ivar name: the normalized name of the command.
+
+    @ivar auto: C{True} if the handler is a C{command_} responder, C{False}
+        if it is a C{juice_} method which is passed the box.
+
+    @ivar command: the L{Command} subclass the responder handles, or C{None}
+        if C{auto} is C{False}.
+
+    @ivar attributeName: the name of the handler.
+
+    @ivar _attribute: the handler as found in the C{__dict__} of the class or
+        of one of its bases.
+
+    @ivar _get: the C{__get__} method of the type of C{_attribute}, or
+        C{None} if it is not a descriptor.
+    """
+
+    def __init__(self, name, cls, attributeName, auto):
+        self.name = name
+        self.attributeName = attributeName
+        self.auto = auto
+        if auto:
+            self.command = getattr(cls, attributeName).command
+        else:
+            self.command = None
+        for klass in cls.__mro__:
+            if attributeName in klass.__dict__:
+                self._attribute = klass.__dict__[attributeName]
+                break
+        self._get = getattr(type(self._attribute), '__get__', None)
+
+    def bind(self, dispatcher):
+        """
+        Return the handler as C{getattr} would find it on C{dispatcher}.
+        """
+        instanceHandler = dispatcher.__dict__.get(self.attributeName)
+        if instanceHandler is not None:
+            return instanceHandler
+        if self._get is None:
+            return self._attribute
+        return self._get(self._attribute, dispatcher, type(dispatcher))
+
+class _CommandQueue:
+    """
+    The responders of one L{Command} waiting for, or running in, a
+    L{HandlerPool}.
+
+    @ivar limit: the greatest number which may run at once, or C{None}.
+
+    @ivar waiting: a C{deque} of (responder, arguments, L{Deferred}) tuples
+        for the responders waiting to run.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.waiting = deque()
+        self.running = 0
+        self.maxQueued = 0
+        self.completed = 0
+
+class HandlerPool:
+    """
+    I run the responders of L{Command}s with C{threaded} set in a thread
+    pool, so that blocking or CPU-heavy ones do not stall every connection,
+    and deliver their results back on the reactor thread.
+
+    No more than a command's C{threadLimit} of its responders run at once;
+    the rest wait in a queue for that command, so one busy command cannot
+    take every thread.
+
+    @ivar reactor: the reactor which results are delivered on, or C{None}
+        for the global reactor.
+
+    @ivar threadPool: the L{twisted.python.threadpool.ThreadPool} which
+        responders run in, or C{None} for the reactor's.
+
+    @ivar _queues: a C{dict} mapping L{Command} subclasses to their
+        L{_CommandQueue}s.
+    """
+
+    def __init__(self, reactor=None, threadPool=None):
+        self.reactor = reactor
+        self.threadPool = threadPool
+        self._queues = {}
+
+    def run(self, command, responder, kw):
+        """
+        Call C{responder} with the arguments C{kw} to C{command} in a
+        thread, once fewer than C{command.threadLimit} are running.
+
+        @return: a L{Deferred} which fires with its result.
+        """
+        queue = self._queues.get(command)
+        if queue is None:
+            queue = self._queues[command] = _CommandQueue(command.threadLimit)
+        d = Deferred()
+        queue.waiting.append((responder, kw, d))
+        self._runWaiting(queue)
+        if len(queue.waiting) > queue.maxQueued:
+            queue.maxQueued = len(queue.waiting)
+        return d
+
+    def _runWaiting(self, queue):
+        while queue.waiting and (queue.limit is None or
+                                 queue.running < queue.limit):
+            responder, kw, d = queue.waiting.popleft()
+            queue.running += 1
+            self._callInThread(responder, kw).addBoth(self._finished, queue, d)
+
+    def _callInThread(self, responder, kw):
+        """
+        Call C{responder} with the arguments C{kw} in my thread pool.
+
+        @return: a L{Deferred} which fires with its result on the reactor
+            thread.
+        """
+        reactor = self.reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        threadPool = self.threadPool
+        if threadPool is None:
+            threadPool = reactor.getThreadPool()
+        return deferToThreadPool(reactor, threadPool, responder, **kw)
+
+    def _finished(self, result, queue, d):
+        queue.running -= 1
+        queue.completed += 1
+        self._runWaiting(queue)
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def metrics(self):
+        """
+        Return a C{dict} mapping each L{Command} subclass whose responders
+        have been run to a C{dict} describing them.
+        """
+        metrics = {}
+        for command, queue in self._queues.items():
+            metrics[command] = {'running': queue.running,
+                                'queued': len(queue.waiting),
+                                'maxQueued': queue.maxQueued,
+                                'completed': queue.completed}
+        return metrics
+
 class DispatchMixin:
     baseDispatchPrefix = 'juice_'
     autoDispatchPrefix = 'command_'
 
     wrapper = None
 
+    # The HandlerPool which runs the responders of threaded commands.  It is
+    # shared by every dispatcher, so that a command's threadLimit applies to
+    # the whole process.
+    handlerPool = HandlerPool()
+
     def _auto(self, aCallable, proto, namespace=None):
         if aCallable is None:
             return None
@@ -210,25 +885,41 @@ class DispatchMixin:
             log.msg('WRONG NAMESPACE: %r, %r' % (namespace, command.namespaces))
             return None
         def doit(box):
-            kw = stringsToObjects(box, command.arguments, proto)
-            for name, extraArg in command.extra:
-                kw[name] = extraArg.fromTransport(proto.transport)
-#             def checkIsDict(result):
-#                 if not isinstance(result, dict):
-#                     raise RuntimeError("%r returned %r, not dictionary" % (
-#                             aCallable, result))
-#                 return result
-            def checkKnownErrors(error):
-                key = error.trap(*command.allErrors)
-                code = command.allErrors[key]
-                desc = str(error.value)
-                return Failure(RemoteJuiceError(
-                        code, desc, error in command.fatalErrors))
-            return maybeDeferred(aCallable, **kw).addCallback(
-                command.makeResponse, proto).addErrback(
-                checkKnownErrors)
+            return self._respond(command, aCallable, proto, box)
         return doit
 
+    def _respond(self, command, responder, proto, box):
+        """
+        Call C{responder} with the arguments to C{command} in C{box}, and
+        return a L{Deferred} which fires with the response box.
+        """
+        kw = command._compiledArguments.toObjects(box, proto)
+        if command.streamBody:
+            kw[BODY] = box[BODY]
+        for name, extraArg in command.extra:
+            kw[name] = extraArg.fromTransport(proto.transport)
+        if command.threaded:
+            d = self.handlerPool.run(command, responder, kw)
+        else:
+            d = self._callResponder(responder, kw)
+        return d.addCallback(
+            command.makeResponse, proto).addErrback(
+            self._checkKnownErrors, command)
+
+    def _checkKnownErrors(self, error, command):
+        key = error.trap(*command.allErrors)
+        code = command.allErrors[key]
+        desc = str(error.value)
+        return Failure(RemoteJuiceError(
+                code, desc, error in command.fatalErrors))
+
+    def _callResponder(self, responder, kw):
+        """
+        Call the responder for a command with its arguments, and return a
+        L{Deferred} which fires with its result.
+        """
+        return maybeDeferred(responder, **kw)
+
     def _wrap(self, aCallable):
         if aCallable is None:
             return None
@@ -243,26 +934,124 @@ class DispatchMixin:
         """
         return cmd.upper().strip().replace('-', '_')
 
+    def _dispatchTable(self):
+        """
+        Return the L{_DispatchTable} for my class, creating it if necessary.
+        Each class has its own, so changing an instance's class changes the
+        table it uses.
+        """
+        cls = type(self)
+        table = cls.__dict__.get('_dispatchTableCache')
+        if table is None:
+            table = _DispatchTable(cls)
+            cls._dispatchTableCache = table
+        return table
+
+    def invalidateDispatchTable(cls):
+        """
+        Forget the handlers looked up for this class and all of its
+        subclasses.  This must be called after adding, removing or replacing
+        a handler on the class once it, or any subclass, has dispatched any
+        commands.
+        """
+        classes = [cls]
+        while classes:
+            klass = classes.pop()
+            if '_dispatchTableCache' in klass.__dict__:
+                del klass._dispatchTableCache
+            classes.extend(klass.__subclasses__())
+    invalidateDispatchTable = classmethod(invalidateDispatchTable)
+
+    def _handler(self, name):
+        """
+        Return the L{_Handler} my class has for the normalized command
+        C{name}, or C{None} if it has none.
+        """
+        handlers = self._dispatchTable().handlers
+        try:
+            return handlers[name]
+        except KeyError:
+            # Try to find a method to be invoked in a transaction first
+            # Otherwise fallback to a "regular" method
+            cls = type(self)
+            handler = None
+            for prefix, auto in [(self.autoDispatchPrefix, True),
+                                 (self.baseDispatchPrefix, False)]:
+                if getattr(cls, prefix + name, None) is not None:
+                    handler = _Handler(name, cls, prefix + name, auto)
+                    break
+            if len(handlers) >= _DispatchTable.maxSize:
+                handlers.clear()
+            handlers[name] = handler
+            return handler
+
+    def _resolve(self, cmd):
+        """
+        Return the L{_Handler} my class has for the command C{cmd}, as
+        received, or C{None} if it has none.
+        """
+        commands = self._dispatchTable().commands
+        handler = commands.get(cmd)
+        if handler is None:
+            handler = self._handler(self.normalizeCommand(cmd))
+            if handler is not None:
+                if len(commands) >= _DispatchTable.maxSize:
+                    commands.clear()
+                commands[cmd] = handler
+        return handler
+
+    def _commandFor(self, cmd):
+        """
+        Return the L{Command} subclass of the responder which would be called
+        for the command C{cmd}, as received, or C{None} if there is none.
+        """
+        handler = self._resolve(cmd)
+        if handler is None:
+            responder = getattr(
+                self, self.autoDispatchPrefix + self.normalizeCommand(cmd), None)
+        elif handler.auto:
+            responder = handler.bind(self)
+        else:
+            return None
+        return getattr(responder, 'command', None)
+
     def lookupFunction(self, proto, name, namespace):
         """Return a callable to invoke when executing the named command.
         """
-        # Try to find a method to be invoked in a transaction first
-        # Otherwise fallback to a "regular" method
-        fName = self.autoDispatchPrefix + name
-        fObj = getattr(self, fName, None)
-        if fObj is not None:
+        handler = self._handler(name)
+        if handler is None:
+            # Nothing on the class; look for handlers set on this instance.
+            fObj = getattr(self, self.autoDispatchPrefix + name, None)
+            if fObj is not None:
+                return self._auto(fObj, proto, namespace)
+            assert namespace is None, 'Old-style parsing'
+            return getattr(self, self.baseDispatchPrefix + name, None)
+        if handler.auto:
             # pass the namespace along
-            return self._auto(fObj, proto, namespace)
-
+            return self._auto(handler.bind(self), proto, namespace)
         assert namespace is None, 'Old-style parsing'
         # Fall back to simplistic command dispatching - we probably want to get
         # rid of this eventually, there's no reason to do extra work and write
         # fewer docs all the time.
-        fName = self.baseDispatchPrefix + name
-        return getattr(self, fName, None)
+        return handler.bind(self)
 
     def dispatchCommand(self, proto, cmd, box, namespace=None):
-        fObj = self.lookupFunction(proto, self.normalizeCommand(cmd), namespace)
+        handler = self._resolve(cmd)
+        if (handler is not None and handler.auto and self.wrapper is None
+            and namespace in handler.command.namespaces
+            and self._dispatchTable().direct
+            and handler.attributeName not in self.__dict__
+            and 'lookupFunction' not in self.__dict__
+            and '_auto' not in self.__dict__):
+            # The common case: call the responder found on the class without
+            # building a callable for this box.
+            return maybeDeferred(self._respond, handler.command,
+                                 handler.bind(self), proto, box)
+        if handler is None:
+            name = self.normalizeCommand(cmd)
+        else:
+            name = handler.name
+        fObj = self.lookupFunction(proto, name, namespace)
         if fObj is None:
             return fail(UnhandledCommand(cmd))
         return maybeDeferred(self._wrap(fObj), box)
@@ -280,13 +1069,15 @@ def normalizeKey(key):
     return lkey
 
 
-def parseJuiceHeaders(lines):
+def parseJuiceHeaders(lines, boxType=JuiceBox):
     """
     Create a JuiceBox from a list of header lines.
 
     @param lines: a list of lines.
+
+    @param boxType: the type of box to create.
     """
-    b = JuiceBox()
+    b = boxType()
     bodylen = 0
     key = None
     for L in lines:
@@ -303,10 +1094,859 @@ def parseJuiceHeaders(lines):
         b[key] = value
     return int(b.pop(LENGTH, 0)), b
 
+class JuiceFrameParser:
+    """
+    I split a stream of bytes into L{JuiceBox}es.
+
+    Received bytes are appended to a single C{bytearray} and consumed by
+    advancing a cursor, so a header block which arrives in many small
+    segments is neither re-concatenated nor re-scanned from its start; the
+    consumed prefix is discarded once per call to L{dataReceived}.
+
+    A body which is not completely received along with its headers is
+    written into a C{bytearray} preallocated from the box's C{_length}, so
+    each of its bytes is copied only once on the way in.
+
+    @ivar boxReceived: a one-argument callable invoked with each complete
+        L{JuiceBox}.
+
+    @ivar memoryviewBodies: if C{True}, the bodies of delivered boxes are
+        C{memoryview}s over a private buffer, instead of C{str}s.
+
+    @ivar boxType: the type of the boxes delivered, L{JuiceBox} or another
+        mapping type with the same constructor, such as L{CompactJuiceBox}.
+
+    @ivar streamFor: C{None}, or a two-argument callable invoked with each
+        box which has a body, and the length of that body, before the body
+        is received.  If it returns an object other than C{None}, that object
+        becomes the box's body, the box is delivered immediately, and the
+        body is passed to the object's C{dataReceived} method piece by piece
+        as it arrives, followed by a call to its C{finish} method.
+
+    @ivar maxBodyLength: C{None}, or the length of the longest body which
+        will be accepted, other than by C{streamFor}.  A box which declares a
+        longer body raises L{MalformedJuiceBox} before any of the body is
+        received or allocated.
+
+    @ivar _buffer: a C{bytearray} of bytes received but not yet consumed.
+
+    @ivar _scanned: the offset into C{_buffer} at which the search for the
+        next header terminator resumes.
+
+    @ivar _pendingBox: C{None}, or a box whose headers have been parsed but
+        whose body has not yet been completely received.
+
+    @ivar _sink: C{None}, or a C{bytearray} as long as the body of
+        C{_pendingBox}.
+
+    @ivar _sinkFilled: the number of bytes of C{_sink} received so far.
+
+    @ivar _stream: C{None}, or the object returned by C{streamFor} for the
+        body currently being received.
+
+    @ivar _streamRemaining: the number of bytes of body still to be passed to
+        C{_stream}.
+
+    @ivar _stopped: C{True} once L{stop} has been called.
+    """
+
+    _pendingBox = None
+    _sink = None
+    _sinkFilled = 0
+    _stream = None
+    _streamRemaining = 0
+    _stopped = False
+
+    def __init__(self, boxReceived, memoryviewBodies=False, streamFor=None,
+                 boxType=JuiceBox, maxBodyLength=None):
+        self.boxReceived = boxReceived
+        self.memoryviewBodies = memoryviewBodies
+        self.streamFor = streamFor
+        self.boxType = boxType
+        self.maxBodyLength = maxBodyLength
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def connectionLost(self, reason):
+        """
+        Tell the stream receiving the current body, if any, that the rest of
+        it will never arrive.
+        """
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.finish(reason)
+
+    def stop(self):
+        """
+        Stop parsing.  No further boxes will be delivered, and bytes which
+        have not been consumed will be returned from L{dataReceived}.
+        """
+        self._stopped = True
+
+    def _bodyReceived(self, data):
+        """
+        Copy bytes into the body of the pending box, delivering it if it is
+        complete.
+
+        @return: C{None} if the body is still incomplete, otherwise the part
+            of C{data} which follows it.
+        """
+        sink = self._sink
+        filled = self._sinkFilled
+        needed = len(sink) - filled
+        if len(data) < needed:
+            sink[filled:filled + len(data)] = data
+            self._sinkFilled = filled + len(data)
+            return None
+        sink[filled:] = memoryview(data)[:needed]
+        box, self._pendingBox, self._sink = self._pendingBox, None, None
+        if self.memoryviewBodies:
+            box[BODY] = memoryview(sink)
+        else:
+            box[BODY] = bytes(sink)
+        self.boxReceived(box)
+        return data[needed:]
+
+    def _streamReceived(self, data):
+        """
+        Pass bytes to the object receiving the current body, finishing it if
+        it is complete.
+
+        @return: C{None} if the body is still incomplete, otherwise the part
+            of C{data} which follows it.
+        """
+        remaining = self._streamRemaining
+        if len(data) < remaining:
+            self._streamRemaining = remaining - len(data)
+            self._stream.dataReceived(data)
+            return None
+        stream, self._stream = self._stream, None
+        if remaining:
+            stream.dataReceived(data[:remaining])
+        stream.finish()
+        return data[remaining:]
+
+    def _parseHeaders(self, buf, offset):
+        """
+        Parse the header block which starts at C{offset} in C{buf}.
+
+        @return: C{None} if the header block is not complete, otherwise a
+            tuple of the offset which follows it, the length of the body
+            which follows that, and a L{JuiceBox} of the headers.
+        """
+        scanned = self._scanned
+        if scanned <= offset:
+            if buf.startswith('\r\n', offset):
+                self._scanned = offset + 2
+                return offset + 2, 0, self.boxType()
+            scanned = offset
+        end = buf.find('\r\n\r\n', scanned)
+        if end == -1:
+            scanned = len(buf) - 3
+            if scanned < offset:
+                scanned = offset
+            self._scanned = scanned
+            return None
+        lines = bytes(buf[offset:end]).split('\r\n')
+        self._scanned = end + 4
+        bodylen, box = parseJuiceHeaders(lines, self.boxType)
+        return end + 4, bodylen, box
+
+    def dataReceived(self, data):
+        """
+        Add some bytes to the stream, delivering every box they complete.
+
+        @return: the bytes which follow the last box consumed if L{stop} has
+            been called, otherwise C{''}.
+        """
+        buf = self._buffer
+        if self._stopped:
+            if buf:
+                data = bytes(buf) + data
+                del buf[:]
+            return data
+        if self._stream is not None:
+            data = self._streamReceived(data)
+            if data is None:
+                return ''
+            if self._stopped:
+                return data
+        elif self._sink is not None:
+            data = self._bodyReceived(data)
+            if data is None:
+                return ''
+            if self._stopped:
+                return data
+        buf += data
+        offset = 0
+        parseHeaders = self._parseHeaders
+        while not self._stopped:
+            parsed = parseHeaders(buf, offset)
+            if parsed is None:
+                break
+            offset, bodylen, box = parsed
+            if bodylen > 0 and self.streamFor is not None:
+                stream = self.streamFor(box, bodylen)
+                if stream is not None:
+                    box[BODY] = stream
+                    self._stream = stream
+                    self._streamRemaining = bodylen
+                    self.boxReceived(box)
+                    if self._stopped:
+                        break
+                    end = min(len(buf), offset + bodylen)
+                    body = memoryview(buf)[offset:end].tobytes()
+                    offset = self._scanned = end
+                    if self._streamReceived(body) is None:
+                        break
+                    continue
+            if bodylen > 0:
+                if (self.maxBodyLength is not None
+                    and bodylen > self.maxBodyLength):
+                    raise MalformedJuiceBox(
+                        "Body of %d bytes is longer than %d" % (
+                            bodylen, self.maxBodyLength))
+                end = offset + bodylen
+                if len(buf) < end:
+                    available = len(buf) - offset
+                    sink = self._sink = bytearray(bodylen)
+                    sink[:available] = memoryview(buf)[offset:]
+                    self._sinkFilled = available
+                    self._pendingBox = box
+                    offset = self._scanned = len(buf)
+                    break
+                if self.memoryviewBodies:
+                    box[BODY] = memoryview(bytearray(memoryview(buf)[offset:end]))
+                else:
+                    box[BODY] = memoryview(buf)[offset:end].tobytes()
+                offset = self._scanned = end
+            self.boxReceived(box)
+        if self._stopped:
+            data = bytes(buf[offset:])
+            del buf[:]
+            return data
+        if offset:
+            del buf[:offset]
+            self._scanned -= offset
+        return ''
+
+class BinaryJuiceFrameParser(JuiceFrameParser):
+    """
+    I split a stream of bytes in the binary framing of protocol version 2,
+    as written by L{BinaryJuiceBoxSerializer}, into L{JuiceBox}es.
+
+    @ivar _partialBox: C{None}, or a box holding the headers parsed so far
+        from a header block which has not been completely received.  Parsing
+        resumes at C{_scanned}.
+    """
+
+    _partialBox = None
+
+    def _parseHeaders(self, buf, offset):
+        box = self._partialBox
+        if box is None:
+            box = self.boxType()
+            position = offset
+        else:
+            position = self._scanned
+        unpack = _binaryPair.unpack_from
+        size = len(buf)
+        while position + 6 <= size:
+            keyLength, valueLength = unpack(buf, position)
+            if not keyLength:
+                position += 6
+                self._partialBox = None
+                self._scanned = position
+                return position, valueLength, box
+            key = position + 6
+            value = key + keyLength
+            end = value + valueLength
+            if end > size:
+                break
+            box[bytes(buf[key:value])] = bytes(buf[value:end])
+            position = end
+        self._partialBox = box
+        self._scanned = position
+        return None
+
+class HeaderTableJuiceFrameParser(BinaryJuiceFrameParser):
+    """
+    I split a stream of bytes in the framing of protocol version 3, as
+    written by L{HeaderTableJuiceBoxSerializer}, into L{JuiceBox}es, keeping
+    the same tables as the serializer which wrote them.
+    """
+
+    def __init__(self, *a, **kw):
+        BinaryJuiceFrameParser.__init__(self, *a, **kw)
+        self._names = _HeaderTable(_NAME_TABLE_SIZE)
+        self._headers = _HeaderTable(_HEADER_TABLE_SIZE)
+
+    def _parseHeaders(self, buf, offset):
+        box = self._partialBox
+        if box is None:
+            box = self.boxType()
+            position = offset
+        else:
+            position = self._scanned
+        unpackOp = _headerOp.unpack_from
+        unpackIndex = _headerIndex.unpack_from
+        names = self._names
+        headers = self._headers
+        size = len(buf)
+        while position + 3 <= size:
+            op = buf[position]
+            if op == _HEADER_INDEXED:
+                index = unpackIndex(buf, position)[1]
+                try:
+                    k, v = headers.entries[index]
+                except IndexError:
+                    raise MalformedJuiceBox(
+                        "Unknown header index: %d" % (index,))
+                box[k] = v
+                position += 3
+                continue
+            if position + 7 > size:
+                break
+            op, key, valueLength = unpackOp(buf, position)
+            if op == _HEADER_END:
+                position += 7
+                self._partialBox = None
+                self._scanned = position
+                return position, valueLength, box
+            if op == _HEADER_LITERAL or op == _HEADER_LITERAL_INDEXED:
+                value = position + 7 + key
+                end = value + valueLength
+                if end > size:
+                    break
+                k = bytes(buf[position + 7:value])
+                names.add(k)
+            elif op == _HEADER_NAMED or op == _HEADER_NAMED_INDEXED:
+                value = position + 7
+                end = value + valueLength
+                if end > size:
+                    break
+                try:
+                    k = names.entries[key]
+                except IndexError:
+                    raise MalformedJuiceBox(
+                        "Unknown header name index: %d" % (key,))
+            else:
+                raise MalformedJuiceBox("Unknown header opcode: %r" % (op,))
+            v = box[k] = bytes(buf[value:end])
+            if op == _HEADER_LITERAL_INDEXED or op == _HEADER_NAMED_INDEXED:
+                headers.add((k, v))
+            position = end
+        self._partialBox = box
+        self._scanned = position
+        return None
+
+class BodyStream:
+    """
+    I am the body of a received box whose command has C{streamBody} set.  I
+    pass the body on to a consumer as it arrives instead of accumulating it,
+    pausing the transport while the consumer cannot keep up.
+
+    @ivar transport: the transport the body is arriving over.
+
+    @ivar length: the length of the body, in bytes.
+
+    @ivar _consumer: C{None}, or the consumer given to L{beginWriting}.
+
+    @ivar _buffered: a C{list} of the parts of the body which arrived before
+        L{beginWriting} was called.
+
+    @ivar _pausedForConsumer: C{True} if the transport has been paused
+        because there was no consumer for the body.
+
+    @ivar _pausedByConsumer: C{True} if the consumer has paused me, and so
+        the transport, and not yet resumed me.
+
+    @ivar _received: the number of bytes of the body which have arrived.
+
+    @ivar _abandoned: C{True} if the responder finished without calling
+        L{beginWriting}, so that the rest of the body is discarded.
+
+    @ivar _finished: C{True} once all of the body has arrived or the
+        connection has been lost.
+
+    @ivar _reason: C{None}, or a L{Failure} if the connection was lost
+        before all of the body arrived.
+    """
+    implements(IPushProducer)
+
+    _consumer = None
+    _pausedForConsumer = False
+    _pausedByConsumer = False
+    _received = 0
+    _abandoned = False
+    _finished = False
+    _reason = None
+
+    def __init__(self, transport, length):
+        self.transport = transport
+        self.length = length
+        self._buffered = []
+        self._done = Deferred()
+
+    def beginWriting(self, consumer):
+        """
+        Write the body to C{consumer}, registering myself as its streaming
+        producer until the whole body has been written.
+
+        @return: a L{Deferred} which fires with C{consumer} once the whole
+            body has been written to it, or fails if the connection is lost
+            first.
+        """
+        assert self._consumer is None, "Body is already being written."
+        assert not self._abandoned, "Body was discarded by its responder."
+        self._consumer = consumer
+        consumer.registerProducer(self, True)
+        buffered, self._buffered = self._buffered, None
+        for data in buffered:
+            consumer.write(data)
+        if self._finished:
+            self._end()
+        elif self._pausedForConsumer:
+            self._pausedForConsumer = False
+            self.transport.resumeProducing()
+        return self._done
+
+    def dataReceived(self, data):
+        self._received += len(data)
+        if self._consumer is not None:
+            self._consumer.write(data)
+        elif not self._abandoned:
+            self._buffered.append(data)
+            if not self._pausedForConsumer and self._received < self.length:
+                self._pausedForConsumer = True
+                self.transport.pauseProducing()
+
+    def finish(self, reason=None):
+        self._finished = True
+        self._reason = reason
+        if self._consumer is not None:
+            self._end()
+        else:
+            self._resume()
+
+    def _responderFinished(self, result):
+        """
+        Discard the body if the responder's result is ready and it has not
+        called L{beginWriting}, since nothing ever will.
+
+        @return: C{result}
+        """
+        if self._consumer is None and not self._abandoned:
+            self._abandoned = True
+            self._buffered = None
+            self._resume()
+        return result
+
+    def _resume(self):
+        """
+        Resume the transport if it was paused for want of a consumer.
+        """
+        if self._pausedForConsumer:
+            self._pausedForConsumer = False
+            self.transport.resumeProducing()
+
+    def _end(self):
+        if self._pausedByConsumer:
+            # Once I am unregistered the consumer will never resume me, and
+            # the rest of the connection must not wait for it.
+            self._pausedByConsumer = False
+            self.transport.resumeProducing()
+        self._consumer.unregisterProducer()
+        if self._reason is not None:
+            self._done.errback(self._reason)
+        else:
+            self._done.callback(self._consumer)
+
+    def pauseProducing(self):
+        self._pausedByConsumer = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._pausedByConsumer = False
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.transport.loseConnection()
+
+class _TimeoutWheel:
+    """
+    I expire any number of timeouts using a single delayed call.
+
+    Deadlines are rounded up to a multiple of C{granularity} seconds, and the
+    keys which expire at each such tick are kept together in a bucket; the
+    one delayed call is always scheduled for the earliest tick with a bucket.
+
+    @ivar clock: the L{IReactorTime} provider used to schedule expiry.
+
+    @ivar granularity: the resolution of the deadlines, in seconds.
+
+    @ivar expired: a one-argument callable invoked with each key which
+        expires.
+
+    @ivar _buckets: a C{dict} mapping ticks to C{set}s of keys.
+
+    @ivar _call: C{None}, or the delayed call which will expire the bucket
+        for C{_callTick}.
+    """
+
+    _call = None
+    _callTick = None
+
+    def __init__(self, clock, granularity, expired):
+        self.clock = clock
+        self.granularity = granularity
+        self.expired = expired
+        self._buckets = {}
+
+    def add(self, key, timeout):
+        """
+        Arrange for C{key} to expire after C{timeout} seconds.
+
+        @return: a token to pass to L{remove} to cancel the expiry.
+        """
+        tick = int(math.ceil(
+            (self.clock.seconds() + timeout) / self.granularity))
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = set()
+            if self._callTick is None or tick < self._callTick:
+                self._schedule(tick)
+        bucket.add(key)
+        return tick
+
+    def remove(self, key, tick):
+        """
+        Cancel the expiry of C{key}, which L{add} returned C{tick} for.
+        """
+        bucket = self._buckets.get(tick)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[tick]
+
+    def stop(self):
+        """
+        Cancel every pending expiry.
+        """
+        self._buckets.clear()
+        if self._call is not None:
+            self._call.cancel()
+            self._call = self._callTick = None
+
+    def _schedule(self, tick):
+        if self._call is not None:
+            self._call.cancel()
+        self._callTick = tick
+        self._call = self.clock.callLater(
+            max(0, tick * self.granularity - self.clock.seconds()),
+            self._expire)
+
+    def _expire(self):
+        self._call = self._callTick = None
+        now = self.clock.seconds() / self.granularity
+        for tick in sorted(self._buckets):
+            if tick > now:
+                break
+            for key in self._buckets.pop(tick):
+                self.expired(key)
+        if self._buckets and self._call is None:
+            self._schedule(min(self._buckets))
+
+class LatencyHistogram:
+    """
+    I count latencies in logarithmically sized buckets: each doubling of
+    latency above C{minimum} is split into C{subBuckets} equal parts, so
+    recording is a constant amount of arithmetic and percentiles are
+    accurate to within a factor of 1 + 1 / C{subBuckets}.
+
+    @ivar counts: a C{list} of the number of latencies in each bucket.
+
+    @ivar count: the number of latencies recorded.
+
+    @ivar total: the sum of the latencies recorded, in seconds.
+
+    @ivar maximum: the greatest latency recorded, in seconds.
+    """
+
+    minimum = 1e-6
+    subBuckets = 4
+    octaves = 32
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every latency recorded.
+        """
+        self.counts = [0] * (self.octaves * self.subBuckets)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, latency):
+        """
+        Count one latency, in seconds.
+        """
+        self.count += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+        mantissa, exponent = math.frexp(latency / self.minimum)
+        if exponent < 1:
+            index = 0
+        else:
+            index = ((exponent - 1) * self.subBuckets +
+                     int((mantissa * 2 - 1) * self.subBuckets))
+            if index >= len(self.counts):
+                index = len(self.counts) - 1
+        self.counts[index] += 1
+
+    def merge(self, other):
+        """
+        Add the latencies counted by another L{LatencyHistogram} to mine.
+        """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def bucketLimit(self, index):
+        """
+        Return the upper limit, in seconds, of the latencies counted in the
+        given bucket.
+        """
+        octave, part = divmod(index, self.subBuckets)
+        return (self.minimum * 2 ** octave *
+                (1 + float(part + 1) / self.subBuckets))
+
+    def percentile(self, fraction):
+        """
+        Return the upper limit of the bucket containing the given fraction of
+        the latencies recorded, or C{0.0} if none have been.
+        """
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(self.bucketLimit(i), self.maximum)
+        return self.maximum
+
+    def snapshot(self):
+        """
+        Return a C{dict} summarizing the latencies recorded.
+        """
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.maximum,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': [(self.bucketLimit(i), count)
+                            for (i, count) in enumerate(self.counts)
+                            if count]}
+
+class JuiceLatencies:
+    """
+    I keep a L{LatencyHistogram} for each command sent or answered over one
+    Juice connection.
+
+    @ivar sent: a C{dict} mapping command names to histograms of the time
+        between this side sending that command and receiving its answer.
+
+    @ivar answered: a C{dict} mapping normalized command names to
+        histograms of the time between this side receiving that command and
+        sending its answer.  Only commands with a handler on the class of
+        the connection are included, so that the peer cannot add entries.
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.answered = {}
+        _allLatencies.add(self)
+
+    def recordSent(self, command, latency):
+        histogram = self.sent.get(command)
+        if histogram is None:
+            histogram = self.sent[command] = LatencyHistogram()
+        histogram.record(latency)
+
+    def recordAnswered(self, command, latency):
+        histogram = self.answered.get(command)
+        if histogram is None:
+            histogram = self.answered[command] = LatencyHistogram()
+        histogram.record(latency)
+
+    def snapshot(self):
+        """
+        Return a C{dict} with C{'sent'} and C{'answered'} keys, each mapping
+        command names to the snapshots of their histograms.
+        """
+        return {'sent': dict([(command, histogram.snapshot())
+                              for (command, histogram) in self.sent.items()]),
+                'answered': dict([(command, histogram.snapshot())
+                                  for (command, histogram)
+                                  in self.answered.items()])}
+
+    def reset(self):
+        self.sent.clear()
+        self.answered.clear()
+
+_allLatencies = weakref.WeakSet()
+
+def latencySnapshot(reset=False):
+    """
+    Combine the latencies recorded by every Juice connection in this process
+    which records them.
+
+    @param reset: if C{True}, forget the latencies recorded so far.
+
+    @return: a C{dict} like the one returned by L{JuiceLatencies.snapshot}.
+    """
+    combined = {'sent': {}, 'answered': {}}
+    for latencies in list(_allLatencies):
+        for direction, histograms in [('sent', latencies.sent),
+                                      ('answered', latencies.answered)]:
+            for command, histogram in histograms.items():
+                total = combined[direction].get(command)
+                if total is None:
+                    total = combined[direction][command] = LatencyHistogram()
+                total.merge(histogram)
+        if reset:
+            latencies.reset()
+    for direction in combined:
+        for command, histogram in combined[direction].items():
+            combined[direction][command] = histogram.snapshot()
+    return combined
+
+class _ReorderingBuffer:
+    """
+    Deliver the results of some L{Deferred}s in order, whatever order they
+    arrive in.
+
+    @ivar results: a C{list} of L{Deferred}s which fire with the results of
+        those given, each after those before it.
+
+    @ivar _arrived: a C{dict} mapping the positions of results which have
+        arrived, but not yet been delivered, to those results.
+
+    @ivar _next: the position of the next result to be delivered.
+    """
+    def __init__(self, deferreds, onUnhandledError):
+        self._onUnhandledError = onUnhandledError
+        self._arrived = {}
+        self._next = 0
+        self.results = [Deferred() for d in deferreds]
+        for position, d in enumerate(deferreds):
+            d.addBoth(self._resultArrived, position)
+
+    def _resultArrived(self, result, position):
+        arrived = self._arrived
+        arrived[position] = result
+        while self._next in arrived:
+            result = arrived.pop(self._next)
+            d = self.results[self._next]
+            self._next += 1
+            if isinstance(result, Failure):
+                d.addErrback(self._onUnhandledError)
+                d.errback(result)
+            else:
+                d.callback(result)
+
 class JuiceParserBase(DispatchMixin):
+    """
+    @ivar maxOutstandingRequests: C{None}, or the greatest number of commands
+        which may be awaiting answers at once.  Commands sent while that many
+        are outstanding wait, in order, until an answer arrives.
+
+    @ivar requestTimeout: C{None}, or the default number of seconds after
+        which a command which has not been answered fails with
+        L{RequestTimedOut}.  The time is measured from when the command is
+        sent, so it does not include any time spent waiting for one of the
+        C{maxOutstandingRequests}.
+
+    @ivar timeoutGranularity: the resolution, in seconds, with which
+        C{requestTimeout} is enforced.
+
+    @ivar clock: C{None}, or the L{IReactorTime} provider used to measure and
+        schedule things; C{None} means the global reactor.
+
+    @ivar requestsCompleted: the number of commands which have been answered,
+        successfully or with an error.
+
+    @ivar requestsTimedOut: the number of commands which have timed out.
+
+    @ivar maxRequestLatency: the longest time, in seconds, that an answered
+        command has waited for its answer.
+
+    @ivar recordLatencies: if C{True} when I am created, C{latencies} is set
+        to a L{JuiceLatencies} which records how long each command takes.
+
+    @ivar latencies: C{None}, or a L{JuiceLatencies}.
+    """
+
+    maxOutstandingRequests = None
+    requestTimeout = None
+    timeoutGranularity = 1.0
+    clock = None
+
+    requestsCompleted = 0
+    requestsTimedOut = 0
+    maxRequestLatency = 0.0
+
+    recordLatencies = False
+    latencies = None
+
+    # Remember this many of the tags of commands which timed out, so that
+    # their late answers can be ignored without being logged.  Answers with
+    # any other tag which is not outstanding are logged, then ignored.
+    _maxTimedOutTags = 1024
+
+    # The number of calls to sendBoxCommands in progress; while it is not
+    # zero, the boxes sent are held back to be written together.
+    _batching = 0
 
     def __init__(self):
         self._outstandingRequests = {}
+        self._requestStarts = {}
+        self._waitingRequests = deque()
+        self._timedOutTags = set()
+        if self.recordLatencies:
+            self.latencies = JuiceLatencies()
+
+    def _getClock(self):
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock
+
+    _timeouts = None
+
+    def _getTimeouts(self):
+        if self._timeouts is None:
+            self._timeouts = _TimeoutWheel(
+                self._getClock(), self.timeoutGranularity, self._timedOut)
+        return self._timeouts
+
+    def requestMetrics(self):
+        """
+        Return a C{dict} describing the commands sent over this connection.
+        """
+        outstanding = self._outstandingRequests
+        return {'inFlight': outstanding and len(outstanding) or 0,
+                'waiting': len(self._waitingRequests),
+                'completed': self.requestsCompleted,
+                'timedOut': self.requestsTimedOut,
+                'maxLatency': self.maxRequestLatency}
 
     def _puke(self, failure):
         log.msg("Juice server or network failure "
@@ -316,8 +1956,23 @@ class JuiceParserBase(DispatchMixin):
             "Dropping connection!  "
             "To avoid, add errbacks to ALL remote commands!")
         if self.transport is not None:
+            self.flushWrites()
             self.transport.loseConnection()
 
+    def flushWrites(self):
+        """
+        Write any boxes which have been sent but are being held back so they
+        can be written along with others.  Call this before using the
+        transport directly.
+        """
+
+    def _commandResult(self, result):
+        """
+        Return what L{Command.do} returns for a command sent over this
+        connection, given the L{Deferred} which fires with its response.
+        """
+        return result
+
     _counter = 0
 
     def _nextTag(self):
@@ -327,28 +1982,106 @@ class JuiceParserBase(DispatchMixin):
     def failAllOutgoing(self, reason):
         OR = list(self._outstandingRequests.items())
         self._outstandingRequests = None # we can never send another request
+        if self._timeouts is not None:
+            self._timeouts.stop()
+        waiting = self._waitingRequests
+        self._waitingRequests = deque()
         for key, value in OR:
             value.errback(reason)
+        for box, result, timeout in waiting:
+            if result is not None:
+                result.errback(reason)
+
+    def _timedOut(self, tag):
+        question = self._outstandingRequests.pop(tag)
+        del self._requestStarts[tag]
+        self.requestsTimedOut += 1
+        if len(self._timedOutTags) >= self._maxTimedOutTags:
+            self._timedOutTags.clear()
+        self._timedOutTags.add(tag)
+        self._sendWaitingRequests()
+        question.addErrback(self._puke)
+        question.errback(RequestTimedOut(tag))
+
+    def _answerReceived(self, tag):
+        """
+        Stop waiting for the answer to the command with the given tag.
+
+        @return: the L{Deferred} for that command, or C{None} if it has
+            already timed out or was never sent.
+        """
+        try:
+            question = self._outstandingRequests.pop(tag)
+        except KeyError:
+            if tag in self._timedOutTags:
+                self._timedOutTags.remove(tag)
+            else:
+                log.msg("Ignoring answer to unknown command %r" % (tag,))
+            return None
+        started, tick, command = self._requestStarts.pop(tag)
+        if tick is not None:
+            self._timeouts.remove(tag, tick)
+        latency = self._getClock().seconds() - started
+        if latency > self.maxRequestLatency:
+            self.maxRequestLatency = latency
+        if self.latencies is not None:
+            self.latencies.recordSent(command, latency)
+        self.requestsCompleted += 1
+        if self._waitingRequests:
+            self._sendWaitingRequests()
+        return question
+
+    def _sendWaitingRequests(self):
+        """
+        Send the commands waiting for a free slot, in order, until one needs
+        a slot and there is none.
+        """
+        waiting = self._waitingRequests
+        limit = self.maxOutstandingRequests
+        while waiting:
+            box, result, timeout = waiting[0]
+            if (result is not None and limit is not None and
+                len(self._outstandingRequests) >= limit):
+                break
+            waiting.popleft()
+            self._sendRequest(box, result, timeout)
 
     def juiceBoxReceived(self, box):
         if debug:
             log.msg("Juice receive: %s" % pprint.pformat(dict(iter(box.items()))))
 
         if ANSWER in box:
-            question = self._outstandingRequests.pop(box[ANSWER])
+            question = self._answerReceived(box[ANSWER])
+            if question is None:
+                return
             question.addErrback(self._puke)
             self._wrap(question.callback)(box)
         elif ERROR in box:
-            question = self._outstandingRequests.pop(box[ERROR])
+            question = self._answerReceived(box[ERROR])
+            if question is None:
+                return
             question.addErrback(self._puke)
             self._wrap(question.errback)(
                 Failure(RemoteJuiceError(box[ERROR_CODE],
                                          box[ERROR_DESCRIPTION])))
         elif COMMAND in box:
             cmd = box[COMMAND]
+            latencies = self.latencies
+            handler = None
+            if latencies is not None and ASK in box:
+                handler = self._resolve(cmd)
+            if handler is not None:
+                clock = self._getClock()
+                started = clock.seconds()
+                def recordLatency():
+                    latencies.recordAnswered(
+                        handler.name, clock.seconds() - started)
+            else:
+                recordLatency = lambda: None
             def sendAnswer(answerBox):
                 if ASK not in box:
                     return
+                recordLatency()
                 if self.transport is None:
                     return
                 answerBox[ANSWER] = box[ASK]
@@ -356,6 +2089,7 @@ class JuiceParserBase(DispatchMixin):
             def sendError(error):
                 if ASK not in box:
                     return error
+                recordLatency()
                 if error.check(RemoteJuiceError):
                     code = error.value.errorCode
                     desc = error.value.description
@@ -377,19 +2111,28 @@ class JuiceParserBase(DispatchMixin):
                 return None # intentionally stop the error here: don't log the
                             # traceback if it's handled, do log it (earlier) if
                             # it isn't
-            self.dispatchCommand(self, cmd, box).addCallbacks(sendAnswer, sendError
-                                                              ).addErrback(self._puke)
+            d = self.dispatchCommand(self, cmd, box)
+            body = box.get(BODY)
+            if isinstance(body, BodyStream):
+                d.addBoth(body._responderFinished)
+            d.addCallbacks(sendAnswer, sendError).addErrback(self._puke)
         else:
             raise RuntimeError(
                 "Empty packet received over connection-oriented juice: %r" % (box,))
 
-    def sendBoxCommand(self, command, box, requiresAnswer=True):
+    def sendBoxCommand(self, command, box, requiresAnswer=True, timeout=None):
         """
         Send a command across the wire with the given C{juice.Box}.
 
         Returns a Deferred which fires with the response C{juice.Box} when it
         is received, or fails with a C{juice.RemoteJuiceError} if an error is
-        received.
+        received, or with L{RequestTimedOut} if no answer is received within
+        C{timeout} seconds of the command being sent (C{requestTimeout}, if
+        C{timeout} is C{None}).
+
+        If C{maxOutstandingRequests} commands are already awaiting answers,
+        the command is not sent until one of them is answered, and its
+        timeout only starts once it is sent.
 
         If the Deferred fails and the error is not handled by the caller of
         this method, the failure will be logged and the connection dropped.
@@ -397,15 +2140,64 @@ class JuiceParserBase(DispatchMixin):
         if self._outstandingRequests is None:
             return fail(CONNECTION_LOST)
         box[COMMAND] = command
-        tag = self._nextTag()
         if requiresAnswer:
-            box[ASK] = tag
-            result = self._outstandingRequests[tag] = Deferred()
+            result = Deferred()
         else:
             result = None
-        box.sendTo(self)
+        limit = self.maxOutstandingRequests
+        if self._waitingRequests or (
+            requiresAnswer and limit is not None and
+            len(self._outstandingRequests) >= limit):
+            # Commands which need no answer wait too, to stay in order.
+            self._waitingRequests.append((box, result, timeout))
+        else:
+            self._sendRequest(box, result, timeout)
         return result
 
+    def sendBoxCommands(self, commands, ordered=False, timeout=None):
+        """
+        Send many commands at once, as L{sendBoxCommand} would, but written
+        to the transport together, so that they take one round trip rather
+        than one each.
+
+        @param commands: an iterable of (command name, C{juice.Box}) pairs.
+
+        @param ordered: if C{True}, the answer to each command is delivered
+            only after the answers to those before it, so the L{Deferred}s
+            fire in the order the commands were given, whatever order the
+            answers arrive in.
+
+        @return: a C{list} of L{Deferred}s, one for each command, in order.
+            Pass it to L{twisted.internet.defer.gatherResults} for one which
+            fires with every response.
+        """
+        self._batching += 1
+        try:
+            results = [self.sendBoxCommand(command, box, timeout=timeout)
+                       for (command, box) in commands]
+        finally:
+            self._batching -= 1
+        if not self._batching:
+            self.flushWrites()
+        if ordered:
+            results = _ReorderingBuffer(results, self._puke).results
+        return results
+
+    def _sendRequest(self, box, result, timeout):
+        tag = self._nextTag()
+        if result is not None:
+            box[ASK] = tag
+            self._outstandingRequests[tag] = result
+            if timeout is None:
+                timeout = self.requestTimeout
+            if timeout is None:
+                tick = None
+            else:
+                tick = self._getTimeouts().add(tag, timeout)
+            self._requestStarts[tag] = (
+                self._getClock().seconds(), tick, box[COMMAND])
+        box.sendTo(self)
+
 
 
 
@@ -468,18 +2260,108 @@ class JuiceList(Argument):
                     objects, self.subargs, Box(), proto
                     ).serialize() for objects in inObject])
 
+# The characters which may appear in an Integer or Float as a string.
+_numberCharacters = frozenset('0123456789+-.eEinfaINFA')
+
+# The ListOf delimiters which also separate the items of a JSON array.
+_jsonDelimiters = (', ', ',')
+
+def _notANumber(inString):
+    raise ValueError(inString)
+
+def _decodeNumbers(inString, delimiter, bulkType):
+    """
+    Decode a list of L{Integer}s or L{Float}s joined by C{delimiter}, one of
+    C{_jsonDelimiters}, as a JSON array, which is much quicker than
+    converting each of them.
+
+    @return: the list, or C{None} if JSON decoding might not give the same
+        result as converting each number with C{bulkType.fromString}, in
+        which case that must be done instead.
+    """
+    if bulkType is Integer:
+        kw = dict(parse_float=_notANumber)
+        types = _integerTypes
+    else:
+        kw = dict(parse_int=float)
+        types = _floatTypes
+    try:
+        values = json.loads('[' + inString + ']',
+                            parse_constant=_notANumber, **kw)
+    except ValueError:
+        return None
+    # JSON separates items by commas and any whitespace, which int and float
+    # strip, so if there are as many items as delimiters allow, each is one
+    # which fromString would have been given.
+    if len(values) != inString.count(delimiter) + 1:
+        return None
+    if not set(map(type, values)) <= types:
+        return None
+    return values
+
+_integerTypes = frozenset([int, long])
+_floatTypes = frozenset([float])
+
 class ListOf(Argument):
+    """
+    A list of values of one type, joined by C{delimiter}.
+
+    Lists of L{Integer}s, L{Float}s and L{String}s, which may be very long,
+    are converted in bulk, without a call to C{subarg} for each item.  Lists
+    of other types, including subclasses of those, are converted item by
+    item.
+
+    @ivar _bulkType: L{Integer}, L{Float} or L{String}, if C{subarg} is an
+        instance of one of them which can be converted in bulk, or C{None}.
+    """
+
     def __init__(self, subarg, delimiter=', '):
         self.subarg = subarg
         self.delimiter = delimiter
+        bulkType = type(subarg)
+        if bulkType in (Integer, Float):
+            # Numbers are joined without checking for the delimiter in each,
+            # so it must be made of characters which no number contains.
+            if set(delimiter) & _numberCharacters:
+                bulkType = None
+        elif bulkType is String:
+            # Strings are checked for the delimiter by counting how often it
+            # appears once they are joined, which is only the same as
+            # checking each of them if no two appearances can overlap.
+            for i in range(1, len(delimiter)):
+                if delimiter[:i] == delimiter[-i:]:
+                    bulkType = None
+                    break
+        else:
+            bulkType = None
+        self._bulkType = bulkType
 
     def fromStringProto(self, inString, proto):
+        bulkType = self._bulkType
+        if bulkType in (Integer, Float) and self.delimiter in _jsonDelimiters:
+            values = _decodeNumbers(inString, self.delimiter, bulkType)
+            if values is not None:
+                return values
         strings = inString.split(self.delimiter)
+        if bulkType is String:
+            return strings
+        if bulkType is not None:
+            return list(map(bulkType.fromString, strings))
         L = [self.subarg.fromStringProto(string, proto)
              for string in strings]
         return L
 
     def toStringProto(self, inObject, proto):
+        bulkType = self._bulkType
+        if bulkType is Integer:
+            return self.delimiter.join(map(str, map(int, inObject)))
+        if bulkType is Float:
+            return self.delimiter.join(map(str, inObject))
+        if bulkType is String:
+            inObject = list(inObject)
+            outString = self.delimiter.join(inObject)
+            if outString.count(self.delimiter) == max(len(inObject) - 1, 0):
+                return outString
         L = []
         for inSingle in inObject:
             outString = self.subarg.toStringProto(inSingle, proto)
@@ -540,6 +2422,60 @@ class Base64Binary(Argument):
     def fromString(self, inString):
         return inString.decode('base64')
 
+class Binary(Argument):
+    """
+    Binary data, sent as it is in the body of the box rather than encoded in
+    a header.  The body holds the values of each of a command's C{Binary}
+    arguments in turn, and the C{_parts} header lists their names and
+    lengths, so a command with C{Binary} arguments may not have a C{body}
+    argument, nor set C{streamBody}.
+
+    Received values are slices of the body, so they are memoryviews, not
+    copies, if the protocol has C{memoryviewBodies} set.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        value = self.retrieve(objects, name)
+        if self.optional and value is None:
+            return
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        elif not isinstance(value, str):
+            value = bytes(value)
+        part = '%s %d' % (name, len(value))
+        parts = strings.get(PARTS)
+        if parts is None:
+            assert BODY not in strings, "Binary arguments need the body"
+            strings[PARTS] = part
+            strings[BODY] = value
+        else:
+            strings[PARTS] = parts + ', ' + part
+            strings[BODY] += value
+
+    def fromBox(self, name, strings, objects, proto):
+        parts = strings.get(PARTS)
+        offset = 0
+        if parts is not None:
+            for part in parts.split(', '):
+                try:
+                    partName, length = part.split(' ')
+                    length = int(length)
+                except ValueError:
+                    raise MalformedJuiceBox("Malformed part %r" % (part,))
+                if length < 0:
+                    raise MalformedJuiceBox("Malformed part %r" % (part,))
+                if partName == name:
+                    body = strings.get(BODY, '')
+                    if offset + length > len(body):
+                        raise MalformedJuiceBox(
+                            "Part %r extends beyond the body" % (name,))
+                    objects[name] = body[offset:offset + length]
+                    return
+                offset += length
+        if not self.optional:
+            raise KeyError(name)
+        objects[name] = None
+
 class Time(Argument):
     def toString(self, inObject):
         return inObject.asISO8601TimeAndDate()
@@ -591,6 +2527,112 @@ class Boolean(Argument):
         else:
             return 'False'
 
+def _definedBy(cls, name):
+    """
+    Return the class in the MRO of C{cls} which defines the attribute
+    C{name}.
+    """
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            return base
+
+class _CompiledArguments:
+    """
+    Conversions between a box and a dictionary of objects for one argument
+    list, with the same results as L{stringsToObjects} and
+    L{objectsToStrings} but specialized to that list, so that the list does
+    not have to be walked, nor the box copied, for each conversion.
+
+    Arguments which override C{fromBox}, C{toBox} or C{retrieve} are handled
+    by calling those methods, exactly as L{stringsToObjects} and
+    L{objectsToStrings} do.  Other arguments are converted by calling their
+    C{fromString}/C{toString} (or C{fromStringProto}/C{toStringProto}, if
+    those are overridden) directly, or not at all for L{String}.
+
+    @ivar arglist: the argument list these conversions were compiled from.
+
+    @ivar toObjects: a function taking a box and a protocol and returning a
+        C{dict} of objects, like L{stringsToObjects}.
+
+    @ivar toStrings: a function taking a C{dict} of objects, a box and a
+        protocol and filling in and returning the box, like
+        L{objectsToStrings}.
+    """
+
+    def __init__(self, arglist):
+        self.arglist = arglist
+        namespace = {'normalizeKey': normalizeKey}
+        decode = []
+        encode = []
+        names = set()
+        custom = False
+        for i, (name, arg) in enumerate(arglist):
+            argClass = type(arg)
+            if (_definedBy(argClass, 'fromBox') is not Argument or
+                _definedBy(argClass, 'toBox') is not Argument or
+                _definedBy(argClass, 'retrieve') is not Argument):
+                custom = True
+                namespace['arg%d' % (i,)] = arg
+                decode.append('    arg%d.fromBox(%r, strings, objects, proto)'
+                              % (i, name))
+                encode.append('    arg%d.toBox(%r, strings, objects, proto)'
+                              % (i, name))
+                continue
+            if normalizeKey(name) == name:
+                names.add(name)
+            if _definedBy(argClass, 'fromStringProto') is not Argument:
+                namespace['from%d' % (i,)] = arg.fromStringProto
+                fromString = 'from%d(value, proto)' % (i,)
+            elif _definedBy(argClass, 'fromString') is String:
+                fromString = 'value'
+            else:
+                namespace['from%d' % (i,)] = arg.fromString
+                fromString = 'from%d(value)' % (i,)
+            if _definedBy(argClass, 'toStringProto') is not Argument:
+                namespace['to%d' % (i,)] = arg.toStringProto
+                toString = 'to%d(value, proto)' % (i,)
+            elif _definedBy(argClass, 'toString') is String:
+                toString = 'value'
+            else:
+                namespace['to%d' % (i,)] = arg.toString
+                toString = 'to%d(value)' % (i,)
+            if arg.optional:
+                decode.append('    value = strings.get(%r)' % (name,))
+                decode.append('    if value is None:')
+                decode.append('        objects[%r] = None' % (name,))
+                decode.append('    else:')
+                decode.append('        objects[%r] = %s' % (name, fromString))
+                encode.append('    value = objects.get(%r)' % (name,))
+                encode.append('    if value is not None:')
+                encode.append('        strings[%r] = %s' % (name, toString))
+            else:
+                decode.append('    value = strings[%r]' % (name,))
+                decode.append('    objects[%r] = %s' % (name, fromString))
+                encode.append('    value = objects[%r]' % (name,))
+                encode.append('    strings[%r] = %s' % (name, toString))
+        namespace['names'] = frozenset(names)
+        source = ['def toObjects(strings, proto):',
+                  '    objects = {}']
+        if custom:
+            # Custom arguments may remove the strings they consume.
+            source.append('    strings = strings.copy()')
+        source.extend(decode)
+        source.append('    return objects')
+        source.extend(['def toStrings(objects, strings, proto):',
+                       '    for key in objects:',
+                       '        if key not in names:',
+                       '            objects = dict([(normalizeKey(k), v)',
+                       '                            for (k, v) in objects.items()])',
+                       '            break'])
+        if custom:
+            source.append('    else:')
+            source.append('        objects = objects.copy()')
+        source.extend(encode)
+        source.append('    return strings')
+        exec('\n'.join(source) + '\n', namespace)
+        self.toObjects = namespace['toObjects']
+        self.toStrings = namespace['toStrings']
+
 class Command:
     class __metaclass__(type):
         def __new__(cls, name, bases, attrs):
@@ -602,7 +2644,16 @@ class Command:
             for v, k in attrs.get('fatalErrors',{}).items():
                 re[k] = v
                 er[v] = k
-            return type.__new__(cls, name, bases, attrs)
+            newCommand = type.__new__(cls, name, bases, attrs)
+            # Compile conversions for the arguments and response, unless
+            # they are the same lists as those of a base class.
+            for listName, codecName in [('arguments', '_compiledArguments'),
+                                        ('response', '_compiledResponse')]:
+                arglist = getattr(newCommand, listName)
+                codec = getattr(newCommand, codecName, None)
+                if codec is None or codec.arglist is not arglist:
+                    setattr(newCommand, codecName, _CompiledArguments(arglist))
+            return newCommand
 
     arguments = []
     response = []
@@ -614,6 +2665,18 @@ class Command:
     errors = {}
     fatalErrors = {}
 
+    # If this is True, the body of a received command is not accumulated in
+    # memory: the responder is called as soon as the headers arrive, with a
+    # BodyStream as its 'body' argument.
+    streamBody = False
+
+    # If this is True, the responder is called in a thread, by the
+    # dispatcher's HandlerPool, and must not touch the reactor or the
+    # protocol.  No more than threadLimit of them run at once, unless it is
+    # None.
+    threaded = False
+    threadLimit = None
+
     commandType = Box
     responseType = Box
 
@@ -646,7 +2709,8 @@ class Command:
 
     def makeResponse(cls, objects, proto):
         try:
-            return objectsToStrings(objects, cls.response, cls.responseType(), proto)
+            return cls._compiledResponse.toStrings(
+                objects, cls.responseType(), proto)
         except:
             log.msg("Exception in %r.makeResponse" % (cls,))
             raise
@@ -663,14 +2727,15 @@ class Command:
             return Failure(self.reverseErrors.get(rje.errorCode, UnhandledRemoteJuiceError)(rje.description))
 
         d = proto.sendBoxCommand(
-            cmd, objectsToStrings(self.structured, self.arguments, self.commandType(),
-                                  proto),
+            cmd, self._compiledArguments.toStrings(
+                self.structured, self.commandType(), proto),
             requiresAnswer)
 
         if requiresAnswer:
-            d.addCallback(stringsToObjects, self.response, proto)
+            d.addCallback(self._compiledResponse.toObjects, proto)
             d.addCallback(self.addExtra, proto.transport)
             d.addErrback(_massageError)
+            d = proto._commandResult(d)
 
         return d
 
@@ -706,6 +2771,7 @@ class ProtocolSwitchCommand(Command):
             proto._switchTo(innerProto, self.protoToSwitchToFactory)
             return ign
         def die(ign):
+            proto.flushWrites()
             proto.transport.loseConnection()
             return ign
         def handle(ign):
@@ -718,11 +2784,22 @@ class Negotiate(Command):
 
     arguments = [('versions', ListOf(Integer()))]
     response = [('version', Integer())]
+    errors = {NegotiationInProgress: 'NEGOTIATION_IN_PROGRESS'}
 
     responseType = NegotiateBox
 
 
-class Juice(LineReceiver, JuiceParserBase):
+
+class _Renegotiate(Negotiate):
+    """
+    The L{Negotiate} command as sent by L{Juice.renegotiateVersion}, which
+    holds back the boxes sent after it until it is answered.
+    """
+    commandType = _NegotiateRequestBox
+    errors = Negotiate.errors
+
+
+class Juice(Protocol, JuiceParserBase):
     """
     JUICE (JUice Is Concurrent Events) is a simple connection-oriented
     request/response protocol.  Packets, or "boxes", are collections of
@@ -736,6 +2813,13 @@ class Juice(LineReceiver, JuiceParserBase):
     All headers whose names begin with a dash ('-') are reserved for use by the
     protocol.  All others are for application use - their meaning depends on
     the value of the "-Command" header.
+
+    Once both sides have agreed on protocol version 2 (see
+    L{renegotiateVersion}), boxes are framed in binary instead: each header is
+    sent as the lengths of its key and value followed by the key and value
+    themselves, so they are neither escaped nor case-converted.  Version 3
+    also sends header names, and whole headers with short values, which have
+    been sent before on the same connection as indexes into a table of them.
     """
 
     protocolName = 'juice-base'
@@ -744,6 +2828,35 @@ class Juice(LineReceiver, JuiceParserBase):
 
     MAX_LENGTH = 1024 * 1024
 
+    # Set this to a number of bytes to drop the connection when a box
+    # declares a longer body, unless it is streamed to a responder, rather
+    # than accepting bodies of any length.
+    maxBodyLength = None
+
+    # Set this to True to receive box bodies as memoryviews rather than
+    # strings, saving a copy of each large body.
+    memoryviewBodies = False
+
+    # The type of the boxes received.  Set this to CompactJuiceBox to use less
+    # memory for each box which is held on to.
+    boxType = JuiceBox
+
+    # The parser and serializer types for the framing of each protocol
+    # version; version 1 is the text framing used until another version is
+    # negotiated.
+    _framings = {
+        1: (JuiceFrameParser, JuiceBoxSerializer),
+        2: (BinaryJuiceFrameParser, BinaryJuiceBoxSerializer),
+        3: (HeaderTableJuiceFrameParser, HeaderTableJuiceBoxSerializer)}
+
+    # Set this to True to hold back the boxes sent during one reactor
+    # iteration and write them together with one writeSequence call when it
+    # ends, or as soon as maxCoalescedBoxes boxes or maxCoalescedBytes bytes
+    # are being held.
+    coalesceWrites = False
+    maxCoalescedBoxes = 64
+    maxCoalescedBytes = 64 * 1024
+
     isServer = property(lambda self: self._issueGreeting,
                         doc="""
                         True if this is a juice server, e.g. it is going to
@@ -788,7 +2901,8 @@ class Juice(LineReceiver, JuiceParserBase):
         """
 
         assert self.innerProtocol is None, "Protocol can only be safely switched once."
-        self.setRawMode()
+        self.flushWrites()
+        self._parser.stop()
         self.innerProtocol = newProto
         self.innerProtocolClientFactory = clientFactory
         newProto.makeConnection(self.transport)
@@ -800,22 +2914,81 @@ class Juice(LineReceiver, JuiceParserBase):
             # This is a command which will trigger an answer, and we can no
             # longer answer anything, so don't bother delivering it.
             return
+        if self._negotiatingBuffer is not None and COMMAND in box:
+            command = self._commandFor(box[COMMAND])
+            if (command is not None and issubclass(command, Negotiate)
+                and ASK in box):
+                self._refuseNegotiation(box[ASK])
+                return
         return super(Juice, self).juiceBoxReceived(box)
 
+    def _refuseNegotiation(self, tag):
+        """
+        Refuse the L{Negotiate} command with the given tag, which my peer sent
+        before it received mine.  Since each side holds back everything it
+        sends until its own request is answered, the refusal is sent at
+        once, in the framing both sides are still using; my peer refuses
+        mine the same way, and neither switches.
+        """
+        errorBox = JuiceBox()
+        errorBox[ERROR] = tag
+        errorBox[ERROR_CODE] = Negotiate.allErrors[NegotiationInProgress]
+        errorBox[ERROR_DESCRIPTION] = "Already negotiating a version"
+        held, self._negotiatingBuffer = self._negotiatingBuffer, None
+        try:
+            errorBox.sendTo(self)
+        finally:
+            self._negotiatingBuffer = held
+
     def sendPacket(self, completeBox):
         """
         Send a juice.Box to my peer.
 
-        Note: transport.write is never called outside of this method.
+        Note: transport.write and transport.writeSequence are never called
+        outside of this method and flushWrites.
         """
         assert not self.__locked, "You cannot send juice packets when a connection is locked"
         if self._startingTLSBuffer is not None:
             self._startingTLSBuffer.append(completeBox)
+        elif self._negotiatingBuffer is not None:
+            self._negotiatingBuffer.append(completeBox)
         else:
             if debug:
                 log.msg("Juice send: %s" % pprint.pformat(dict(iter(completeBox.items()))))
 
-            self.transport.write(completeBox.serialize())
+            data = self._serializer.serialize(completeBox)
+            if type(completeBox) is _NegotiateRequestBox:
+                # Not before now: it may have been held back itself, by
+                # prepareTLS, and must not be held back behind itself.
+                self._negotiatingBuffer = []
+            if not (self.coalesceWrites or self._batching):
+                self.transport.write(data)
+                return
+            pending = self._pendingWrites
+            if pending is None:
+                pending = self._pendingWrites = []
+                self._pendingBytes = 0
+                self._flushCall = self._getClock().callLater(
+                    0, self.flushWrites)
+            pending.append(data)
+            self._pendingBytes += len(data)
+            if (len(pending) >= self.maxCoalescedBoxes or
+                self._pendingBytes >= self.maxCoalescedBytes):
+                self.flushWrites()
+
+    _pendingWrites = None
+    _pendingBytes = 0
+    _flushCall = None
+
+    def flushWrites(self):
+        pending = self._pendingWrites
+        if pending is None:
+            return
+        self._pendingWrites = None
+        if self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self.transport.writeSequence(pending)
 
     def sendCommand(self, command, __content='', __answer=True, **kw):
         box = JuiceBox(__content, **kw)
@@ -832,8 +3005,15 @@ class Juice(LineReceiver, JuiceParserBase):
                                                                     self._transportHost,
                                                                     self._transportPeer))
         self._outstandingRequests = {}
-        self._requestBuffer = []
-        LineReceiver.makeConnection(self, transport)
+        # Each connection has its own serializer, since it caches the header
+        # names this connection sends.
+        self._serializer = JuiceBoxSerializer()
+        self._parser = self._makeParser(JuiceFrameParser)
+        Protocol.makeConnection(self, transport)
+
+    def _makeParser(self, parserType):
+        return parserType(self._frameReceived, self.memoryviewBodies,
+                          self._streamFor, self.boxType, self.maxBodyLength)
 
     _startingTLSBuffer = None
 
@@ -844,6 +3024,7 @@ class Juice(LineReceiver, JuiceParserBase):
         if self.hostCertificate is None:
             self.hostCertificate = certificate
             self._justStartedTLS = True
+            self.flushWrites()
             self.transport.startTLS(certificate.options(*verifyAuthorities))
             stlsb = self._startingTLSBuffer
             if stlsb is not None:
@@ -863,7 +3044,36 @@ class Juice(LineReceiver, JuiceParserBase):
         # means the connection was secured properly.  Make a note of that fact.
         if self._justStartedTLS:
             self._justStartedTLS = False
-        return LineReceiver.dataReceived(self, data)
+        parser = self._parser
+        data = parser.dataReceived(data)
+        while self._parser is not parser:
+            # A box changed the framing; parse the rest in the new one.
+            parser = self._parser
+            data = parser.dataReceived(data)
+        if data and self.innerProtocol is not None:
+            self.innerProtocol.dataReceived(data)
+
+    def _streamFor(self, box, length):
+        """
+        Return a L{BodyStream} for the body of C{box} if it is a command whose
+        responder wants its body streamed, otherwise C{None}.
+        """
+        if COMMAND not in box:
+            return None
+        command = self._commandFor(box[COMMAND])
+        if command is None or not command.streamBody:
+            return None
+        return BodyStream(self.transport, length)
+
+    def _frameReceived(self, box):
+        """
+        Deliver a box from my L{JuiceFrameParser}, and stop parsing if that
+        switched protocols or started to drop the connection.
+        """
+        self.juiceBoxReceived(box)
+        if self.innerProtocol is not None or (
+            self.transport is not None and self.transport.disconnecting):
+            self._parser.stop()
 
     def connectionLost(self, reason):
         log.msg("%s %s connection lost (HOST:%s PEER:%s)" % (
@@ -871,68 +3081,64 @@ class Juice(LineReceiver, JuiceParserBase):
                 self.__class__.__name__,
                 self._transportHost,
                 self._transportPeer))
+        self._parser.connectionLost(reason)
+        self._negotiatingBuffer = None
+        if self._pendingWrites is not None:
+            self._pendingWrites = None
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
         self.failAllOutgoing(reason)
         if self.innerProtocol is not None:
             self.innerProtocol.connectionLost(reason)
             if self.innerProtocolClientFactory is not None:
                 self.innerProtocolClientFactory.clientConnectionLost(None, reason)
 
-    def lineReceived(self, line):
-        if line:
-            self._requestBuffer.append(line)
-        else:
-            buf = self._requestBuffer
-            self._requestBuffer = []
-            bodylen, b = parseJuiceHeaders(buf)
-            if bodylen:
-                self._bodyRemaining = bodylen
-                self._bodyBuffer = []
-                self._pendingBox = b
-                self.setRawMode()
-            else:
-                self.juiceBoxReceived(b)
-
-    def rawDataReceived(self, data):
-        if self.innerProtocol is not None:
-            self.innerProtocol.dataReceived(data)
-            return
-        self._bodyRemaining -= len(data)
-        if self._bodyRemaining <= 0:
-            if self._bodyRemaining < 0:
-                self._bodyBuffer.append(data[:self._bodyRemaining])
-                extraData = data[self._bodyRemaining:]
-            else:
-                self._bodyBuffer.append(data)
-                extraData = ''
-            self._pendingBox['body'] = ''.join(self._bodyBuffer)
-            self._bodyBuffer = None
-            b, self._pendingBox = self._pendingBox, None
-            self.juiceBoxReceived(b)
-            if self.innerProtocol is not None:
-                self.innerProtocol.makeConnection(self.transport)
-                if extraData:
-                    self.innerProtocol.dataReceived(extraData)
-            else:
-                self.setLineMode(extraData)
-        else:
-            self._bodyBuffer.append(data)
-
     protocolVersion = 0
 
     def _setProtocolVersion(self, version):
-        # if we ever want to actually mangle encodings, this is the place to do
-        # it!
+        """
+        Frame everything sent and received from now on as C{version} does.
+        """
         self.protocolVersion = version
+        parserType, serializerType = self._framings[version]
+        if type(self._serializer) is not serializerType:
+            self._serializer = serializerType()
+        if type(self._parser) is not parserType:
+            self._parser.stop()
+            self._parser = self._makeParser(parserType)
         return version
 
+    _negotiatingBuffer = None
+    _renegotiating = False
+
     def renegotiateVersion(self, newVersion):
+        """
+        Ask my peer to switch to protocol version C{newVersion}.
+
+        Boxes sent after the request has been written and before its answer
+        arrives are held back, and then sent in whichever framing was
+        agreed.  If my peer asks to renegotiate at the same time, both
+        requests fail with L{NegotiationInProgress}, and the framing is not
+        changed, as does a request made while one of mine is outstanding.
+        """
         assert newVersion in VERSIONS, (
             "This side of the connection doesn't support version %r"
             % (newVersion,))
-        v = VERSIONS[:]
-        v.remove(newVersion)
-        return Negotiate(versions=[newVersion]).do(self).addCallback(
-            lambda ver: self._setProtocolVersion(ver['version']))
+        if self._renegotiating:
+            return fail(NegotiationInProgress(
+                    "Already negotiating a version"))
+        self._renegotiating = True
+        d = _Renegotiate(versions=[newVersion]).do(self)
+        def release(result):
+            self._renegotiating = False
+            held, self._negotiatingBuffer = self._negotiatingBuffer, None
+            for box in held or ():
+                self.sendPacket(box)
+            return result
+        return d.addCallback(
+            lambda ver: self._setProtocolVersion(ver['version'])
+            ).addBoth(release)
 
     def command_NEGOTIATE(self, versions):
         for version in versions:
@@ -942,7 +3148,7 @@ class Juice(LineReceiver, JuiceParserBase):
     command_NEGOTIATE.command = Negotiate
 
 
-VERSIONS = [1]
+VERSIONS = [1, 2, 3]
 
 from io import StringIO
 class _ParserHelper(Juice):
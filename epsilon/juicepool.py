@@ -0,0 +1,310 @@
+# -*- test-case-name: epsilon.test.test_juicepool -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Serve Juice from several processes at once.
+
+L{JuiceWorkerPool} runs a number of worker processes, each with its own
+reactor and its own listening socket on the same port, bound with
+C{SO_REUSEPORT} so that the kernel spreads incoming connections between
+them.  Workers which exit are restarted, and stopping the pool lets each
+worker finish with its open connections first.
+
+Run a pool from the command line with::
+
+    python -m epsilon.juicepool --workers 4 --port 7000 \\
+        myproject.MyJuiceServerFactory
+"""
+
+import os, sys, socket
+
+from twisted.application.service import Service
+from twisted.internet import defer, protocol
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.task import deferLater
+from twisted.protocols.policies import WrappingFactory
+from twisted.python import log, reflect, usage
+
+from epsilon import process
+
+
+def listenReusePort(reactor, port, factory, interface='', backlog=50):
+    """
+    Listen for TCP connections on C{port} with C{SO_REUSEPORT} set, so that
+    other processes, or other listeners in this one, may listen on the same
+    port at the same time.
+
+    @param reactor: an L{IReactorSocket} provider.
+
+    @return: an L{IListeningPort}.
+    """
+    if interface and ':' in interface:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    skt = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        skt.bind((interface, port))
+        skt.listen(backlog)
+        skt.setblocking(False)
+        return reactor.adoptStreamPort(skt.fileno(), family, factory)
+    finally:
+        # The reactor has its own copy of the descriptor.
+        skt.close()
+
+
+
+def drain(clock, port, connections, timeout):
+    """
+    Stop listening, then wait for the open connections to close, aborting any
+    still open after C{timeout} seconds.  They are aborted rather than lost,
+    so that a peer which is not reading cannot hold them open with data
+    waiting to be written.
+
+    @param port: the L{IListeningPort} to stop.
+
+    @param connections: the L{WrappingFactory} whose C{protocols} are the open
+        connections.
+
+    @return: a L{Deferred} which fires when every connection has closed.
+    """
+    d = defer.maybeDeferred(port.stopListening)
+    deadline = clock.seconds() + timeout
+    def check(ignored=None):
+        if not connections.protocols:
+            return None
+        if clock.seconds() >= deadline:
+            for proto in list(connections.protocols):
+                proto.transport.abortConnection()
+        return deferLater(clock, 0.1, check)
+    return d.addCallback(check)
+
+
+
+class _ParentWatcher(protocol.Protocol):
+    """
+    Stop a worker's reactor if its standard input is closed, which means
+    the process running the pool has gone away.
+    """
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+
+    def connectionLost(self, reason):
+        if self.reactor.running:
+            self.reactor.stop()
+
+
+
+def runWorker(reactor, factoryName, port, interface='', drainTimeout=10.0):
+    """
+    Serve connections to C{port} with the factory named C{factoryName} until
+    the reactor is stopped, then drain them.  This is the body of each worker
+    process.
+    """
+    factory = WrappingFactory(reflect.namedAny(factoryName)())
+    listeningPort = listenReusePort(reactor, port, factory, interface)
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', drain, reactor, listeningPort, factory,
+        drainTimeout)
+    process.StandardIOService(_ParentWatcher(reactor)).startService()
+    log.msg("Juice worker %d serving %s on port %d" % (
+            os.getpid(), factoryName, port))
+    reactor.run()
+
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """
+    The pool's end of one worker process.
+
+    @ivar ended: a L{Deferred} which fires when the process has exited.
+    """
+    def __init__(self, pool, slot, started):
+        self.pool = pool
+        self.slot = slot
+        self.started = started
+        self.ended = defer.Deferred()
+
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg("[worker %d] %s" % (self.slot, line))
+
+    errReceived = outReceived
+
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self.pool._workerEnded(self, reason)
+
+
+
+class JuiceWorkerPool(Service):
+    """
+    I run C{workers} processes, each serving Juice connections to C{port}
+    with a new instance of the factory named C{factoryName}.
+
+    @ivar restartDelay: the number of seconds to wait before restarting a
+        worker which has exited.  It doubles, up to C{maxRestartDelay}, each
+        time a worker exits within C{maxRestartDelay} seconds of starting, so
+        that a worker which cannot start does not spin.
+
+    @ivar stopTimeout: the number of seconds to wait for a worker to exit,
+        after it is asked to, before killing it.
+
+    @ivar restarts: the number of times a worker has been restarted.
+
+    @ivar _workers: a C{dict} mapping each slot to the L{_WorkerProtocol} for
+        the worker running in it.
+
+    @ivar _delays: a C{dict} mapping each slot to the delay before its worker
+        is next restarted.
+
+    @ivar _restarting: a C{dict} mapping slots to the delayed calls which
+        will restart their workers.
+    """
+
+    restartDelay = 1.0
+    maxRestartDelay = 30.0
+    stopTimeout = 30.0
+    restarts = 0
+
+    def __init__(self, factoryName, port, workers, interface='',
+                 drainTimeout=10.0, clock=None):
+        self.factoryName = factoryName
+        self.port = port
+        self.workers = workers
+        self.interface = interface
+        self.drainTimeout = drainTimeout
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._workers = {}
+        self._delays = {}
+        self._restarting = {}
+
+
+    def _spawn(self, proto):
+        """
+        Start a worker process connected to C{proto}.
+        """
+        args = [sys.executable, '-m', 'epsilon.juicepool', '--worker',
+                '--port', str(self.port), '--interface', self.interface,
+                '--drain-timeout', str(self.drainTimeout), self.factoryName]
+        return process.spawnPythonProcess(
+            proto, args, env=os.environ, packages=('epsilon',))
+
+
+    def _startWorker(self, slot):
+        self._restarting.pop(slot, None)
+        proto = _WorkerProtocol(self, slot, self.clock.seconds())
+        self._workers[slot] = proto
+        self._spawn(proto)
+
+
+    def _workerEnded(self, proto, reason):
+        slot = proto.slot
+        if self._workers.get(slot) is not proto:
+            return
+        del self._workers[slot]
+        if not self.running:
+            return
+        log.msg("Juice worker %d exited: %s" % (slot, reason.value))
+        delay = self._delays.get(slot, self.restartDelay)
+        if self.clock.seconds() - proto.started < self.maxRestartDelay:
+            self._delays[slot] = min(delay * 2, self.maxRestartDelay)
+        else:
+            delay = self._delays[slot] = self.restartDelay
+        self.restarts += 1
+        self._restarting[slot] = self.clock.callLater(
+            delay, self._startWorker, slot)
+
+
+    def _signalWorker(self, proto, signal):
+        """
+        Send C{signal} to the worker connected to C{proto}, unless it has
+        already exited, in which case its C{ended} L{Deferred} will fire.
+        """
+        try:
+            proto.transport.signalProcess(signal)
+        except ProcessExitedAlready:
+            pass
+
+
+    def startService(self):
+        Service.startService(self)
+        for slot in range(self.workers):
+            self._startWorker(slot)
+
+
+    def stopService(self):
+        """
+        Ask every worker to stop accepting connections and exit once its
+        open connections have closed, and kill any which have not exited
+        after C{stopTimeout} seconds.
+
+        @return: a L{Deferred} which fires when every worker has exited.
+        """
+        Service.stopService(self)
+        for call in self._restarting.values():
+            call.cancel()
+        self._restarting.clear()
+        ended = []
+        for proto in self._workers.values():
+            self._signalWorker(proto, 'TERM')
+            kill = self.clock.callLater(
+                self.stopTimeout, self._signalWorker, proto, 'KILL')
+            def exited(ignored, kill=kill):
+                if kill.active():
+                    kill.cancel()
+            ended.append(proto.ended.addCallback(exited))
+        return defer.gatherResults(ended)
+
+
+
+class Options(usage.Options):
+    synopsis = '[options] <factory>'
+
+    optParameters = [
+        ('port', 'p', 7000, 'The port to listen on.', int),
+        ('interface', 'i', '', 'The interface to listen on.'),
+        ('workers', 'w', 2, 'The number of worker processes.', int),
+        ('drain-timeout', None, 10.0,
+         'How long to let connections finish when stopping.', float)]
+
+    optFlags = [
+        ('worker', None, 'Run one worker, rather than a pool of them.')]
+
+    def parseArgs(self, factory='epsilon.juice.JuiceServerFactory'):
+        self['factory'] = factory
+
+
+
+def main(argv=None):
+    """
+    Run a L{JuiceWorkerPool}, or one of its workers, until it is stopped.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    options = Options()
+    options.parseOptions(argv)
+    log.startLogging(sys.stderr)
+    from twisted.internet import reactor
+    if options['worker']:
+        runWorker(reactor, options['factory'], options['port'],
+                  options['interface'], options['drain-timeout'])
+        return
+    pool = JuiceWorkerPool(
+        options['factory'], options['port'], options['workers'],
+        options['interface'], options['drain-timeout'])
+    reactor.callWhenRunning(pool.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown', pool.stopService)
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,70 @@
 # Copyright 2005 Divmod, Inc.  See LICENSE file for details
-# -*- test-case-name: vertex.test.test_juice -*-
+# -*- test-case-name: epsilon.test.test_liner -*-
 
 __metaclass__ = type
 
 from twisted.internet.protocol import Protocol
 
 class LineReceiver(Protocol):
+    """
+    A protocol which receives delimited lines, and can switch to receiving
+    raw data and back.
+
+    Received bytes are kept in a single C{bytearray} which is consumed by
+    advancing an offset, and compacted once per call to L{dataReceived}, so
+    many short lines in one segment cost no more copying than one long one.
+    The search for a delimiter resumes where the previous one stopped, so a
+    long line arriving in many segments is scanned only once.
+
+    @ivar _buffer: C{None}, or a C{bytearray} of received bytes not yet
+        delivered.
+
+    @ivar _scanned: the offset into C{_buffer} before which there is no
+        delimiter.
+
+    @ivar _receiving: C{True} while lines are being delivered; data received
+        during that time (for example, from L{setLineMode} called by
+        L{lineReceived}) is delivered after the data already buffered.  It is
+        C{False} during calls to L{rawDataReceived}, when nothing is
+        buffered, so data passed to L{setLineMode} from there is delivered
+        before it returns.
+    """
 
     lineMode = True
     MAX_LINE_LENGTH = 1024 * 1024
-    buffer = ''
     delimiter = '\r\n'
 
+    _buffer = None
+    _scanned = 0
+    _receiving = False
+
+    def _getBuffer(self):
+        if self._buffer is None:
+            return ''
+        return bytes(self._buffer)
+
+    def _setBuffer(self, data):
+        self._buffer = bytearray(data)
+        self._scanned = 0
+
+    buffer = property(_getBuffer, _setBuffer, doc="""
+        The bytes received but not yet delivered.
+        """)
+
     def lineReceived(self, line):
         pass
 
     def rawDataReceived(self, data):
         pass
 
+    def lineLengthExceeded(self, line):
+        """
+        Called with the buffered bytes when a line longer than
+        C{MAX_LINE_LENGTH} is received; the buffer is discarded.  By default,
+        drop the connection.
+        """
+        return self.transport.loseConnection()
+
     def setLineMode(self, extra=''):
         self.lineMode = True
         if extra:
@@ -36,32 +83,77 @@ class LineReceiver(Protocol):
         self.lineMode = False
 
     def dataReceived(self, data):
-        buffer = self.buffer
-        buffer += data
-        delimiter = self.delimiter
-        begin = 0
-        raw = False
-        while self.lineMode:
-            end = buffer.find(delimiter, begin)
-            if end == -1:
-                break
-            line = buffer[begin:end]
-            self.lineReceived(line)
-            if self.isDisconnecting():
-                self.buffer = ''
+        buf = self._buffer
+        if self._receiving:
+            buf += data
+            return
+        if not buf:
+            if not self.lineMode:
+                # Nothing is buffered, so raw data can be passed on as it is.
+                if not self.isDisconnecting():
+                    self.rawDataReceived(data)
                 return
-            begin = end + len(delimiter)
-        else:
-            raw = True
-        if begin:
-            buffer = buffer[begin:]
-        if raw:
-            self.buffer = ''
-            if self.isDisconnecting():
-                return
-            if buffer:
-                self.rawDataReceived(buffer)
-        else:
-            self.buffer = buffer
-
+            if buf is None:
+                buf = self._buffer = bytearray()
+        buf += data
+        self._receiving = True
+        try:
+            self._deliver(buf)
+        finally:
+            self._receiving = False
 
+    def _deliver(self, buf):
+        """
+        Deliver as much of C{buf} as possible.
+        """
+        delimiter = self.delimiter
+        delimiterLength = len(delimiter)
+        maxLength = self.MAX_LINE_LENGTH
+        offset = 0
+        scanned = self._scanned
+        while True:
+            if self.lineMode:
+                if scanned < offset:
+                    scanned = offset
+                end = buf.find(delimiter, scanned)
+                if end == -1:
+                    if len(buf) - offset > maxLength:
+                        break
+                    scanned = len(buf) - delimiterLength + 1
+                    if scanned < offset:
+                        scanned = offset
+                    self._scanned = scanned - offset
+                    del buf[:offset]
+                    return
+                if end - offset > maxLength:
+                    break
+                line = bytes(buf[offset:end])
+                offset = scanned = end + delimiterLength
+                self.lineReceived(line)
+                transport = self.transport
+                if transport is not None and transport.disconnecting:
+                    del buf[:]
+                    self._scanned = 0
+                    return
+            else:
+                data = bytes(buf[offset:])
+                del buf[:]
+                self._scanned = 0
+                if not data or self.isDisconnecting():
+                    return
+                self._receiving = False
+                try:
+                    self.rawDataReceived(data)
+                finally:
+                    self._receiving = True
+                # rawDataReceived may have switched back to line mode and
+                # left part of a line buffered; if so, keep going.
+                buf = self._buffer
+                if buf is None:
+                    return
+                offset = 0
+                scanned = self._scanned
+        line = bytes(buf[offset:])
+        del buf[:]
+        self._scanned = 0
+        self.lineLengthExceeded(line)
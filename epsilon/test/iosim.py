@@ -1 +1,231 @@
-Non
\ No newline at end of file
+# -*- test-case-name: epsilon.test.test_juice -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Connect protocols to each other in memory, for tests and benchmarks.
+"""
+
+import itertools
+
+from zope.interface import implements
+
+from twisted.internet import error, interfaces
+from twisted.internet.address import IPv4Address
+from twisted.python import failure
+
+
+class FakeTransport:
+    """
+    A transport which holds the bytes written to it until an L{IOPump}
+    delivers them to the protocol on the other end.
+
+    @ivar protocol: the protocol connected to this end.
+
+    @ivar isServer: C{True} if this is the server's end of the connection.
+
+    @ivar bytesWritten: the number of bytes written so far.
+    """
+
+    implements(interfaces.ITransport, interfaces.IConsumer)
+
+    _nextSerial = itertools.count().next
+
+    disconnecting = False
+    disconnected = False
+    disconnectReason = error.ConnectionDone("Connection done")
+    producer = None
+    streamingProducer = False
+
+    def __init__(self, protocol, isServer):
+        self.protocol = protocol
+        self.isServer = isServer
+        self.serial = self._nextSerial()
+        self.stream = []
+        self.bytesWritten = 0
+
+
+    def __repr__(self):
+        return 'FakeTransport<%s,%s,%s>' % (
+            self.isServer and 'S' or 'C', self.serial,
+            self.protocol.__class__.__name__)
+
+
+    def write(self, data):
+        self.stream.append(data)
+        self.bytesWritten += len(data)
+
+
+    def writeSequence(self, iovec):
+        self.write(''.join(iovec))
+
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+    def getPeer(self):
+        return IPv4Address('TCP', '127.0.0.1', self.isServer and 4321 or 1234)
+
+
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', self.isServer and 1234 or 4321)
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streamingProducer = streaming
+        if not streaming:
+            producer.resumeProducing()
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def _checkProducer(self):
+        # Called when the pump is idle, to let a pull producer write more.
+        if self.producer is not None and not self.streamingProducer:
+            self.producer.resumeProducing()
+
+
+    def pauseProducing(self):
+        pass
+
+
+    def resumeProducing(self):
+        pass
+
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+    def getOutBuffer(self):
+        """
+        Return, and forget, the bytes written since the last call, or C{None}
+        if there are none.
+        """
+        if self.stream:
+            data = ''.join(self.stream)
+            self.stream = []
+            return data
+        return None
+
+
+    def bufferReceived(self, data):
+        self.protocol.dataReceived(data)
+
+
+    def reportDisconnect(self):
+        self.protocol.connectionLost(failure.Failure(self.disconnectReason))
+
+
+
+def makeFakeClient(protocol):
+    return FakeTransport(protocol, isServer=False)
+
+
+
+def makeFakeServer(protocol):
+    return FakeTransport(protocol, isServer=True)
+
+
+
+class IOPump:
+    """
+    I move bytes between the transports of a client and a server.
+
+    @ivar bytesMoved: the number of bytes moved so far, in both directions.
+    """
+
+    def __init__(self, client, server, clientIO, serverIO, debug=False):
+        self.client = client
+        self.server = server
+        self.clientIO = clientIO
+        self.serverIO = serverIO
+        self.debug = debug
+        self.bytesMoved = 0
+
+
+    def flush(self, debug=False):
+        """
+        Pump until no more bytes are written.
+
+        @return: C{True} if any bytes were moved.
+        """
+        result = False
+        for i in range(1000):
+            if self.pump(debug):
+                result = True
+            else:
+                break
+        else:
+            raise RuntimeError("Still pumping after 1000 iterations")
+        return result
+
+
+    def pump(self, debug=False):
+        """
+        Deliver the bytes written to each side since the last call to the
+        other, or, if there are none, deliver a disconnection.
+
+        @return: C{True} if anything was delivered.
+        """
+        debug = debug or self.debug
+        serverData = self.serverIO.getOutBuffer()
+        clientData = self.clientIO.getOutBuffer()
+        self.clientIO._checkProducer()
+        self.serverIO._checkProducer()
+        if debug:
+            if clientData:
+                print('C: ' + repr(clientData))
+            if serverData:
+                print('S: ' + repr(serverData))
+        if clientData:
+            self.bytesMoved += len(clientData)
+            self.serverIO.bufferReceived(clientData)
+        if serverData:
+            self.bytesMoved += len(serverData)
+            self.clientIO.bufferReceived(serverData)
+        if clientData or serverData:
+            return True
+        if self.serverIO.disconnecting and not self.serverIO.disconnected:
+            if debug:
+                print('* C')
+            self.serverIO.disconnected = True
+            self.clientIO.disconnecting = True
+            self.clientIO.reportDisconnect()
+            return True
+        if self.clientIO.disconnecting and not self.clientIO.disconnected:
+            if debug:
+                print('* S')
+            self.clientIO.disconnected = True
+            self.serverIO.disconnecting = True
+            self.serverIO.reportDisconnect()
+            return True
+        return False
+
+
+
+def connectedServerAndClient(ServerClass, ClientClass,
+                             clientTransportFactory=makeFakeClient,
+                             serverTransportFactory=makeFakeServer,
+                             debug=False, greet=True):
+    """
+    Connect a new client protocol to a new server protocol.
+
+    @param greet: if C{True}, deliver whatever each writes when connected.
+
+    @return: a 3-tuple of the client, the server and the L{IOPump} which
+        connects them.
+    """
+    client = ClientClass()
+    server = ServerClass()
+    clientIO = clientTransportFactory(client)
+    serverIO = serverTransportFactory(server)
+    client.makeConnection(clientIO)
+    server.makeConnection(serverIO)
+    pump = IOPump(client, server, clientIO, serverIO, debug)
+    if greet:
+        pump.flush()
+    return client, server, pump
@@ -0,0 +1,540 @@
+# -*- test-case-name: epsilon.test.test_juice -*-
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Microbenchmarks for L{epsilon.juice}.
+
+Run C{python -m epsilon.test.juicebench} to print the results of every
+benchmark in this module, or C{python -m epsilon.test.juicebench --json} to
+print the results of L{loopbackSuite} as JSON, for comparison between
+revisions.
+"""
+
+import os, sys, gc, time, json, platform, socket, signal, subprocess
+import multiprocessing
+
+from epsilon import juice
+from epsilon.liner import LineReceiver
+from epsilon.test import iosim
+
+
+def timed(f, count):
+    """
+    Call C{f} C{count} times and return the elapsed wall-clock time in
+    seconds.
+    """
+    start = time.time()
+    for i in range(count):
+        f()
+    return time.time() - start
+
+
+
+class _LineJuiceParser(LineReceiver):
+    """
+    The line-oriented parser which L{juice.JuiceFrameParser} replaced, kept
+    here to measure against.
+    """
+    transport = None
+
+    def __init__(self, boxReceived):
+        self.boxReceived = boxReceived
+        self._requestBuffer = []
+
+
+    def lineReceived(self, line):
+        if line:
+            self._requestBuffer.append(line)
+        else:
+            buf = self._requestBuffer
+            self._requestBuffer = []
+            bodylen, b = juice.parseJuiceHeaders(buf)
+            if bodylen:
+                self._bodyRemaining = bodylen
+                self._bodyBuffer = []
+                self._pendingBox = b
+                self.setRawMode()
+            else:
+                self.boxReceived(b)
+
+
+    def rawDataReceived(self, data):
+        self._bodyRemaining -= len(data)
+        if self._bodyRemaining <= 0:
+            if self._bodyRemaining < 0:
+                self._bodyBuffer.append(data[:self._bodyRemaining])
+                extraData = data[self._bodyRemaining:]
+            else:
+                self._bodyBuffer.append(data)
+                extraData = ''
+            self._pendingBox['body'] = ''.join(self._bodyBuffer)
+            self._bodyBuffer = None
+            b, self._pendingBox = self._pendingBox, None
+            self.boxReceived(b)
+            self.setLineMode(extraData)
+        else:
+            self._bodyBuffer.append(data)
+
+
+
+def sampleBox(headers=8, valueSize=16, bodySize=0, boxType=juice.Box):
+    """
+    Return a L{juice.JuiceBox}, or a box of type C{boxType}, shaped like a
+    typical command.
+    """
+    box = boxType()
+    box[juice.COMMAND] = 'sample-command'
+    box[juice.ASK] = '1f'
+    for i in range(headers):
+        box['header_%d' % (i,)] = 'v' * valueSize
+    if bodySize:
+        box[juice.BODY] = 'b' * bodySize
+    return box
+
+
+
+def benchmarkParse(boxes=1000, segmentSize=64, **boxShape):
+    """
+    Measure how quickly each parser turns a stream of serialized boxes,
+    delivered in C{segmentSize}-byte segments, back into boxes.
+
+    @return: a C{dict} mapping parser names to boxes parsed per second.
+    """
+    box = sampleBox(**boxShape)
+    text = box.serialize() * boxes
+    binary = juice.BinaryJuiceBoxSerializer().serialize(box) * boxes
+    serializer = juice.HeaderTableJuiceBoxSerializer()
+    table = ''.join([serializer.serialize(box) for i in range(boxes)])
+    results = {}
+    for name, factory, data in [
+        ('line', _LineJuiceParser, text),
+        ('frame', juice.JuiceFrameParser, text),
+        ('frame-memoryview',
+         lambda boxReceived: juice.JuiceFrameParser(boxReceived, True),
+         text),
+        ('binary', juice.BinaryJuiceFrameParser, binary),
+        ('table', juice.HeaderTableJuiceFrameParser, table)]:
+        segments = [data[i:i + segmentSize]
+                    for i in range(0, len(data), segmentSize)]
+        received = []
+        parser = factory(received.append)
+        def parse():
+            for segment in segments:
+                parser.dataReceived(segment)
+        elapsed = timed(parse, 1)
+        assert len(received) == boxes, (name, len(received))
+        results[name] = boxes / max(elapsed, 1e-9)
+    return results
+
+
+
+def benchmarkSerialize(boxes=10000, **boxShape):
+    """
+    Measure how quickly boxes are serialized by L{juice.JuiceBox.serialize},
+    by L{juice.JuiceBoxSerializer}, both returning a new string for each box
+    and appending each box to one reused C{bytearray}, and by
+    L{juice.BinaryJuiceBoxSerializer} and
+    L{juice.HeaderTableJuiceBoxSerializer}.
+
+    @return: a C{dict} mapping serializer names to boxes serialized per
+        second.
+    """
+    box = sampleBox(**boxShape)
+    serializer = juice.JuiceBoxSerializer()
+    binary = juice.BinaryJuiceBoxSerializer()
+    table = juice.HeaderTableJuiceBoxSerializer()
+    buf = bytearray()
+    def serializeInto():
+        serializer.serializeInto(box, buf)
+        del buf[:]
+    results = {}
+    for name, f in [('serialize', box.serialize),
+                    ('serializer', lambda: serializer.serialize(box)),
+                    ('serializeInto', serializeInto),
+                    ('binary', lambda: binary.serialize(box)),
+                    ('table', lambda: table.serialize(box))]:
+        results[name] = boxes / max(timed(f, boxes), 1e-9)
+    return results
+
+
+
+def frameSizes(boxes=100, **boxShape):
+    """
+    Measure how many bytes each framing uses for a box, when the same box is
+    sent repeatedly.
+
+    @return: a C{dict} mapping framing names to bytes per box.
+    """
+    box = sampleBox(**boxShape)
+    results = {}
+    for name, serializer in [
+        ('text', juice.JuiceBoxSerializer()),
+        ('binary', juice.BinaryJuiceBoxSerializer()),
+        ('table', juice.HeaderTableJuiceBoxSerializer())]:
+        size = sum([len(serializer.serialize(box)) for i in range(boxes)])
+        results[name] = size / boxes
+    return results
+
+
+
+def boxMemory(**boxShape):
+    """
+    Measure how much memory a L{juice.JuiceBox} and a
+    L{juice.CompactJuiceBox} with the same contents take, not counting the
+    keys and values, which they share.
+
+    @return: a C{dict} mapping box type names to bytes per box.
+    """
+    results = {}
+    for boxType in [juice.JuiceBox, juice.CompactJuiceBox]:
+        box = sampleBox(boxType=boxType, **boxShape)
+        size = sys.getsizeof(box)
+        fields = getattr(box, '_fields', None)
+        if fields is not None:
+            size += sys.getsizeof(fields)
+        results[boxType.__name__] = size
+    return results
+
+
+
+class MarshalCommand(juice.Command):
+    arguments = [('text', juice.String()),
+                 ('number', juice.Integer()),
+                 ('ratio', juice.Float()),
+                 ('flag', juice.Boolean()),
+                 ('name', juice.Unicode()),
+                 ('note', juice.String(optional=True))]
+
+
+
+def benchmarkMarshal(calls=10000):
+    """
+    Measure how quickly the arguments of a typical command are converted to
+    a box and back by L{juice.objectsToStrings} and L{juice.stringsToObjects}
+    and by the conversions compiled for L{MarshalCommand}.
+
+    @return: a C{dict} mapping conversion names to round trips per second.
+    """
+    objects = dict(text='hello', number=12345, ratio=0.5, flag=True,
+                   name=u'name', note=None)
+    arguments = MarshalCommand.arguments
+    compiled = MarshalCommand._compiledArguments
+    def generic():
+        juice.stringsToObjects(
+            juice.objectsToStrings(objects, arguments, juice.Box(), None),
+            arguments, None)
+    def specialized():
+        compiled.toObjects(
+            compiled.toStrings(objects, juice.Box(), None), None)
+    results = {}
+    for name, f in [('generic', generic), ('compiled', specialized)]:
+        results[name] = calls / max(timed(f, calls), 1e-9)
+    return results
+
+
+
+def benchmarkListOf(items=10000, calls=20):
+    """
+    Measure how quickly a long L{juice.ListOf} of each type which is
+    converted in bulk is converted to a string and back, in bulk and item by
+    item.
+
+    @return: a C{dict} mapping conversion names to lists per second.
+    """
+    results = {}
+    for name, subarg, objects in [
+        ('integer', juice.Integer(), list(range(items))),
+        ('float', juice.Float(), [i / 3.0 for i in range(items)]),
+        ('string', juice.String(), ['item%d' % (i,) for i in range(items)])]:
+        bulk = juice.ListOf(subarg)
+        itemByItem = juice.ListOf(subarg)
+        itemByItem._bulkType = None
+        string = bulk.toStringProto(objects, None)
+        for kind, argument in [('bulk', bulk), ('item', itemByItem)]:
+            results['%s %s decode' % (name, kind)] = calls / max(timed(
+                    lambda: argument.fromStringProto(string, None),
+                    calls), 1e-9)
+            results['%s %s encode' % (name, kind)] = calls / max(timed(
+                    lambda: argument.toStringProto(objects, None),
+                    calls), 1e-9)
+    return results
+
+
+
+class Base64Upload(juice.Command):
+    arguments = [('data', juice.Base64Binary())]
+
+class BinaryUpload(juice.Command):
+    arguments = [('data', juice.Binary())]
+
+
+
+def benchmarkBinary(size=64 * 1024, calls=200):
+    """
+    Measure how quickly C{size} bytes of binary data are sent and received
+    as a L{juice.Base64Binary} argument and as a L{juice.Binary} one: the
+    conversion to a box, serialization, parsing and conversion back.
+
+    @return: a C{dict} mapping argument types to round trips per second, and
+        to the bytes each box takes.
+    """
+    objects = {'data': os.urandom(size)}
+    results = {}
+    for name, command in [('base64', Base64Upload), ('binary', BinaryUpload)]:
+        codec = command._compiledArguments
+        def roundTrip():
+            boxes = []
+            juice.JuiceFrameParser(boxes.append, True).dataReceived(
+                codec.toStrings(objects, juice.Box(), None).serialize())
+            return codec.toObjects(boxes[0], None)
+        results[name + ' round trips/s'] = calls / max(
+            timed(roundTrip, calls), 1e-9)
+        results[name + ' bytes'] = len(
+            codec.toStrings(objects, juice.Box(), None).serialize())
+    return results
+
+
+
+class Echo(juice.Command):
+    commandName = 'echo'
+    arguments = [('text', juice.String())]
+    response = [('text', juice.String())]
+
+
+
+class EchoJuice(juice.Juice):
+    """
+    A L{juice.Juice} which answers L{Echo}.
+    """
+    def command_ECHO(self, text):
+        return dict(text=text)
+    command_ECHO.command = Echo
+
+
+
+class EchoJuiceServerFactory(juice.JuiceServerFactory):
+    protocol = EchoJuice
+
+
+
+# The directory containing epsilon, for the pool run by benchmarkWorkers.
+# Found now, in case the working directory changes later.
+_epsilonPath = os.path.dirname(
+    os.path.dirname(os.path.abspath(juice.__file__)))
+
+
+
+def benchmarkLoopback(boxSize=64, depth=1, requests=1000):
+    """
+    Send C{requests} L{Echo} commands, each with C{boxSize} bytes of text,
+    from a L{juice.Juice} to an L{EchoJuice} connected to it in memory,
+    keeping C{depth} of them awaiting answers at once.
+
+    The objects counted are those tracked by the garbage collector which are
+    allocated, and not freed, while the commands are sent and answered;
+    CPython cannot count every allocation without a debug build, but this
+    shows boxes, or anything else, being kept when they should not be.
+
+    @return: a C{dict} of the boxes, commands and answers together, and
+        bytes sent per second, the median and 99th percentile time in
+        seconds from sending a command to receiving its answer, and the
+        objects kept per box.
+    """
+    client, server, pump = iosim.connectedServerAndClient(
+        lambda: EchoJuice(True), lambda: juice.Juice(False))
+    client.latencies = juice.JuiceLatencies()
+    text = 'x' * boxSize
+    unsent = [requests]
+    def send():
+        unsent[0] -= 1
+        Echo(text=text).do(client).addCallback(answered)
+    def answered(response):
+        if unsent[0]:
+            send()
+    gc.collect()
+    gc.disable()
+    try:
+        objects = gc.get_count()[0]
+        start = time.time()
+        for i in range(min(depth, requests)):
+            send()
+        while pump.pump():
+            pass
+        elapsed = max(time.time() - start, 1e-9)
+        objects = gc.get_count()[0] - objects
+    finally:
+        gc.enable()
+    latencies = client.latencies.sent['echo']
+    assert latencies.count == requests, "Only %d of %d commands answered" % (
+        latencies.count, requests)
+    boxes = requests * 2
+    return {'boxesPerSecond': boxes / elapsed,
+            'bytesPerSecond': pump.bytesMoved / elapsed,
+            'latencyP50': latencies.percentile(0.5),
+            'latencyP99': latencies.percentile(0.99),
+            'objectsPerBox': float(objects) / boxes}
+
+
+
+def loopbackSuite(boxSizes=(16, 1024, 65536), depths=(1, 16, 128),
+                  requests=1000, repeats=3):
+    """
+    Run L{benchmarkLoopback} for each box size and pipeline depth, C{repeats}
+    times each, after running it once to warm up, and keep the median of
+    each result.
+
+    @return: a C{dict} describing the Python this was run on, and with a
+        C{'results'} key for a C{list} of C{dict}s, one for each box size and
+        depth in turn, with those and the results of L{benchmarkLoopback}.
+    """
+    benchmarkLoopback(requests=requests)
+    results = []
+    for boxSize in boxSizes:
+        for depth in depths:
+            runs = [benchmarkLoopback(boxSize, depth, requests)
+                    for i in range(repeats)]
+            result = {'boxSize': boxSize, 'depth': depth,
+                      'requests': requests}
+            for key in runs[0]:
+                values = sorted([run[key] for run in runs])
+                result[key] = values[len(values) // 2]
+            results.append(result)
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'repeats': repeats,
+            'results': results}
+
+
+
+def _echoClient(port, requests, results):
+    """
+    Send C{requests} L{Echo} commands to C{port}, one after another, and put
+    the time taken on C{results}.  This is the body of each client process
+    used by L{benchmarkWorkers}.
+    """
+    skt = socket.create_connection(('127.0.0.1', port))
+    skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    start = time.time()
+    for i in range(requests):
+        skt.sendall(
+            '_command: echo\r\n_ask: %d\r\ntext: hello\r\n\r\n' % (i,))
+        received = ''
+        while not received.endswith('\r\n\r\n'):
+            data = skt.recv(4096)
+            if not data:
+                raise IOError("Connection lost")
+            received += data
+    results.put(time.time() - start)
+    skt.close()
+
+
+
+def _waitForPort(port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+        else:
+            return
+
+
+
+def benchmarkWorkers(workerCounts=(1, 2, 4), clients=8, requests=2000):
+    """
+    Measure the throughput of a L{epsilon.juicepool.JuiceWorkerPool} of each
+    size in C{workerCounts}, serving C{clients} client processes each sending
+    L{Echo} commands over loopback.  The pool can only scale as far as there
+    are cores to run it, and the clients, on.  Since this starts real
+    processes and takes seconds, only L{main} runs it, not the tests.
+
+    @return: a C{dict} mapping worker counts to requests per second.
+    """
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [_epsilonPath] + env.get('PYTHONPATH', '').split(os.pathsep))
+    results = {}
+    for workers in workerCounts:
+        pool = subprocess.Popen(
+            [sys.executable, '-m', 'epsilon.juicepool',
+             '--workers', str(workers), '--port', str(port),
+             '--interface', '127.0.0.1',
+             'epsilon.test.juicebench.EchoJuiceServerFactory'],
+            env=env, stderr=open(os.devnull, 'w'))
+        try:
+            _waitForPort(port)
+            # Give the rest of the workers a moment to start listening, too.
+            time.sleep(1)
+            times = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(
+                    target=_echoClient, args=(port, requests, times))
+                for i in range(clients)]
+            start = time.time()
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+            elapsed = time.time() - start
+        finally:
+            pool.send_signal(signal.SIGTERM)
+            pool.wait()
+        results['%d workers' % (workers,)] = clients * requests / elapsed
+    return results
+
+
+
+def report(label, results, unit='boxes/s'):
+    """
+    Print the results of one benchmark on one line.
+    """
+    print('%s: %s' % (
+        label, ', '.join([('%s %d %s' % (name, value, unit)).rstrip()
+                          for (name, value) in sorted(results.items())])))
+
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv == ['--json']:
+        print(json.dumps(loopbackSuite(), indent=2, sort_keys=True))
+        return
+    for segmentSize in (16, 1460, 65536):
+        report('parse, %d-byte segments' % (segmentSize,),
+               benchmarkParse(segmentSize=segmentSize))
+    report('parse, 1MiB bodies',
+           benchmarkParse(boxes=20, segmentSize=16384, headers=2,
+                          bodySize=1024 * 1024))
+    for headers in (2, 8, 32):
+        report('serialize, %d headers' % (headers,),
+               benchmarkSerialize(headers=headers))
+    report('size', frameSizes(), 'bytes/box')
+    for headers in (0, 2, 8, 32):
+        report('memory, %d headers' % (headers,),
+               boxMemory(headers=headers), 'bytes/box')
+    report('marshal', benchmarkMarshal(), 'round trips/s')
+    report('ListOf, 10000 items', benchmarkListOf(), 'lists/s')
+    report('binary arguments, 64KiB', benchmarkBinary(), '')
+    for result in loopbackSuite()['results']:
+        report('loopback, %(boxSize)d-byte boxes, depth %(depth)d' % result,
+               {'boxes/s': result['boxesPerSecond'],
+                'bytes/s': result['bytesPerSecond'],
+                'p50 us': result['latencyP50'] * 1e6,
+                'p99 us': result['latencyP99'] * 1e6,
+                'objects/box': result['objectsPerBox']}, '')
+    report('worker pool, %d cores' % (multiprocessing.cpu_count(),),
+           benchmarkWorkers(), 'requests/s')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# -*- test-case-name: epsilon.test.test_amprouter -*-
+# Copyright (c) 2008 Divmod.  See LICENSE for details.
+
+"""
+Microbenchmarks for L{epsilon.amprouter}.
+
+Run C{python -m epsilon.test.routerbench} to print the results of every
+benchmark in this module.
+"""
+
+import random
+
+from epsilon.amprouter import _ROUTE, DROP, Router
+from epsilon.test.juicebench import timed, report
+
+
+class _NullSender:
+    """
+    An L{IBoxSender} which throws away the boxes sent to it.
+    """
+    def sendBox(self, box):
+        pass
+
+
+    def unhandledError(self, failure):
+        pass
+
+
+
+class _RouterSender:
+    """
+    An L{IBoxSender} which delivers the boxes sent to it to a L{Router}, as
+    the other end of a connection would.
+    """
+    def __init__(self, router):
+        self.router = router
+
+
+    def sendBox(self, box):
+        self.router.ampBoxReceived(box)
+
+
+    def unhandledError(self, failure):
+        pass
+
+
+
+class _CountingReceiver:
+    """
+    An L{IBoxReceiver} which counts the boxes delivered to it.
+    """
+    boxes = 0
+
+    def startReceivingBoxes(self, sender):
+        self.sender = sender
+
+
+    def ampBoxReceived(self, box):
+        self.boxes += 1
+
+
+    def stopReceivingBoxes(self, reason):
+        pass
+
+
+
+def _legacySend(route, box):
+    """
+    Send C{box} through C{route} the way L{Route.sendBox} did before route
+    names were encoded in advance, to measure against.
+    """
+    box[_ROUTE] = route.remoteRouteName.encode('ascii')
+    route.router._sender.sendBox(box)
+
+
+
+def _legacyReceive(router, box):
+    """
+    Deliver C{box} the way L{Router.ampBoxReceived} did before unknown routes
+    were handled, to measure against.
+    """
+    route = box.pop(_ROUTE, None)
+    router._routes[route].receiver.ampBoxReceived(box)
+
+
+
+def benchmarkRouter(routes=10000, boxes=100000, hot=0.01, hotShare=0.8,
+                    unknownShare=0.01):
+    """
+    Measure how quickly boxes are sent and received through a router with
+    C{routes} routes, the C{hot} fraction of which carry C{hotShare} of the
+    traffic, before and after route names were encoded in advance, and with
+    metrics recorded.  Boxes received are also measured with C{unknownShare}
+    of them for routes which are not bound, and dropped.
+
+    @return: a C{dict} mapping kinds of traffic to boxes per second.
+    """
+    def makeRouter(**kw):
+        router = Router(unknownRoute=DROP, **kw)
+        router.startReceivingBoxes(_NullSender())
+        bound = []
+        for i in range(routes):
+            route = router.bindRoute(_CountingReceiver())
+            route.connectTo(u'remote%d' % (i,))
+            bound.append(route)
+        return router, bound
+    router, bound = makeRouter()
+
+    rand = random.Random(0)
+    hotRoutes = max(1, int(routes * hot))
+    def pick():
+        if rand.random() < hotShare:
+            return rand.randrange(hotRoutes)
+        return rand.randrange(routes)
+    traffic = [pick() for i in range(boxes)]
+
+    def sendAll(send, bound=bound):
+        for i in traffic:
+            send(bound[i], {'_command': 'ping', '_ask': '1'})
+    def received(unknownShare):
+        # Route names as a parser would produce them: new strings each time.
+        result = []
+        for i in traffic:
+            if rand.random() < unknownShare:
+                name = 'unknown%d' % (i,)
+            else:
+                name = '%d' % (i,)
+            result.append({_ROUTE: name, '_command': 'ping', '_ask': '1'})
+        return result
+    def receiveAll(receive, boxes):
+        for box in boxes:
+            receive(box)
+
+    results = {}
+    results['send'] = boxes / max(timed(
+            lambda: sendAll(lambda route, box: route.sendBox(box)), 1), 1e-9)
+    results['send, before'] = boxes / max(timed(
+            lambda: sendAll(_legacySend), 1), 1e-9)
+    incoming = received(0)
+    results['receive'] = boxes / max(timed(
+            lambda: receiveAll(router.ampBoxReceived, incoming), 1), 1e-9)
+    incoming = received(0)
+    results['receive, before'] = boxes / max(timed(
+            lambda: receiveAll(
+                lambda box: _legacyReceive(router, box), incoming), 1), 1e-9)
+    incoming = received(unknownShare)
+    results['receive, %d%% unknown' % (unknownShare * 100,)] = boxes / max(
+        timed(lambda: receiveAll(router.ampBoxReceived, incoming), 1), 1e-9)
+
+    metered, meteredBound = makeRouter(recordMetrics=True)
+    results['send, recording metrics'] = boxes / max(timed(
+            lambda: sendAll(lambda route, box: route.sendBox(box),
+                            meteredBound), 1), 1e-9)
+    incoming = received(0)
+    results['receive, recording metrics'] = boxes / max(timed(
+            lambda: receiveAll(metered.ampBoxReceived, incoming), 1), 1e-9)
+    return results
+
+
+
+def benchmarkRouteChurn(routes=10000, cycles=100000):
+    """
+    Measure how quickly short-lived routes are bound and unbound while
+    C{routes} others are bound, by a router which creates compact route
+    identifiers and by one which counts in decimal, and how long the
+    identifiers are by the end.  Each router is connected to another, which
+    acknowledges the routes unbound.
+
+    @return: a C{dict} mapping the kinds of identifier to routes per second,
+        and to the number of bytes in the last identifier created.
+    """
+    results = {}
+    for name, compact in [('decimal', False), ('compact', True)]:
+        router = Router(compactRouteIds=compact)
+        peer = Router()
+        peer.startReceivingBoxes(_RouterSender(router))
+        router.startReceivingBoxes(_RouterSender(peer))
+        receiver = _CountingReceiver()
+        bound = [router.bindRoute(receiver) for i in range(routes)]
+        def churn():
+            for i in range(cycles):
+                bound[i % routes].unbind()
+                bound[i % routes] = router.bindRoute(receiver)
+        results[name + ' routes/s'] = cycles / max(timed(churn, 1), 1e-9)
+        results[name + ' name bytes'] = len(bound[(cycles - 1) % routes]
+                                            .localRouteName)
+    return results
+
+
+
+def main():
+    report('router, 10000 routes', benchmarkRouter())
+    report('route churn, 10000 routes', benchmarkRouteChurn(), '')
+
+
+
+if __name__ == '__main__':
+    main()
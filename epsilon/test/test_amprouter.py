@@ -4,14 +4,24 @@
 Tests for L{epsilon.amprouter}.
 """
 
+from weakref import WeakSet
+
 from zope.interface import implements
 from zope.interface.verify import verifyObject
 
+from twisted.python import log
 from twisted.python.failure import Failure
+from twisted.internet.task import Clock
 from twisted.protocols.amp import IBoxReceiver, IBoxSender
 from twisted.trial.unittest import TestCase
 
-from epsilon.amprouter import _ROUTE, RouteNotConnected, Router
+from epsilon import amprouter
+from epsilon.amprouter import (
+    _ROUTE, _CREDIT, _UNKNOWN, _UNKNOWN_ROUTE, _CONTROL, _FLOW_CONTROL,
+    _RELEASE_ROUTE, _ROUTE_RELEASED, _ROUTE_RELEASES, RouteNotConnected,
+    Router,
+    RAISE, DROP, ANSWER_ERROR, BUFFER)
+from epsilon.test import routerbench
 
 
 class SomeReceiver:
@@ -85,6 +95,58 @@ class CollectingSender:
 
 
 
+class RouterSender(CollectingSender):
+    """
+    An L{IBoxSender} which delivers the boxes sent to it to a L{Router}, as
+    well as saving them.
+
+    @ivar router: The L{Router} to deliver boxes to.
+
+    @ivar held: The boxes sent before C{router} was started, which are
+        delivered by L{deliverHeld}.
+    """
+    def __init__(self, router):
+        CollectingSender.__init__(self)
+        self.router = router
+        self.held = []
+
+
+    def sendBox(self, box):
+        CollectingSender.sendBox(self, box)
+        if self.router._sender is None:
+            self.held.append(box.copy())
+        else:
+            self.router.ampBoxReceived(box.copy())
+
+
+    def deliverHeld(self):
+        held, self.held = self.held, []
+        for box in held:
+            self.router.ampBoxReceived(box)
+
+
+
+def connectRouters(client, server):
+    """
+    Start C{client} and C{server}, each sending the boxes sent through it to
+    the other, as the two ends of a connection would.
+    """
+    toServer = RouterSender(server)
+    client.startReceivingBoxes(toServer)
+    server.startReceivingBoxes(RouterSender(client))
+    toServer.deliverHeld()
+
+
+
+def negotiate(router, credit=Router.initialCredit):
+    """
+    Tell C{router} that the router on the other end of its connection applies
+    flow control, with C{credit} initial credit for each route.
+    """
+    router.ampBoxReceived({_ROUTE: _CONTROL, _FLOW_CONTROL: str(credit)})
+
+
+
 class RouteTests(TestCase):
     """
     Tests for L{Route}, the L{IBoxSender} which handles adding routing
@@ -162,6 +224,19 @@ class RouteTests(TestCase):
             RouteNotConnected, self.route.sendBox, {'foo': 'bar'})
 
 
+    def test_sendBoxInterned(self):
+        """
+        L{Route.sendBox} adds the same, interned, route name to every box.
+        """
+        self.route.connectTo(u"bar")
+        self.route.sendBox({})
+        self.route.sendBox({})
+        first, second = self.sender.boxes
+        self.assertIdentical(first[_ROUTE], second[_ROUTE])
+        self.assertIdentical(first[_ROUTE], intern("bar"))
+        self.assertIsInstance(first[_ROUTE], str)
+
+
     def test_unbind(self):
         """
         L{Route.unbind} removes the route from its router.
@@ -317,3 +392,850 @@ class RouterTests(TestCase):
 
         self.assertTrue(receiver.stopped)
         receiver.reason.trap(DummyException)
+
+
+
+class FlowControlTests(TestCase):
+    """
+    Tests for the flow control applied by a L{Router} created with a window.
+    """
+    def setUp(self):
+        """
+        Create a started router with flow control, and a route connected
+        through it.
+        """
+        self.clock = Clock()
+        self.sender = CollectingSender()
+        self.router = Router(window=Router.initialCredit, clock=self.clock)
+        self.router.startReceivingBoxes(self.sender)
+        negotiate(self.router)
+        del self.sender.boxes[:]
+        self.receiver = SomeReceiver()
+        self.route = self.router.bindRoute(self.receiver, 'local')
+        self.route.connectTo('remote')
+
+
+    def test_smallWindow(self):
+        """
+        L{Router} raises L{ValueError} if its window is smaller than
+        L{Router.initialCredit}.
+        """
+        self.assertRaises(
+            ValueError, Router, window=Router.initialCredit - 1,
+            clock=self.clock)
+
+
+    def test_queued(self):
+        """
+        Boxes sent through a route are passed to the router's sender once the
+        reactor has had a turn.
+        """
+        self.route.sendBox({'foo': 'bar'})
+        self.assertEqual(self.sender.boxes, [])
+        self.clock.advance(0)
+        self.assertEqual(
+            self.sender.boxes, [{_ROUTE: 'remote', 'foo': 'bar'}])
+
+
+    def test_credit(self):
+        """
+        A route sends no more than L{Router.initialCredit} boxes until it is
+        granted more credit, and then as many more as it was granted.
+        """
+        for i in range(Router.initialCredit + 5):
+            self.route.sendBox({'n': str(i)})
+        self.clock.advance(0)
+        self.assertEqual(len(self.sender.boxes), Router.initialCredit)
+        self.router.ampBoxReceived({_ROUTE: 'local', _CREDIT: '3'})
+        self.clock.advance(0)
+        self.assertEqual(len(self.sender.boxes), Router.initialCredit + 3)
+        self.assertEqual(self.receiver.boxes, [])
+        self.assertEqual(
+            [box['n'] for box in self.sender.boxes],
+            [str(i) for i in range(Router.initialCredit + 3)])
+
+
+    def test_grantWindow(self):
+        """
+        A route started by a router with a window larger than
+        L{Router.initialCredit} grants the difference to the other end of the
+        connection.
+        """
+        router = Router(window=Router.initialCredit + 10, clock=self.clock)
+        router.startReceivingBoxes(self.sender)
+        negotiate(router)
+        router.bindRoute(SomeReceiver(), 'a').connectTo('b')
+        self.assertEqual(
+            self.sender.boxes,
+            [{_ROUTE: _CONTROL, _FLOW_CONTROL: str(Router.initialCredit)},
+             {_ROUTE: 'b', _CREDIT: '10'}])
+
+
+    def test_grantConsumed(self):
+        """
+        Once half of its window of boxes has been delivered through a route,
+        the router grants that much credit to the other end of the
+        connection.
+        """
+        half = Router.initialCredit // 2
+        for i in range(half - 1):
+            self.router.ampBoxReceived({_ROUTE: 'local', 'n': str(i)})
+        self.assertEqual(self.sender.boxes, [])
+        self.router.ampBoxReceived({_ROUTE: 'local', 'n': 'last'})
+        self.assertEqual(
+            self.sender.boxes, [{_ROUTE: 'remote', _CREDIT: str(half)}])
+        self.assertEqual(len(self.receiver.boxes), half)
+
+
+    def test_negotiated(self):
+        """
+        A started L{Router} with a window tells the router on the other end
+        of the connection its initial credit, and routes send nothing, and
+        grant no credit, until that router has said the same.
+        """
+        sender = CollectingSender()
+        router = Router(window=Router.initialCredit + 10, clock=self.clock)
+        router.startReceivingBoxes(sender)
+        self.assertEqual(
+            sender.boxes,
+            [{_ROUTE: _CONTROL, _FLOW_CONTROL: str(Router.initialCredit)}])
+        del sender.boxes[:]
+        route = router.bindRoute(SomeReceiver(), 'a')
+        route.connectTo('b')
+        for i in range(3):
+            route.sendBox({'n': str(i)})
+        self.clock.advance(0)
+        self.assertEqual(sender.boxes, [])
+        negotiate(router, 2)
+        self.clock.advance(0)
+        self.assertEqual(
+            sender.boxes,
+            [{_ROUTE: 'b', _CREDIT: '10'},
+             {_ROUTE: 'b', 'n': '0'}, {_ROUTE: 'b', 'n': '1'}])
+
+
+    def test_unbindAfterSend(self):
+        """
+        Credit granted for a route after it has been unbound is ignored,
+        whatever the policy for unknown routes.
+        """
+        for i in range(Router.initialCredit // 2):
+            self.route.sendBox({'n': str(i)})
+        self.clock.advance(0)
+        self.route.unbind()
+        self.router.ampBoxReceived(
+            {_ROUTE: 'local', _CREDIT: str(Router.initialCredit // 2)})
+        self.assertEqual(self.router.unknownRouteBoxes, 0)
+
+
+    def test_peerWithoutFlowControl(self):
+        """
+        A L{Router} with a window connected to one without stops applying
+        flow control, sending the boxes it queued, and neither sends credit
+        to the other.
+        """
+        for windowFirst in [True, False]:
+            windowed = Router(window=Router.initialCredit, clock=self.clock)
+            plain = Router()
+            windowedReceiver = SomeReceiver()
+            plainReceiver = SomeReceiver()
+            windowed.bindRoute(windowedReceiver, 'w').connectTo('p')
+            if windowFirst:
+                connectRouters(windowed, plain)
+            else:
+                connectRouters(plain, windowed)
+            plain.bindRoute(plainReceiver, 'p').connectTo('w')
+            for i in range(Router.initialCredit * 2):
+                windowedReceiver.sender.sendBox({'n': str(i)})
+                plainReceiver.sender.sendBox({'n': str(i)})
+            self.clock.advance(0)
+            self.assertIdentical(windowed.window, None)
+            for receiver in windowedReceiver, plainReceiver:
+                self.assertEqual(
+                    receiver.boxes,
+                    [{'n': str(i)} for i in range(Router.initialCredit * 2)])
+            self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_roundRobin(self):
+        """
+        Routes with queued boxes take turns to send them, so that a box sent
+        through a quiet route is not held up behind those of a busy one.
+        """
+        self.router.quantum = 10
+        quiet = self.router.bindRoute(SomeReceiver(), 'quiet')
+        quiet.connectTo('quiet')
+        for i in range(10):
+            self.route.sendBox({'n': str(i)})
+        quiet.sendBox({'n': 'q'})
+        self.clock.advance(0)
+        self.assertEqual(
+            [box['n'] for box in self.sender.boxes[:3]], ['0', 'q', '1'])
+
+
+    def test_deficit(self):
+        """
+        A route whose boxes are bigger than L{Router.quantum} sends one every
+        few turns, so that routes get equal shares of bytes rather than of
+        boxes.
+        """
+        self.router.quantum = 20
+        small = self.router.bindRoute(SomeReceiver(), 'small')
+        small.connectTo('s')
+        for i in range(3):
+            # With its route, each of these boxes is
+            # 2 + (4 + 1 + 2) + (4 + 4 + 40) + (4 + 6 + 6) = 73 bytes, nearly
+            # four turns' worth.
+            self.route.sendBox({'n': 'b' + str(i), 'data': 'x' * 40})
+        for i in range(10):
+            # Each of these is 2 + (4 + 1 + 2) + (4 + 6 + 1) = 20 bytes.
+            small.sendBox({'n': 's' + str(i)})
+        self.clock.advance(0)
+        self.assertEqual(
+            [box['n'] for box in self.sender.boxes[:9]],
+            ['s0', 's1', 's2', 'b0', 's3', 's4', 's5', 's6', 'b1'])
+
+
+    def test_unbind(self):
+        """
+        Boxes queued for a route which is unbound are not sent.
+        """
+        self.route.sendBox({'foo': 'bar'})
+        self.route.unbind()
+        self.clock.advance(0)
+        self.assertEqual(self.sender.boxes, [])
+
+
+    def test_stopReceivingBoxes(self):
+        """
+        Queued boxes are not sent once the router has been stopped.
+        """
+        self.route.sendBox({'foo': 'bar'})
+        self.router.stopReceivingBoxes(Failure(RuntimeError("stopped")))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_connected(self):
+        """
+        Two routers with flow control connected to each other deliver all of
+        the boxes sent through a route, granting each other credit as they
+        go.
+        """
+        client = Router(window=Router.initialCredit * 2, clock=self.clock)
+        server = Router(window=Router.initialCredit * 2, clock=self.clock)
+        connectRouters(client, server)
+        clientReceiver = SomeReceiver()
+        serverReceiver = SomeReceiver()
+        clientRoute = client.bindRoute(clientReceiver, 'c')
+        serverRoute = server.bindRoute(serverReceiver, 's')
+        clientRoute.connectTo('s')
+        serverRoute.connectTo('c')
+        for i in range(200):
+            clientReceiver.sender.sendBox({'n': str(i)})
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        self.assertEqual(
+            [box['n'] for box in serverReceiver.boxes],
+            [str(i) for i in range(200)])
+
+
+
+class UnknownRouteTests(TestCase):
+    """
+    Tests for the handling of boxes received by a L{Router} for routes which
+    are not bound.
+    """
+    def router(self, policy):
+        """
+        Return a started router with the given unknown route policy.
+        """
+        router = Router(unknownRoute=policy)
+        router.startReceivingBoxes(self.sender)
+        return router
+
+
+    def setUp(self):
+        self.sender = CollectingSender()
+
+
+    def test_invalidPolicy(self):
+        """
+        L{Router} raises L{ValueError} if given an unknown policy.
+        """
+        self.assertRaises(ValueError, Router, unknownRoute='ignore')
+
+
+    def test_raise(self):
+        """
+        By default, L{Router.ampBoxReceived} raises L{KeyError} for a box for
+        an unknown route.
+        """
+        router = Router()
+        self.assertEqual(router.unknownRoute, RAISE)
+        router.startReceivingBoxes(self.sender)
+        self.assertRaises(
+            KeyError, router.ampBoxReceived, {_ROUTE: 'nowhere'})
+
+
+    def test_drop(self):
+        """
+        A L{Router} whose policy is L{DROP} ignores boxes for unknown routes,
+        counting them.
+        """
+        router = self.router(DROP)
+        router.ampBoxReceived({_ROUTE: 'nowhere', '_ask': '1'})
+        self.assertEqual(self.sender.boxes, [])
+        self.assertEqual(router.unknownRouteBoxes, 1)
+
+
+    def test_answerError(self):
+        """
+        A L{Router} whose policy is L{ANSWER_ERROR} answers boxes for unknown
+        routes which ask questions with an error, and drops the rest.
+        """
+        router = self.router(ANSWER_ERROR)
+        router.ampBoxReceived({_ROUTE: 'nowhere', '_command': 'x'})
+        self.assertEqual(self.sender.boxes, [])
+        router.ampBoxReceived(
+            {_ROUTE: 'nowhere', '_command': 'x', '_ask': '7'})
+        box, = self.sender.boxes
+        self.assertEqual(box['_error'], '7')
+        self.assertEqual(box['_error_code'], 'UNKNOWN')
+        self.assertEqual(router.unknownRouteBoxes, 2)
+
+
+    def test_errorDelivered(self):
+        """
+        The error answered by a L{Router} whose policy is L{ANSWER_ERROR} is
+        delivered by the router which sent the question to the route which
+        sent it.
+        """
+        client = Router()
+        server = Router(unknownRoute=ANSWER_ERROR)
+        connectRouters(client, server)
+        receiver = SomeReceiver()
+        client.bindRoute(SomeReceiver(), 'other').connectTo('elsewhere')
+        client.bindRoute(receiver, 'c').connectTo('nowhere')
+        receiver.sender.sendBox({'_command': 'x', '_ask': '3'})
+        self.assertEqual(
+            receiver.boxes,
+            [{'_error': '3', '_error_code': 'UNKNOWN',
+              '_error_description': "Unknown route 'nowhere'"}])
+
+
+    def test_buffer(self):
+        """
+        A L{Router} whose policy is L{BUFFER} delivers boxes for unknown
+        routes once a route with their name has been started.
+        """
+        router = self.router(BUFFER)
+        router.ampBoxReceived({_ROUTE: 'later', 'n': '1'})
+        router.ampBoxReceived({_ROUTE: 'later', 'n': '2'})
+        receiver = SomeReceiver()
+        route = router.bindRoute(receiver, 'later')
+        self.assertEqual(receiver.boxes, [])
+        route.connectTo('there')
+        self.assertEqual(receiver.boxes, [{'n': '1'}, {'n': '2'}])
+        router.ampBoxReceived({_ROUTE: 'later', 'n': '3'})
+        self.assertEqual(len(receiver.boxes), 3)
+
+
+    def test_bufferUnstarted(self):
+        """
+        A L{Router} whose policy is L{BUFFER} delivers boxes for routes which
+        are bound but not started once they are started.
+        """
+        router = self.router(BUFFER)
+        receiver = SomeReceiver()
+        route = router.bindRoute(receiver, 'later')
+        router.ampBoxReceived({_ROUTE: 'later', 'n': '1'})
+        self.assertEqual(router.unknownRouteBoxes, 0)
+        route.connectTo('there')
+        self.assertEqual(receiver.boxes, [{'n': '1'}])
+
+
+    def test_bufferRouteLimit(self):
+        """
+        Boxes for a route which already has
+        L{Router.maxEarlyBoxesPerRoute} boxes held on to are evicted, and
+        answered with an error if they ask a question.
+        """
+        router = self.router(BUFFER)
+        router.maxEarlyBoxesPerRoute = 2
+        for i in range(3):
+            router.ampBoxReceived({_ROUTE: 'later', 'n': str(i)})
+        router.ampBoxReceived({_ROUTE: 'later', '_ask': '9'})
+        self.assertEqual(router.earlyBoxesEvicted, 2)
+        self.assertEqual(
+            [box['_error'] for box in self.sender.boxes], ['9'])
+        receiver = SomeReceiver()
+        router.bindRoute(receiver, 'later').connectTo('there')
+        self.assertEqual(receiver.boxes, [{'n': '0'}, {'n': '1'}])
+
+
+    def test_bufferLimit(self):
+        """
+        When more than L{Router.maxEarlyBoxes} boxes would be held on to, all
+        of the boxes for the route which has had boxes held on to for longest
+        are evicted.
+        """
+        router = self.router(BUFFER)
+        router.maxEarlyBoxes = 3
+        router.ampBoxReceived({_ROUTE: 'first', 'n': '1'})
+        router.ampBoxReceived({_ROUTE: 'second', 'n': '2'})
+        router.ampBoxReceived({_ROUTE: 'first', '_ask': '3'})
+        self.assertEqual(router.earlyBoxesEvicted, 0)
+        router.ampBoxReceived({_ROUTE: 'third', 'n': '4'})
+        self.assertEqual(router.earlyBoxesEvicted, 2)
+        self.assertEqual(
+            [box['_error'] for box in self.sender.boxes], ['3'])
+        receivers = {}
+        for name in ['first', 'second', 'third']:
+            receivers[name] = SomeReceiver()
+            router.bindRoute(receivers[name], name).connectTo(name)
+        self.assertEqual(receivers['first'].boxes, [])
+        self.assertEqual(receivers['second'].boxes, [{'n': '2'}])
+        self.assertEqual(receivers['third'].boxes, [{'n': '4'}])
+
+
+    def test_bufferStopped(self):
+        """
+        Boxes held on to are discarded when the router is stopped.
+        """
+        router = self.router(BUFFER)
+        router.ampBoxReceived({_ROUTE: 'later', 'n': '1'})
+        router.stopReceivingBoxes(Failure(RuntimeError("stopped")))
+        self.assertEqual(router._early, {})
+        self.assertEqual(router._earlyBoxes, 0)
+
+
+    def test_pipelined(self):
+        """
+        With routers whose policy is L{BUFFER}, a peer may send boxes through
+        a route before the other end has bound it, and flow control credit
+        granted before the other end has bound a route is not lost.
+        """
+        clock = Clock()
+        client = Router(
+            window=Router.initialCredit * 2, clock=clock, unknownRoute=BUFFER)
+        server = Router(
+            window=Router.initialCredit * 2, clock=clock, unknownRoute=BUFFER)
+        connectRouters(client, server)
+        clientReceiver = SomeReceiver()
+        client.bindRoute(clientReceiver, 'c').connectTo('s')
+        for i in range(Router.initialCredit * 3):
+            clientReceiver.sender.sendBox({'n': str(i)})
+        clock.advance(0)
+        serverReceiver = SomeReceiver()
+        server.bindRoute(serverReceiver, 's').connectTo('c')
+        while clock.getDelayedCalls():
+            clock.advance(0)
+        self.assertEqual(
+            [box['n'] for box in serverReceiver.boxes],
+            [str(i) for i in range(Router.initialCredit * 3)])
+        self.assertEqual(client.earlyBoxesEvicted, 0)
+        self.assertEqual(server.earlyBoxesEvicted, 0)
+
+
+
+class MetricsTests(TestCase):
+    """
+    Tests for the traffic recorded by a L{Router} created with
+    C{recordMetrics}.
+    """
+    def setUp(self):
+        """
+        Create a started router which records metrics, and a route connected
+        through it.
+        """
+        self.clock = Clock()
+        self.sender = CollectingSender()
+        self.router = Router(clock=self.clock, recordMetrics=True)
+        self.router.startReceivingBoxes(self.sender)
+        self.route = self.router.bindRoute(SomeReceiver(), 'local')
+        self.route.connectTo('remote')
+
+
+    def test_notRecorded(self):
+        """
+        A L{Router} created without C{recordMetrics} records nothing.
+        """
+        router = Router()
+        router.startReceivingBoxes(self.sender)
+        route = router.bindRoute(SomeReceiver())
+        route.connectTo('remote')
+        route.sendBox({'foo': 'bar'})
+        self.assertIdentical(route.metrics(), None)
+        self.assertIdentical(router.metrics(), None)
+        self.assertEqual(router.topRoutes(), [])
+
+
+    def test_route(self):
+        """
+        L{Route.metrics} returns the number of boxes and bytes, not counting
+        the route name, sent and received through the route, and when it was
+        last active.
+        """
+        self.clock.advance(5)
+        self.route.sendBox({'foo': 'bar'})
+        self.clock.advance(5)
+        self.router.ampBoxReceived({_ROUTE: 'local', 'a': 'b'})
+        self.router.ampBoxReceived({_ROUTE: 'local', 'a': 'b'})
+        self.assertEqual(
+            self.route.metrics(),
+            {'route': 'local', 'boxesIn': 2, 'bytesIn': 16, 'boxesOut': 1,
+             'bytesOut': 12, 'queued': 0, 'lastActivity': 10.0})
+
+
+    def test_queued(self):
+        """
+        L{Route.metrics} includes the number of boxes queued to be sent
+        through a route of a router with flow control.
+        """
+        router = Router(window=Router.initialCredit, clock=self.clock,
+                        recordMetrics=True)
+        router.startReceivingBoxes(self.sender)
+        negotiate(router)
+        route = router.bindRoute(SomeReceiver())
+        route.connectTo('remote')
+        route.sendBox({})
+        route.sendBox({})
+        self.assertEqual(route.metrics()['queued'], 2)
+        self.assertEqual(router.metrics()['queued'], 2)
+        self.clock.advance(0)
+        self.assertEqual(route.metrics()['queued'], 0)
+
+
+    def test_router(self):
+        """
+        L{Router.metrics} returns the totals of the traffic through every
+        route, including those which have been unbound, and the numbers of
+        routes bound and unbound.
+        """
+        other = self.router.bindRoute(SomeReceiver(), 'other')
+        other.connectTo('elsewhere')
+        self.route.sendBox({'foo': 'bar'})
+        other.sendBox({'foo': 'bar'})
+        self.router.ampBoxReceived({_ROUTE: 'other', 'a': 'b'})
+        other.unbind()
+        self.assertIdentical(other.metrics(), None)
+        self.assertEqual(
+            self.router.metrics(),
+            {'routes': 1, 'routesBound': 2, 'routesUnbound': 1,
+             'boxesIn': 1, 'bytesIn': 8, 'boxesOut': 2, 'bytesOut': 24,
+             'queued': 0, 'unknownRouteBoxes': 0, 'earlyBoxesEvicted': 0})
+
+
+    def test_slotReused(self):
+        """
+        A route bound after another is unbound reuses its counters, starting
+        from zero.
+        """
+        slot = self.route._slot
+        self.route.sendBox({})
+        self.route.unbind()
+        route = self.router.bindRoute(SomeReceiver())
+        self.assertEqual(route._slot, slot)
+        self.assertEqual(route.metrics()['boxesOut'], 0)
+
+
+    def test_manyRoutes(self):
+        """
+        The router records the traffic of as many routes as are bound.
+        """
+        routes = [self.router.bindRoute(SomeReceiver()) for i in range(200)]
+        for route in routes:
+            route.connectTo(None)
+        routes[-1].sendBox({})
+        self.assertEqual(routes[-1].metrics()['boxesOut'], 1)
+        self.assertEqual(self.router.metrics()['routes'], 201)
+
+
+    def test_topRoutes(self):
+        """
+        L{Router.topRoutes} returns the metrics of the routes which have sent
+        and received the most bytes, busiest first.
+        """
+        for i, size in enumerate([10, 30, 20]):
+            route = self.router.bindRoute(SomeReceiver(), str(i))
+            route.connectTo(str(i))
+            route.sendBox({'data': 'x' * size})
+        self.assertEqual(
+            [result['route'] for result in self.router.topRoutes(2)],
+            ['1', '2'])
+
+
+    def test_processTopRoutes(self):
+        """
+        L{amprouter.topRoutes} returns the busiest routes of every router in
+        the process which records metrics, and L{amprouter.logTopRoutes} logs
+        them.
+        """
+        self.patch(amprouter, '_meteredRouters', WeakSet([self.router]))
+        other = Router(clock=self.clock, recordMetrics=True)
+        other.startReceivingBoxes(self.sender)
+        route = other.bindRoute(SomeReceiver(), 'busy')
+        route.connectTo('there')
+        route.sendBox({'data': 'x' * 1000})
+        self.route.sendBox({'data': 'x'})
+        top = amprouter.topRoutes(2)
+        self.assertEqual(
+            [(result['router'], result['route']) for result in top],
+            [(id(other), 'busy'), (id(self.router), 'local')])
+
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        amprouter.logTopRoutes(1)
+        lines = [''.join(message['message']) for message in messages]
+        self.assertEqual(len(lines), 2)
+        self.assertIn("route 'busy'", lines[1])
+
+
+
+class CompactRouteIdTests(TestCase):
+    """
+    Tests for the route identifiers created by a L{Router} created with
+    C{compactRouteIds}.
+    """
+    def setUp(self):
+        self.sender = CollectingSender()
+        self.router = self.startRouter(Router(compactRouteIds=True))
+
+
+    def startRouter(self, router):
+        """
+        Start C{router}, and agree to acknowledge its unbound routes, as the
+        router on the other end of its connection would.
+        """
+        router.startReceivingBoxes(self.sender)
+        self.assertEqual(self.sender.boxes,
+                         [{_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ask'}])
+        del self.sender.boxes[:]
+        router.ampBoxReceived({_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ok'})
+        return router
+
+
+    def acknowledge(self):
+        """
+        Acknowledge every route unbinding the router has told the other end
+        of its connection about, as the router on the other end would.
+        """
+        boxes, self.sender.boxes = self.sender.boxes, []
+        for box in boxes:
+            if box.get(_RELEASE_ROUTE) is not None:
+                self.router.ampBoxReceived({
+                        _ROUTE: _CONTROL,
+                        _ROUTE_RELEASED: box[_RELEASE_ROUTE]})
+
+
+    def test_compact(self):
+        """
+        L{Router.createRouteIdentifier} returns unique identifiers written
+        in base 64.
+        """
+        names = [self.router.createRouteIdentifier() for i in range(66)]
+        self.assertEqual(len(set(names)), 66)
+        self.assertEqual(names[:3], ['0', '1', '2'])
+        self.assertEqual(names[10], 'a')
+        self.assertEqual(names[63:], ['_', '10', '11'])
+
+
+    def test_reused(self):
+        """
+        The identifiers of routes which have been unbound are reused once the
+        other end of the connection has acknowledged it, least recently
+        released first.
+        """
+        routes = [self.router.bindRoute(SomeReceiver()) for i in range(4)]
+        routes[2].unbind()
+        routes[0].unbind()
+        self.assertEqual(
+            self.sender.boxes,
+            [{_ROUTE: _CONTROL, _RELEASE_ROUTE: '2'},
+             {_ROUTE: _CONTROL, _RELEASE_ROUTE: '0'}])
+        self.assertEqual(
+            self.router.bindRoute(SomeReceiver()).localRouteName, '4')
+        self.acknowledge()
+        self.assertEqual(
+            [self.router.bindRoute(SomeReceiver()).localRouteName
+             for i in range(3)],
+            ['2', '0', '5'])
+
+
+    def test_acknowledged(self):
+        """
+        A L{Router} acknowledges that a route of the router on the other end
+        of the connection was unbound, after any boxes it sent in reply to
+        boxes from the route, so that the identifier is released.
+        """
+        peer = Router(window=32, clock=Clock())
+        router = Router(window=32, clock=Clock(), compactRouteIds=True)
+        connectRouters(router, peer)
+        route = router.bindRoute(SomeReceiver())
+        route.connectTo('peer')
+        receiver = SomeReceiver()
+        peerRoute = peer.bindRoute(receiver, 'peer')
+        peerRoute.connectTo(route.localRouteName)
+        for i in range(16):
+            route.sendBox({'n': str(i)})
+        router._clock.advance(0)
+        route.unbind()
+        self.assertEqual(len(receiver.boxes), 16)
+        toRouter = peer._sender.boxes
+        self.assertEqual(
+            toRouter[-2:],
+            [{_ROUTE: route.localRouteName, _CREDIT: '16'},
+             {_ROUTE: _CONTROL, _ROUTE_RELEASED: route.localRouteName}])
+        self.assertEqual(
+            router.bindRoute(SomeReceiver()).localRouteName,
+            route.localRouteName)
+
+
+    def test_releasesAgreed(self):
+        """
+        Identifiers of routes unbound before the router on the other end of
+        the connection agrees to acknowledge unbound routes are not released
+        until it has agreed and acknowledged them.
+        """
+        router = Router(compactRouteIds=True)
+        router.startReceivingBoxes(self.sender)
+        self.router = router
+        routes = [router.bindRoute(SomeReceiver()) for i in range(3)]
+        routes[1].unbind()
+        routes[0].unbind()
+        self.assertEqual(
+            self.sender.boxes, [{_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ask'}])
+        self.acknowledge()
+        self.assertEqual(router.bindRoute(SomeReceiver()).localRouteName, '3')
+        router.ampBoxReceived({_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ok'})
+        self.assertEqual(
+            self.sender.boxes,
+            [{_ROUTE: _CONTROL, _RELEASE_ROUTE: '1'},
+             {_ROUTE: _CONTROL, _RELEASE_ROUTE: '0'}])
+        self.acknowledge()
+        self.assertEqual(
+            [router.bindRoute(SomeReceiver()).localRouteName
+             for i in range(3)],
+            ['1', '0', '4'])
+
+
+    def test_agreeToAcknowledge(self):
+        """
+        A L{Router} agrees to acknowledge unbound routes when the router on
+        the other end of the connection asks, whether or not it has
+        C{compactRouteIds} itself.
+        """
+        router = Router()
+        router.startReceivingBoxes(self.sender)
+        router.ampBoxReceived({_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ask'})
+        self.assertEqual(
+            self.sender.boxes, [{_ROUTE: _CONTROL, _ROUTE_RELEASES: 'ok'}])
+
+
+    def test_heldBoxesEvicted(self):
+        """
+        Boxes received for a route after it was unbound, and held on to, are
+        evicted when its identifier is released, rather than delivered to the
+        next route with the same identifier.
+        """
+        router = self.startRouter(
+            Router(unknownRoute=BUFFER, compactRouteIds=True))
+        self.router = router
+        route = router.bindRoute(SomeReceiver())
+        route.connectTo('remote')
+        route.unbind()
+        router.ampBoxReceived(
+            {_ROUTE: route.localRouteName, '_command': 'x', '_ask': '1'})
+        self.acknowledge()
+        self.assertEqual(router.earlyBoxesEvicted, 1)
+        self.assertEqual(
+            [box['_error'] for box in self.sender.boxes
+             if box[_ROUTE] == _UNKNOWN
+             and box[_UNKNOWN_ROUTE] == route.localRouteName],
+            ['1'])
+        second = SomeReceiver()
+        reused = router.bindRoute(second)
+        reused.connectTo('remote')
+        self.assertEqual(reused.localRouteName, route.localRouteName)
+        self.assertEqual(second.boxes, [])
+
+
+    def test_churn(self):
+        """
+        However many routes are bound and unbound, identifiers only grow as
+        long as is needed for the routes bound at once.
+        """
+        for i in range(1000):
+            self.router.bindRoute(SomeReceiver()).unbind()
+            self.acknowledge()
+        self.assertEqual(self.router.createRouteIdentifier(), '0')
+
+
+    def test_namedRoute(self):
+        """
+        Binding and unbinding a route with a name of its own does not reuse
+        or release an identifier.
+        """
+        route = self.router.bindRoute(SomeReceiver(), 'named')
+        route.unbind()
+        default = self.router.bindRoute(SomeReceiver(), None)
+        default.unbind()
+        self.assertEqual(self.sender.boxes, [])
+        self.assertEqual(
+            self.router.bindRoute(SomeReceiver()).localRouteName, '0')
+        self.assertEqual(
+            self.router.bindRoute(SomeReceiver()).localRouteName, '1')
+
+
+    def test_ampBoxReceived(self):
+        """
+        Boxes are delivered to routes with compact identifiers, and routes
+        reusing an identifier receive the boxes sent to it afterwards.
+        """
+        first = SomeReceiver()
+        route = self.router.bindRoute(first)
+        route.connectTo('remote')
+        self.router.ampBoxReceived({_ROUTE: route.localRouteName, 'n': '1'})
+        route.unbind()
+        self.acknowledge()
+        second = SomeReceiver()
+        reused = self.router.bindRoute(second)
+        reused.connectTo('remote')
+        self.assertEqual(reused.localRouteName, route.localRouteName)
+        self.router.ampBoxReceived({_ROUTE: reused.localRouteName, 'n': '2'})
+        self.assertEqual(first.boxes, [{'n': '1'}])
+        self.assertEqual(second.boxes, [{'n': '2'}])
+
+
+
+class BenchmarkTests(TestCase):
+    """
+    Run each benchmark in L{epsilon.test.routerbench} briefly, so that they
+    keep working.
+    """
+    def test_router(self):
+        """
+        L{routerbench.benchmarkRouter} reports rates for sending and
+        receiving, before and after route names were encoded in advance.
+        """
+        results = routerbench.benchmarkRouter(routes=100, boxes=100)
+        self.assertEqual(
+            sorted(results),
+            ['receive', 'receive, 1% unknown', 'receive, before',
+             'receive, recording metrics', 'send', 'send, before',
+             'send, recording metrics'])
+
+
+    def test_routeChurn(self):
+        """
+        L{routerbench.benchmarkRouteChurn} reports rates of binding and
+        unbinding routes, and identifier lengths, with and without compact
+        route identifiers.
+        """
+        results = routerbench.benchmarkRouteChurn(routes=10, cycles=100)
+        self.assertEqual(
+            sorted(results),
+            ['compact name bytes', 'compact routes/s',
+             'decimal name bytes', 'decimal routes/s'])
+        self.assertEqual(results['compact name bytes'], 1)
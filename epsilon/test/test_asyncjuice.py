@@ -0,0 +1,214 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{epsilon.asyncjuice}.
+"""
+
+from twisted.trial import unittest
+
+from epsilon import juice
+
+try:
+    from epsilon import asyncjuice
+except ImportError:
+    asyncjuice = None
+else:
+    asyncio = asyncjuice.asyncio
+
+from epsilon.test.test_juice import Hello, UnfriendlyGreeting, Square
+
+
+if asyncjuice is not None:
+    class HelloJuice(asyncjuice.AsyncJuice):
+        """
+        An L{asyncjuice.AsyncJuice} which answers L{Hello}, in a way chosen by
+        the greeting.
+        """
+        def command_HELLO(self, hello):
+            if hello == 'unfriendly':
+                raise UnfriendlyGreeting('unfriendly')
+            if hello == 'coroutine':
+                return asyncio.sleep(0, dict(hello='from a coroutine'))
+            if hello == 'crash':
+                1 // 0
+            if hello == 'never':
+                return asyncio.Future(loop=self.loop)
+            return dict(hello=hello)
+        command_HELLO.command = Hello
+
+        def command_SQUARE(self, number):
+            return dict(square=number * number)
+        command_SQUARE.command = Square
+
+
+
+class FakeTransport:
+    """
+    An C{asyncio} transport which records what is written to it.
+    """
+    closed = False
+
+    def __init__(self):
+        self.written = []
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def close(self):
+        self.closed = True
+
+
+
+class AsyncJuiceTest(unittest.TestCase):
+    """
+    Tests for L{asyncjuice.AsyncJuice} connected to another over a real
+    socket.
+    """
+    if asyncjuice is None:
+        skip = 'asyncio is not available'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        server = self.loop.run_until_complete(
+            self.loop.create_server(
+                lambda: HelloJuice(self.loop), '127.0.0.1', 0))
+        def stopServer():
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.addCleanup(stopServer)
+        port = server.sockets[0].getsockname()[1]
+        transport, self.client = self.loop.run_until_complete(
+            self.loop.create_connection(
+                lambda: HelloJuice(self.loop), '127.0.0.1', port))
+        self.addCleanup(transport.close)
+
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+
+    def test_command(self):
+        """
+        L{juice.Command.do} returns a future which has the response to the
+        command.
+        """
+        self.assertEqual(
+            self.wait(Hello(hello='world').do(self.client)),
+            {'hello': 'world'})
+
+
+    def test_sendCommand(self):
+        """
+        L{asyncjuice.AsyncJuice.sendCommand} returns a future which has the
+        response box.
+        """
+        box = self.wait(self.client.sendCommand('hello', hello='box'))
+        self.assertEqual(box['hello'], 'box')
+
+
+    def test_asynchronousResponder(self):
+        """
+        A responder may return a coroutine, whose result is the response.
+        """
+        self.assertEqual(
+            self.wait(Hello(hello='coroutine').do(self.client)),
+            {'hello': 'from a coroutine'})
+
+
+    def test_threaded(self):
+        """
+        The responders of threaded commands are run in the event loop's
+        executor, without the Twisted reactor.
+        """
+        self.assertEqual(
+            self.wait(Square(number=3).do(self.client)), {'square': 9})
+        pool = self.client.handlerPool
+        self.assertTrue(isinstance(pool, asyncjuice.LoopHandlerPool))
+        self.assertIdentical(pool.loop, self.loop)
+        self.assertEqual(pool.metrics()[Square]['completed'], 1)
+
+
+    def test_error(self):
+        """
+        If the responder raises an error which the command declares, the
+        future has that error.
+        """
+        future = Hello(hello='unfriendly').do(self.client)
+        self.assertRaises(UnfriendlyGreeting, self.wait, future)
+
+
+    def test_timeout(self):
+        """
+        Request timeouts are scheduled on the event loop.
+        """
+        self.client.requestTimeout = self.client.timeoutGranularity = 0.01
+        future = Hello(hello='never').do(self.client)
+        self.assertRaises(juice.RequestTimedOut, self.wait, future)
+        self.assertEqual(self.client.requestMetrics()['timedOut'], 1)
+
+
+    def test_connectionLost(self):
+        """
+        Commands awaiting answers when the connection is lost fail.
+        """
+        future = Hello(hello='never').do(self.client)
+        self.client.transport.loseConnection()
+        self.assertRaises(Exception, self.wait, future)
+
+
+
+class AsyncJuiceFramingTest(unittest.TestCase):
+    """
+    Tests for the framing used by L{asyncjuice.AsyncJuice}.
+    """
+    if asyncjuice is None:
+        skip = 'asyncio is not available'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.transport = FakeTransport()
+        self.proto = HelloJuice(self.loop)
+        self.proto.connection_made(self.transport)
+
+
+    def _received(self, parserType=juice.JuiceFrameParser):
+        boxes = []
+        parserType(boxes.append).dataReceived(''.join(self.transport.written))
+        return boxes
+
+
+    def test_negotiate(self):
+        """
+        L{asyncjuice.AsyncJuice} answers L{juice.Negotiate}, switching
+        framing after the answer, just as L{juice.Juice} does.
+        """
+        request = juice.Box(versions='2', _command='Negotiate', _ask='1')
+        serializer = juice.BinaryJuiceBoxSerializer()
+        hello = juice.Box(hello='binary', _command='hello', _ask='2')
+        self.proto.data_received(
+            request.serialize() + serializer.serialize(hello))
+        self.assertEqual(self.proto.protocolVersion, 2)
+        answer = self.transport.written.pop(0)
+        boxes = []
+        juice.JuiceFrameParser(boxes.append).dataReceived(answer)
+        self.assertEqual(boxes, [{'version': '2', '_answer': '1'}])
+        self.assertEqual(
+            self._received(juice.BinaryJuiceFrameParser),
+            [{'hello': 'binary', '_answer': '2'}])
+
+
+    def test_fatalError(self):
+        """
+        An unexpected error in a responder closes the transport, as it drops
+        a L{juice.Juice} connection.
+        """
+        self.proto.data_received(
+            juice.Box(hello='crash', _command='hello', _ask='1').serialize())
+        self.assertTrue(self.transport.closed)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
@@ -1,10 +1,15 @@
 # Copyright 2005 Divmod, Inc.  See LICENSE file for details
 
+import json
 
 from epsilon import juice
-from epsilon.test import iosim
+from epsilon.test import iosim, juicebench
 from twisted.trial import unittest
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task
+from twisted.internet.error import ConnectionLost
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 
 class TestProto(protocol.Protocol):
     def __init__(self, onConnLost, dataToSend):
@@ -199,6 +204,22 @@ World: this header is ignored
             p.flush()
             self.assertEqual(s.boxes[-1], jb)
 
+    def testLongBody(self):
+        """
+        Bodies longer than C{MAX_LENGTH} are delivered unless
+        C{maxBodyLength} is set.
+        """
+        s = LiteralJuice(True)
+        s.makeConnection(StringTransport())
+        body = 'x' * (juice.Juice.MAX_LENGTH * 2)
+        s.dataReceived(juice.Box(body=body).serialize())
+        self.assertEqual(s.boxes, [{juice.BODY: body}])
+        s = LiteralJuice(True)
+        s.maxBodyLength = 10
+        s.makeConnection(StringTransport())
+        self.assertRaises(juice.MalformedJuiceBox,
+                          s.dataReceived, juice.Box(body='x' * 11).serialize())
+
 SWITCH_CLIENT_DATA = 'Success!'
 SWITCH_SERVER_DATA = 'No, really.  Success.'
 
@@ -286,3 +307,2029 @@ class AppLevelTest(unittest.TestCase):
 
     def testProtocolSwitchDeferred(self):
         return self.testProtocolSwitch(switcher=DeferredSymmetricCommandProtocol)
+
+
+
+class FrameParserTest(unittest.TestCase):
+    """
+    Tests for L{juice.JuiceFrameParser}.
+    """
+    def setUp(self):
+        self.boxes = []
+        self.parser = juice.JuiceFrameParser(self.boxes.append)
+
+
+    def _serialize(self, *boxes):
+        return ''.join([juice.Box(**kw).serialize() for kw in boxes])
+
+
+    def _declareLength(self, length):
+        """
+        Return a header block with no headers which declares a body of
+        C{length} bytes.
+        """
+        return '-Length: %d\r\n\r\n' % (length,)
+
+
+    def test_singleChunk(self):
+        """
+        Several complete boxes delivered in one chunk are each parsed into a
+        L{juice.JuiceBox}.
+        """
+        data = self._serialize(dict(a='1'), dict(b='2', body='xyz'))
+        self.assertEqual(self.parser.dataReceived(data), '')
+        self.assertEqual(self.boxes, [{'a': '1'}, {'b': '2', 'body': 'xyz'}])
+        self.assertTrue(isinstance(self.boxes[0], juice.JuiceBox))
+
+
+    def test_byteAtATime(self):
+        """
+        Boxes split across arbitrarily small segments, including through the
+        header terminator and the body, are parsed the same way as if they
+        had arrived all at once.
+        """
+        data = self._serialize(
+            dict(hello='world', multi='a\r\nb'),
+            dict(body='blah\r\n\r\ntest'),
+            dict(tail='end'))
+        for i in range(len(data)):
+            self.parser.dataReceived(data[i])
+        self.assertEqual(
+            self.boxes,
+            [{'hello': 'world', 'multi': 'a\r\nb'},
+             {'body': 'blah\r\n\r\ntest'},
+             {'tail': 'end'}])
+        self.assertEqual(len(self.parser._buffer), 0)
+
+
+    def test_largeBody(self):
+        """
+        A body delivered in many segments after its headers is accumulated
+        and delivered intact, followed by the boxes which come after it.
+        """
+        body = ''.join([chr(i % 256) for i in range(100000)])
+        data = self._serialize(dict(a='b', body=body), dict(c='d'))
+        for i in range(0, len(data), 1000):
+            self.parser.dataReceived(data[i:i + 1000])
+        self.assertEqual(self.boxes, [{'a': 'b', 'body': body}, {'c': 'd'}])
+
+
+    def test_memoryviewBodies(self):
+        """
+        If C{memoryviewBodies} is set, bodies are delivered as
+        C{memoryview}s, whether or not they arrived along with their headers,
+        and such boxes serialize the same way as boxes with C{str} bodies.
+        """
+        self.parser.memoryviewBodies = True
+        data = self._serialize(dict(body='abc'), dict(body='defgh'))
+        self.parser.dataReceived(data[:-3])
+        self.parser.dataReceived(data[-3:])
+        self.assertEqual(len(self.boxes), 2)
+        for box in self.boxes:
+            self.assertTrue(isinstance(box['body'], memoryview))
+        self.assertEqual(
+            [box['body'].tobytes() for box in self.boxes], ['abc', 'defgh'])
+        self.assertEqual(self._serialize(*self.boxes), data)
+
+
+    def test_emptyBox(self):
+        """
+        A blank line where a header block is expected is delivered as an
+        empty box, as it was by the line-based parser.
+        """
+        self.parser.dataReceived('\r\n' + self._serialize(dict(a='b')))
+        self.assertEqual(self.boxes, [{}, {'a': 'b'}])
+
+
+    def test_malformed(self):
+        """
+        A header line without a separator raises L{juice.MalformedJuiceBox}.
+        """
+        self.assertRaises(
+            juice.MalformedJuiceBox,
+            self.parser.dataReceived, 'bogus\r\n\r\n')
+
+
+    def test_bodyTooLong(self):
+        """
+        A box whose body is longer than C{maxBodyLength} raises
+        L{juice.MalformedJuiceBox} as soon as its headers are parsed.
+        """
+        self.parser.maxBodyLength = 10
+        data = self._serialize(dict(body='x' * 10), dict(body='x' * 11))
+        self.assertRaises(
+            juice.MalformedJuiceBox,
+            self.parser.dataReceived, data[:-11])
+        self.assertEqual(self.boxes, [{'body': 'x' * 10}])
+
+
+    def test_declaredLengthTooLong(self):
+        """
+        A declared body length too large to allocate raises
+        L{juice.MalformedJuiceBox}, rather than being allocated.
+        """
+        self.parser.maxBodyLength = juice.Juice.MAX_LENGTH
+        self.assertRaises(
+            juice.MalformedJuiceBox,
+            self.parser.dataReceived, self._declareLength(4000000000) + 'xx')
+
+
+    def test_stop(self):
+        """
+        After L{juice.JuiceFrameParser.stop} is called while a box is being
+        delivered, no more boxes are delivered and the unconsumed bytes, along
+        with any received later, are returned.
+        """
+        def boxReceived(box):
+            self.boxes.append(box)
+            self.parser.stop()
+        self.parser.boxReceived = boxReceived
+        second = self._serialize(dict(b='c'))
+        self.assertEqual(
+            self.parser.dataReceived(self._serialize(dict(a='b')) + second),
+            second)
+        self.assertEqual(self.boxes, [{'a': 'b'}])
+        self.assertEqual(self.parser.dataReceived('more'), 'more')
+
+
+
+class BinaryFrameParserTest(FrameParserTest):
+    """
+    Tests for L{juice.BinaryJuiceFrameParser}.
+    """
+    def setUp(self):
+        self.boxes = []
+        self.parser = juice.BinaryJuiceFrameParser(self.boxes.append)
+
+
+    def _serialize(self, *boxes):
+        serializer = juice.BinaryJuiceBoxSerializer()
+        return ''.join([serializer.serialize(juice.Box(**kw))
+                        for kw in boxes])
+
+
+    def _declareLength(self, length):
+        return juice._binaryPair.pack(0, length)
+
+
+    def test_emptyBox(self):
+        """
+        A box with no headers and no body is delivered as an empty box.
+        """
+        self.parser.dataReceived(self._serialize(dict(), dict(a='b')))
+        self.assertEqual(self.boxes, [{}, {'a': 'b'}])
+
+
+    def test_malformed(self):
+        """
+        Keys and values are delivered exactly as they were sent, including
+        line breaks, separators and case which the text framing would have
+        escaped or converted.
+        """
+        box = {'Mixed-Case': 'a\r\n b', 'colon': ': \r\n\r\n', 'empty': ''}
+        self.parser.dataReceived(self._serialize(box))
+        self.assertEqual(self.boxes, [box])
+
+
+
+class HeaderTableFrameParserTest(BinaryFrameParserTest):
+    """
+    Tests for L{juice.HeaderTableJuiceFrameParser}.
+    """
+    def setUp(self):
+        self.boxes = []
+        self.parser = juice.HeaderTableJuiceFrameParser(self.boxes.append)
+        self.serializer = juice.HeaderTableJuiceBoxSerializer()
+
+
+    def _serialize(self, *boxes):
+        return ''.join([self.serializer.serialize(juice.Box(**kw))
+                        for kw in boxes])
+
+
+    def _declareLength(self, length):
+        return juice._headerOp.pack(juice._HEADER_END, 0, length)
+
+
+    def test_unknownIndexes(self):
+        """
+        A header or header name index which is not in the table raises
+        L{juice.MalformedJuiceBox}.
+        """
+        for data in [juice._headerIndex.pack(juice._HEADER_INDEXED, 0),
+                     juice._headerOp.pack(juice._HEADER_NAMED, 300, 1) + 'v']:
+            parser = juice.HeaderTableJuiceFrameParser(self.boxes.append)
+            self.assertRaises(juice.MalformedJuiceBox,
+                              parser.dataReceived, data)
+        self.assertEqual(self.boxes, [])
+
+
+    def test_repeatedHeaders(self):
+        """
+        Header names and short headers which have been sent before are sent
+        as indexes, and are parsed back into the same boxes.
+        """
+        box = dict(_command='hello', hello='world', _ask='1')
+        first = self._serialize(box)
+        box['_ask'] = '2'
+        second = self._serialize(box)
+        self.assertTrue(len(second) < len(first) / 2, (first, second))
+        self.parser.dataReceived(first + second)
+        self.assertEqual(
+            self.boxes,
+            [dict(box, _ask='1'), dict(box, _ask='2')])
+
+
+    def test_tableReplacement(self):
+        """
+        Once a table is full, each new entry replaces the oldest one, on
+        both ends.
+        """
+        self.patch(juice, '_NAME_TABLE_SIZE', 2)
+        self.patch(juice, '_HEADER_TABLE_SIZE', 2)
+        self.setUp()
+        boxes = [dict(a='1'), dict(b='2'), dict(c='3'), dict(a='1'),
+                 dict(b='2'), dict(c='4'), dict(c='3'), dict(a='5')]
+        for box in boxes:
+            self.parser.dataReceived(self._serialize(box))
+        self.assertEqual(self.boxes, boxes)
+
+
+    def test_unknownOpcode(self):
+        """
+        A header with an unknown opcode raises L{juice.MalformedJuiceBox}.
+        """
+        self.assertRaises(
+            juice.MalformedJuiceBox,
+            self.parser.dataReceived, '\x09\x00\x00\x00\x00\x00\x00')
+
+
+    def test_rejectedBoxChangesNothing(self):
+        """
+        A box which cannot be serialized neither adds its headers to the
+        tables nor leaves any of them in front of the next box, so the
+        tables on both ends stay in step.
+        """
+        for bad, exception in [
+            (('k' * 0x10000, 'value'), juice.MalformedJuiceBox),
+            (('number', 1), TypeError)]:
+            self.assertRaises(
+                exception, self.serializer.serialize,
+                OrderedBox([('good', 'x'), bad]))
+        data = self._serialize(dict(good='x'))
+        self.assertEqual(
+            data,
+            juice.HeaderTableJuiceBoxSerializer().serialize(
+                juice.Box(good='x')))
+        self.parser.dataReceived(data + self._serialize(dict(good='x')))
+        self.assertEqual(self.boxes, [dict(good='x')] * 2)
+
+
+
+class SerializerTest(unittest.TestCase):
+    """
+    Tests for L{juice.JuiceBoxSerializer}.
+    """
+    boxes = [
+        dict(simple='test'),
+        dict(simple='test', body='blah\r\n\r\ntesttest'),
+        dict(ceq=': ', crtest='test\r', lftest='hello\n'),
+        dict(newline='test\r\none\r\ntwo', newline2='test\r\none\r\n two'),
+        dict(_command='hello', _ask='1f', some_key='value'),
+        dict(body=memoryview(bytearray('memory'))),
+        dict()]
+
+    def test_sameAsSerialize(self):
+        """
+        L{juice.JuiceBoxSerializer.serialize} produces exactly the same bytes
+        as L{juice.JuiceBox.serialize}, whether or not its header name cache
+        is warm or overflowing.
+        """
+        for serializer in [juice.JuiceBoxSerializer(),
+                           juice.JuiceBoxSerializer(cacheSize=2)]:
+            for i in range(2):
+                for kw in self.boxes:
+                    box = juice.Box(**kw)
+                    self.assertEqual(serializer.serialize(box),
+                                     box.serialize())
+
+
+    def test_serializeInto(self):
+        """
+        L{juice.JuiceBoxSerializer.serializeInto} appends to the given
+        C{bytearray}.
+        """
+        buf = bytearray('prefix')
+        boxes = [juice.Box(**kw) for kw in self.boxes]
+        serializer = juice.JuiceBoxSerializer()
+        for box in boxes:
+            serializer.serializeInto(box, buf)
+        self.assertEqual(
+            bytes(buf),
+            'prefix' + ''.join([box.serialize() for box in boxes]))
+
+
+    def test_failureLeavesNothing(self):
+        """
+        A box which cannot be serialized leaves none of its headers in front
+        of the next box serialized.
+        """
+        serializer = juice.JuiceBoxSerializer()
+        bad = juice.Box()
+        bad.update([('key%d' % (i,), 'x') for i in range(20)])
+        bad['value'] = 1
+        self.assertRaises(TypeError, serializer.serialize, bad)
+        box = juice.Box(simple='test')
+        self.assertEqual(serializer.serialize(box), box.serialize())
+
+
+    def test_perConnection(self):
+        """
+        Each L{juice.Juice} connection has its own L{juice.JuiceBoxSerializer},
+        so that the header names cached for one do not fill the cache of
+        another.
+        """
+        serializers = []
+        for i in range(2):
+            proto = juice.Juice(False)
+            proto.makeConnection(StringTransport())
+            serializers.append(proto._serializer)
+        self.assertTrue(type(serializers[0]) is juice.JuiceBoxSerializer)
+        self.assertFalse(serializers[0] is serializers[1])
+
+
+
+class OrderedBox(juice.Box):
+    """
+    A box whose items are serialized in the order they were given.
+    """
+    def __init__(self, items):
+        juice.Box.__init__(self)
+        self.update(items)
+        self._items = items
+
+    def items(self):
+        return list(self._items)
+
+class BinarySerializerTest(unittest.TestCase):
+    """
+    Tests for L{juice.BinaryJuiceBoxSerializer}.
+    """
+    def test_format(self):
+        """
+        Each header is written as the lengths of its key and value followed
+        by the key and value, and the header block ends with a zero key
+        length and the length of the body, followed by the body.
+        """
+        serializer = juice.BinaryJuiceBoxSerializer()
+        self.assertEqual(
+            serializer.serialize(juice.Box(key='value')),
+            '\x00\x03\x00\x00\x00\x05keyvalue\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(
+            serializer.serialize(juice.Box(body='xy')),
+            '\x00\x00\x00\x00\x00\x02xy')
+
+
+    def test_serializeInto(self):
+        """
+        L{juice.BinaryJuiceBoxSerializer.serializeInto} appends to the given
+        C{bytearray}.
+        """
+        serializer = juice.BinaryJuiceBoxSerializer()
+        boxes = [juice.Box(**kw) for kw in SerializerTest.boxes]
+        buf = bytearray('prefix')
+        for box in boxes:
+            serializer.serializeInto(box, buf)
+        self.assertEqual(
+            bytes(buf),
+            'prefix' + ''.join([serializer.serialize(box) for box in boxes]))
+
+
+
+    def test_invalidKeys(self):
+        """
+        Keys which cannot be framed, because they are empty or longer than
+        their 16 bit length allows, are rejected with
+        L{juice.MalformedJuiceBox}.
+        """
+        for serializer in [juice.BinaryJuiceBoxSerializer(),
+                           juice.HeaderTableJuiceBoxSerializer()]:
+            box = juice.Box()
+            box['k' * 0x10000] = 'value'
+            self.assertRaises(juice.MalformedJuiceBox,
+                              serializer.serialize, box)
+        box = juice.Box()
+        box[''] = 'value'
+        self.assertRaises(juice.MalformedJuiceBox,
+                          juice.BinaryJuiceBoxSerializer().serialize, box)
+        box = juice.Box()
+        box['k' * 0xffff] = 'value'
+        self.assertEqual(juice.BinaryJuiceFrameParser(list).dataReceived(
+                juice.BinaryJuiceBoxSerializer().serialize(box)), '')
+
+
+    def test_invalidKeyLeavesNothing(self):
+        """
+        A box with a key which cannot be framed leaves none of its headers in
+        front of the next box serialized.
+        """
+        serializer = juice.BinaryJuiceBoxSerializer()
+        box = OrderedBox([('key', 'x'), ('', 'value')])
+        self.assertRaises(juice.MalformedJuiceBox, serializer.serialize, box)
+        self.assertEqual(
+            serializer.serialize(juice.Box(key='value')),
+            juice.BinaryJuiceBoxSerializer().serialize(juice.Box(key='value')))
+
+
+class VersionNegotiationTest(unittest.TestCase):
+    """
+    Tests for switching to protocol version 2 with
+    L{juice.Juice.renegotiateVersion}.
+    """
+    def setUp(self):
+        self.client, self.server, self.pump = connectedServerAndClient(
+            ServerClass=lambda: SimpleSymmetricCommandProtocol(True),
+            ClientClass=lambda: SimpleSymmetricCommandProtocol(False))
+
+
+    def test_binaryFraming(self):
+        """
+        Once version 2 has been negotiated, both sides send and parse the
+        binary framing, and commands still work in both directions.
+        """
+        negotiated = []
+        self.client.renegotiateVersion(2).addCallback(negotiated.append)
+        self.pump.flush()
+        self.assertEqual(negotiated, [2])
+        for proto in self.client, self.server:
+            self.assertEqual(proto.protocolVersion, 2)
+            self.assertTrue(
+                isinstance(proto._parser, juice.BinaryJuiceFrameParser))
+        greetings = []
+        self.client.sendHello('multi\r\nline').addCallback(greetings.append)
+        self.server.sendHello('back').addCallback(greetings.append)
+        self.pump.flush()
+        self.assertEqual(
+            sorted([greeting['hello'] for greeting in greetings]),
+            ['back', 'multi\r\nline'])
+
+
+    def test_boxesHeldUntilAnswered(self):
+        """
+        Commands sent while the answer to the request is outstanding are
+        held back, and sent in the binary framing once it arrives, as are
+        boxes sent from the peer immediately after its answer.
+        """
+        self.client.renegotiateVersion(2)
+        greetings = []
+        self.client.sendHello('early').addCallback(greetings.append)
+        self.assertEqual(len(self.client._negotiatingBuffer), 1)
+        self.pump.flush()
+        self.assertEqual(self.client._negotiatingBuffer, None)
+        self.assertEqual([greeting['hello'] for greeting in greetings],
+                         ['early'])
+
+
+    def test_simultaneous(self):
+        """
+        If both sides ask to renegotiate before either receives the other's
+        request, both requests fail with L{juice.NegotiationInProgress}, the
+        boxes held back are sent in the framing both still use, and commands
+        keep working.
+        """
+        failures = []
+        self.client.renegotiateVersion(2).addErrback(failures.append)
+        self.server.renegotiateVersion(3).addErrback(failures.append)
+        greetings = []
+        self.client.sendHello('from client').addCallback(greetings.append)
+        self.server.sendHello('from server').addCallback(greetings.append)
+        self.pump.flush()
+        self.assertEqual(len(failures), 2)
+        for failure in failures:
+            failure.trap(juice.NegotiationInProgress)
+        for proto in self.client, self.server:
+            self.assertEqual(proto._negotiatingBuffer, None)
+            self.assertTrue(type(proto._parser) is juice.JuiceFrameParser)
+        self.assertEqual(
+            sorted([greeting['hello'] for greeting in greetings]),
+            ['from client', 'from server'])
+        self.client.renegotiateVersion(2)
+        self.pump.flush()
+        for proto in self.client, self.server:
+            self.assertEqual(proto.protocolVersion, 2)
+
+
+    def test_alreadyRenegotiating(self):
+        """
+        Asking to renegotiate while a request is outstanding fails with
+        L{juice.NegotiationInProgress}, without disturbing the outstanding
+        request or the boxes held back behind it.
+        """
+        negotiated = []
+        self.client.renegotiateVersion(2).addCallback(negotiated.append)
+        greetings = []
+        self.client.sendHello('held').addCallback(greetings.append)
+        self.failureResultOf(self.client.renegotiateVersion(3)).trap(
+            juice.NegotiationInProgress)
+        self.pump.flush()
+        self.assertEqual(negotiated, [2])
+        self.assertEqual([greeting['hello'] for greeting in greetings],
+                         ['held'])
+        self.client.renegotiateVersion(3).addCallback(negotiated.append)
+        self.pump.flush()
+        self.assertEqual(negotiated, [2, 3])
+
+
+    def test_heldByTLS(self):
+        """
+        A request held back by L{juice.Juice.prepareTLS} holds back nothing
+        until it is written, after the boxes sent before it.
+        """
+        self.client.prepareTLS()
+        negotiated = []
+        self.client.renegotiateVersion(2).addCallback(negotiated.append)
+        greetings = []
+        self.client.sendHello('after').addCallback(greetings.append)
+        self.assertEqual(self.client._negotiatingBuffer, None)
+        held, self.client._startingTLSBuffer = (
+            self.client._startingTLSBuffer, None)
+        for box in held:
+            self.client.sendPacket(box)
+        self.pump.flush()
+        self.assertEqual(negotiated, [2])
+        self.assertEqual([greeting['hello'] for greeting in greetings],
+                         ['after'])
+
+
+    def test_headerTables(self):
+        """
+        Once version 3 has been negotiated, repeated commands work in both
+        directions with the header tables on both ends in step.
+        """
+        self.client.renegotiateVersion(3)
+        self.pump.flush()
+        for proto in self.client, self.server:
+            self.assertEqual(proto.protocolVersion, 3)
+            self.assertTrue(
+                isinstance(proto._parser, juice.HeaderTableJuiceFrameParser))
+        greetings = []
+        for i in range(3):
+            self.client.sendHello('hi').addCallback(greetings.append)
+            self.server.sendHello(str(i)).addCallback(greetings.append)
+        self.pump.flush()
+        self.assertEqual(
+            sorted([greeting['hello'] for greeting in greetings]),
+            ['0', '1', '2', 'hi', 'hi', 'hi'])
+
+
+    def test_otherVersionAgreed(self):
+        """
+        If the peer answers with a different version than the one requested,
+        the held boxes are sent in that version's framing, which both sides
+        then use.
+        """
+        def command_NEGOTIATE(versions):
+            return dict(version=1)
+        command_NEGOTIATE.command = juice.Negotiate
+        self.server.command_NEGOTIATE = command_NEGOTIATE
+        negotiated = []
+        self.client.renegotiateVersion(2).addCallback(negotiated.append)
+        greetings = []
+        self.client.sendHello('still here').addCallback(greetings.append)
+        self.pump.flush()
+        self.assertEqual(negotiated, [1])
+        self.assertEqual([greeting['hello'] for greeting in greetings],
+                         ['still here'])
+        for proto in self.client, self.server:
+            self.assertEqual(proto.protocolVersion, 1)
+            self.assertTrue(type(proto._parser) is juice.JuiceFrameParser)
+
+
+
+class CompactBoxTest(unittest.TestCase):
+    """
+    Tests for L{juice.CompactJuiceBox}.
+    """
+    def test_mapping(self):
+        """
+        L{juice.CompactJuiceBox} supports the same mapping operations as
+        L{juice.JuiceBox}, for both reserved and other keys, and compares
+        equal to a C{dict} with the same items.
+        """
+        box = juice.CompactJuiceBox('the body', a='1', _ask='2')
+        box['b'] = '3'
+        box['a'] = '4'
+        box[juice.COMMAND] = 'hello'
+        self.assertEqual(
+            box, {'a': '4', 'b': '3', '_ask': '2', '_command': 'hello',
+                  'body': 'the body'})
+        self.assertEqual(len(box), 5)
+        self.assertTrue('b' in box and juice.ASK in box)
+        self.assertFalse('c' in box or juice.ANSWER in box)
+        self.assertEqual(box.get('c', 'x'), 'x')
+        self.assertEqual(box.pop('a'), '4')
+        self.assertEqual(box.pop(juice.ASK), '2')
+        self.assertRaises(KeyError, box.pop, juice.ASK)
+        self.assertEqual(box.pop('a', None), None)
+        del box['b']
+        self.assertRaises(KeyError, box.__getitem__, 'b')
+        self.assertRaises(KeyError, box.__delitem__, juice.ERROR)
+        self.assertEqual(
+            sorted(box.items()),
+            [('_command', 'hello'), ('body', 'the body')])
+
+
+    def test_valueNamedLikeKey(self):
+        """
+        A value equal to a key is not mistaken for that key.
+        """
+        box = juice.CompactJuiceBox(a='b')
+        self.assertFalse('b' in box)
+        box['b'] = 'c'
+        self.assertEqual(box, {'a': 'b', 'b': 'c'})
+
+
+    def test_compact(self):
+        """
+        L{juice.CompactJuiceBox} instances have no instance C{dict}, and
+        copies are independent of the original.
+        """
+        box = juice.CompactJuiceBox(a='1', _command='c')
+        self.assertFalse(hasattr(box, '__dict__'))
+        copy = box.copy()
+        copy['a'] = '2'
+        del copy[juice.COMMAND]
+        self.assertEqual(box, {'a': '1', '_command': 'c'})
+        self.assertEqual(copy, {'a': '2'})
+
+
+    def test_serialize(self):
+        """
+        L{juice.CompactJuiceBox}es are serialized in the same way as
+        L{juice.JuiceBox}es, and parsers can deliver them.
+        """
+        for kw in SerializerTest.boxes:
+            box = juice.CompactJuiceBox(**kw)
+            data = box.serialize()
+            self.assertEqual(juice.JuiceBoxSerializer().serialize(box), data)
+            boxes = []
+            juice.JuiceFrameParser(
+                boxes.append, boxType=juice.CompactJuiceBox).dataReceived(data)
+            self.assertEqual(boxes, [kw])
+            self.assertTrue(isinstance(boxes[0], juice.CompactJuiceBox))
+
+
+    def test_commands(self):
+        """
+        Commands work between L{juice.Juice}s which receive
+        L{juice.CompactJuiceBox}es, in every framing.
+        """
+        def compact(isServer):
+            proto = SimpleSymmetricCommandProtocol(isServer)
+            proto.boxType = juice.CompactJuiceBox
+            return proto
+        client, server, pump = connectedServerAndClient(
+            ServerClass=lambda: compact(True),
+            ClientClass=lambda: compact(False))
+        for version in juice.VERSIONS:
+            client.renegotiateVersion(version)
+            greetings = []
+            client.sendHello('hello').addCallback(greetings.append)
+            pump.flush()
+            self.assertEqual(greetings, [{'hello': 'hello'}])
+
+
+
+class Dispatcher(juice.DispatchMixin):
+    """
+    A L{juice.DispatchMixin} which counts the commands it normalizes.
+    """
+    normalized = 0
+
+    def normalizeCommand(self, cmd):
+        self.normalized += 1
+        return juice.DispatchMixin.normalizeCommand(self, cmd)
+
+    def juice_FOO(self, box):
+        return 'foo'
+
+class OtherDispatcher(Dispatcher):
+    def juice_FOO(self, box):
+        return 'other foo'
+
+class LookupDispatcher(juice.DispatchMixin):
+    """
+    A L{juice.DispatchMixin} which overrides C{lookupFunction} and C{_auto}
+    and records the names they are called with.
+    """
+    transport = None
+
+    def __init__(self):
+        self.lookedUp = []
+        self.wrapped = []
+
+    def lookupFunction(self, proto, name, namespace):
+        self.lookedUp.append(name)
+        return juice.DispatchMixin.lookupFunction(self, proto, name, namespace)
+
+    def _auto(self, aCallable, proto, namespace=None):
+        self.wrapped.append(aCallable.command)
+        return juice.DispatchMixin._auto(self, aCallable, proto, namespace)
+
+    def command_HELLO(self, hello):
+        return dict(hello=hello)
+    command_HELLO.command = Hello
+
+class DispatchTableTest(unittest.TestCase):
+    """
+    Tests for the caching of command lookups by L{juice.DispatchMixin}.
+    """
+    def setUp(self):
+        self.dispatcher = Dispatcher()
+        self.addCleanup(Dispatcher.invalidateDispatchTable)
+        self.addCleanup(OtherDispatcher.invalidateDispatchTable)
+
+    def dispatch(self, cmd):
+        return self.successResultOf(
+            self.dispatcher.dispatchCommand(self.dispatcher, cmd, {}))
+
+    def test_cached(self):
+        """
+        A command is only normalized the first time it is dispatched.
+        """
+        self.assertEqual(self.dispatch('foo'), 'foo')
+        self.assertEqual(self.dispatch('foo'), 'foo')
+        self.assertEqual(self.dispatcher.normalized, 1)
+
+    def test_unhandled(self):
+        """
+        Dispatching a command with no handler fails with
+        L{juice.UnhandledCommand} every time.
+        """
+        for i in range(2):
+            self.failureResultOf(
+                self.dispatcher.dispatchCommand(self.dispatcher, 'bar', {})
+                ).trap(juice.UnhandledCommand)
+
+    def test_classChanged(self):
+        """
+        An instance whose class is changed dispatches to the handlers of its
+        new class.
+        """
+        self.dispatch('foo')
+        self.dispatcher.__class__ = OtherDispatcher
+        self.assertEqual(self.dispatch('foo'), 'other foo')
+
+    def test_invalidate(self):
+        """
+        Handlers added to a class after it has dispatched a command are used
+        once L{juice.DispatchMixin.invalidateDispatchTable} is called.
+        """
+        self.failureResultOf(
+            self.dispatcher.dispatchCommand(self.dispatcher, 'bar', {}))
+        Dispatcher.juice_BAR = lambda self, box: 'bar'
+        self.addCleanup(delattr, Dispatcher, 'juice_BAR')
+        Dispatcher.invalidateDispatchTable()
+        self.assertEqual(self.dispatch('bar'), 'bar')
+
+    def test_invalidateSubclasses(self):
+        """
+        L{juice.DispatchMixin.invalidateDispatchTable} also forgets the
+        handlers looked up for subclasses, which inherit handlers added to
+        the class.
+        """
+        other = OtherDispatcher()
+        self.failureResultOf(other.dispatchCommand(other, 'bar', {}))
+        Dispatcher.juice_BAR = lambda self, box: 'bar'
+        self.addCleanup(delattr, Dispatcher, 'juice_BAR')
+        Dispatcher.invalidateDispatchTable()
+        self.assertEqual(
+            self.successResultOf(other.dispatchCommand(other, 'bar', {})),
+            'bar')
+
+
+    def test_staticHandler(self):
+        """
+        Handlers are bound to the dispatcher as C{getattr} would bind them,
+        so a C{staticmethod} is not passed the dispatcher.
+        """
+        Dispatcher.juice_STATIC = staticmethod(lambda box: 'static')
+        self.addCleanup(delattr, Dispatcher, 'juice_STATIC')
+        Dispatcher.invalidateDispatchTable()
+        self.assertEqual(self.dispatch('static'), 'static')
+
+
+    def test_instanceHandler(self):
+        """
+        Handlers set on an instance are found, as they are by C{getattr}.
+        """
+        self.dispatcher.juice_BAZ = lambda box: 'baz'
+        self.assertEqual(self.dispatch('baz'), 'baz')
+
+
+    def test_lookupFunctionOverridden(self):
+        """
+        A subclass which overrides C{lookupFunction} and C{_auto} has them
+        called for every command it dispatches.
+        """
+        dispatcher = LookupDispatcher()
+        for i in range(2):
+            response = self.successResultOf(dispatcher.dispatchCommand(
+                    dispatcher, 'hello', juice.Box(hello='world')))
+            self.assertEqual(response, {'hello': 'world'})
+        self.assertEqual(dispatcher.lookedUp, ['HELLO', 'HELLO'])
+        self.assertEqual(dispatcher.wrapped, [Hello, Hello])
+
+
+
+class Square(juice.Command):
+    commandName = 'square'
+    arguments = [('number', juice.Integer())]
+    response = [('square', juice.Integer())]
+    errors = {ValueError: 'NEGATIVE'}
+    threaded = True
+    threadLimit = 2
+
+class ThreadedDispatcher(juice.DispatchMixin):
+    """
+    A L{juice.DispatchMixin} with a threaded responder, which records the
+    numbers it is asked to square.
+    """
+    transport = None
+
+    def __init__(self):
+        self.squared = []
+
+    def command_SQUARE(self, number):
+        if number < 0:
+            raise ValueError(number)
+        self.squared.append(number)
+        return dict(square=number * number)
+    command_SQUARE.command = Square
+
+    def command_HELLO(self, hello):
+        return dict(hello=hello)
+    command_HELLO.command = Hello
+
+class FakeThreadPool:
+    """
+    A thread pool which runs nothing until told to.
+
+    @ivar calls: a C{list} of the calls waiting to be run.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, f, *a, **kw):
+        self.calls.append((onResult, f, a, kw))
+
+    def runNext(self):
+        onResult, f, a, kw = self.calls.pop(0)
+        try:
+            result = f(*a, **kw)
+        except:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+class FakeReactor:
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+class HandlerPoolTest(unittest.TestCase):
+    """
+    Tests for the dispatching of commands with C{threaded} set to a
+    L{juice.HandlerPool}.
+    """
+    def setUp(self):
+        self.threadPool = FakeThreadPool()
+        self.dispatcher = ThreadedDispatcher()
+        self.dispatcher.handlerPool = juice.HandlerPool(
+            FakeReactor(), self.threadPool)
+
+    def square(self, number):
+        return self.dispatcher.dispatchCommand(
+            self.dispatcher, 'square', juice.Box(number=str(number)))
+
+    def test_threaded(self):
+        """
+        A threaded responder is run by the thread pool, and its response is
+        delivered when it has been.
+        """
+        d = self.square(3)
+        self.assertEqual(self.dispatcher.squared, [])
+        self.assertNoResult(d)
+        self.threadPool.runNext()
+        self.assertEqual(self.successResultOf(d), {'square': '9'})
+
+    def test_error(self):
+        """
+        An error declared by the command, raised by a threaded responder, is
+        sent to the peer as it is for any other responder.
+        """
+        d = self.square(-1)
+        self.threadPool.runNext()
+        self.assertEqual(
+            self.failureResultOf(d, juice.RemoteJuiceError).value.errorCode,
+            'NEGATIVE')
+
+    def test_threadLimit(self):
+        """
+        No more than C{threadLimit} responders for a command run at once, and
+        the rest run, in order, as those finish.
+        """
+        results = [self.square(n) for n in range(5)]
+        self.assertEqual(len(self.threadPool.calls), 2)
+        self.threadPool.runNext()
+        self.assertEqual(len(self.threadPool.calls), 2)
+        while self.threadPool.calls:
+            self.threadPool.runNext()
+        self.assertEqual(self.dispatcher.squared, [0, 1, 2, 3, 4])
+        for d in results:
+            self.successResultOf(d)
+
+    def test_metrics(self):
+        """
+        L{juice.HandlerPool.metrics} reports how many responders for each
+        command are running, queued, and completed, and the longest the
+        queue has been.
+        """
+        pool = self.dispatcher.handlerPool
+        self.assertEqual(pool.metrics(), {})
+        for n in range(4):
+            self.square(n)
+        self.threadPool.runNext()
+        self.assertEqual(
+            pool.metrics(),
+            {Square: {'running': 2, 'queued': 1, 'maxQueued': 2,
+                      'completed': 1}})
+
+    def test_unthreaded(self):
+        """
+        Responders for commands without C{threaded} set are not run by the
+        thread pool.
+        """
+        d = self.dispatcher.dispatchCommand(
+            self.dispatcher, 'hello', juice.Box(hello='world'))
+        self.assertEqual(self.successResultOf(d), {'hello': 'world'})
+        self.assertEqual(self.threadPool.calls, [])
+
+    def test_reactorThreadPool(self):
+        """
+        By default, threaded responders run in the reactor's thread pool.
+        """
+        self.dispatcher.handlerPool = juice.HandlerPool()
+        return self.square(4).addCallback(
+            self.assertEqual, {'square': '16'})
+
+
+
+class Pair(juice.Argument):
+    """
+    An argument which is stored as two keys in a box, to exercise arguments
+    which override C{fromBox} and C{toBox}.
+    """
+    def fromBox(self, name, strings, objects, proto):
+        objects[name] = (strings.pop(name + '_a'), strings.pop(name + '_b'))
+
+    def toBox(self, name, strings, objects, proto):
+        strings[name + '_a'], strings[name + '_b'] = objects.pop(name)
+
+class Everything(juice.Command):
+    commandName = 'everything'
+    arguments = [('text', juice.String()),
+                 ('number', juice.Integer()),
+                 ('maybe', juice.Float(optional=True)),
+                 ('flag', juice.Boolean()),
+                 ('From', juice.Unicode()),
+                 ('numbers', juice.ListOf(juice.Integer())),
+                 ('pair', Pair())]
+    response = [('answer', juice.String(optional=True))]
+
+class CompiledArgumentsTest(unittest.TestCase):
+    """
+    Tests for the conversions L{juice.Command} compiles for its arguments and
+    responses.
+    """
+    objects = {'text': 'hello', 'number': 3, 'maybe': None, 'flag': True,
+               'From': u'\N{SNOWMAN}', 'numbers': [1, 2], 'pair': ('x', 'y')}
+
+    def test_toStrings(self):
+        """
+        The compiled conversion from objects to a box gives the same result
+        as L{juice.objectsToStrings}, whether or not the keys of the objects
+        are already normalized, and does not change the objects.
+        """
+        for objects in [self.objects,
+                        dict(self.objects, maybe=1.5),
+                        {'TEXT': 'hello', 'number': 3, 'flag': False,
+                         'from': u'x', 'numbers': [], 'pair': ('', '')}]:
+            copy = dict(objects)
+            self.assertEqual(
+                Everything._compiledArguments.toStrings(
+                    objects, juice.Box(), None),
+                juice.objectsToStrings(
+                    objects, Everything.arguments, juice.Box(), None))
+            self.assertEqual(objects, copy)
+
+    def test_toObjects(self):
+        """
+        The compiled conversion from a box to objects gives the same result
+        as L{juice.stringsToObjects}, and does not change the box.
+        """
+        for objects in [self.objects, dict(self.objects, maybe=1.5)]:
+            box = juice.objectsToStrings(
+                objects, Everything.arguments, juice.Box(), None)
+            copy = box.copy()
+            self.assertEqual(
+                Everything._compiledArguments.toObjects(box, None),
+                juice.stringsToObjects(box, Everything.arguments, None))
+            self.assertEqual(box, copy)
+
+    def test_missingArgument(self):
+        """
+        A box without a required argument cannot be converted.
+        """
+        self.assertRaises(
+            KeyError, Hello._compiledArguments.toObjects, juice.Box(), None)
+
+    def test_inherited(self):
+        """
+        A subclass which does not change the argument list shares the
+        conversions of its base class; one which does gets its own.
+        """
+        class Same(Everything):
+            pass
+        class Different(Everything):
+            arguments = [('other', juice.String())]
+        self.assertIdentical(
+            Same._compiledArguments, Everything._compiledArguments)
+        self.assertEqual(
+            Different._compiledArguments.toObjects(
+                juice.Box(other='value'), None),
+            {'other': 'value'})
+        self.assertIdentical(
+            Different._compiledResponse, Everything._compiledResponse)
+
+
+
+class SlowInteger(juice.Integer):
+    """
+    An L{juice.Integer} subclass, which L{juice.ListOf} converts item by item.
+    """
+
+class ListOfTest(unittest.TestCase):
+    """
+    Tests for L{juice.ListOf}.
+    """
+    def roundTrip(self, argument, objects):
+        string = argument.toStringProto(objects, None)
+        return string, argument.fromStringProto(string, None)
+
+    def test_bulk(self):
+        """
+        Lists of L{juice.Integer}, L{juice.Float} and L{juice.String} are
+        converted in bulk, with the same results as item by item.
+        """
+        for subarg, objects in [
+            (juice.Integer(), [1, -20, 3L ** 50]),
+            (juice.Float(), [0.5, -1e100, 3.0]),
+            (juice.String(), ['a', '', 'b c'])]:
+            argument = juice.ListOf(subarg)
+            self.assertIdentical(argument._bulkType, type(subarg))
+            slow = juice.ListOf(subarg)
+            slow._bulkType = None
+            self.assertEqual(self.roundTrip(argument, objects),
+                             self.roundTrip(slow, objects))
+
+    def test_bulkValues(self):
+        """
+        Bulk conversion gives the values the items are converted to.
+        """
+        self.assertEqual(
+            self.roundTrip(juice.ListOf(juice.Integer()), [1, 2.5, '3']),
+            ('1, 2, 3', [1, 2, 3]))
+        self.assertEqual(
+            self.roundTrip(juice.ListOf(juice.String(), '|'), ('a', 'b')),
+            ('a|b', ['a', 'b']))
+        self.assertEqual(
+            juice.ListOf(juice.String()).toStringProto(
+                iter(['a', 'b']), None),
+            'a, b')
+        self.assertEqual(
+            juice.ListOf(juice.Float()).fromStringProto('1, 2.5', None),
+            [1.0, 2.5])
+
+    def test_numbersAsJSON(self):
+        """
+        Numbers joined by commas, which are decoded as JSON, are decoded
+        exactly as converting each would, including those JSON would treat
+        differently.
+        """
+        integers = juice.ListOf(juice.Integer())
+        floats = juice.ListOf(juice.Float())
+        for argument, inString, expected in [
+            (integers, '1, -2,  3', [1, -2, 3]),
+            (integers, '007, +1', [7, 1]),
+            (floats, '1, 2.5, inf', [1.0, 2.5, float('inf')]),
+            (juice.ListOf(juice.Integer(), ','), '1, 2', [1, 2])]:
+            values = argument.fromStringProto(inString, None)
+            self.assertEqual(values, expected)
+            self.assertEqual(map(type, values), map(type, expected))
+        for argument, inString in [
+            (integers, ''), (integers, '1,2'), (integers, '1.5'),
+            (integers, 'true'), (integers, '[1]'), (integers, 'NaN'),
+            (floats, '"1"'), (floats, 'null')]:
+            self.assertRaises(
+                ValueError, argument.fromStringProto, inString, None)
+
+    def test_delimiterInString(self):
+        """
+        A string containing the delimiter cannot be sent in a list of
+        strings.
+        """
+        argument = juice.ListOf(juice.String())
+        self.assertRaises(
+            AssertionError, argument.toStringProto, ['a', 'b, c'], None)
+        self.assertEqual(
+            argument.toStringProto(['a,', ' b'], None), 'a,,  b')
+
+    def test_itemByItem(self):
+        """
+        Lists of subclasses of the bulk types, and lists with delimiters
+        which could be confused with their items, are converted item by
+        item.
+        """
+        self.assertIdentical(
+            juice.ListOf(SlowInteger())._bulkType, None)
+        argument = juice.ListOf(juice.Integer(), '-')
+        self.assertIdentical(argument._bulkType, None)
+        self.assertRaises(
+            AssertionError, argument.toStringProto, [1, -2], None)
+        argument = juice.ListOf(juice.String(), '||')
+        self.assertIdentical(argument._bulkType, None)
+        self.assertRaises(
+            AssertionError, argument.toStringProto, ['a||b', 'c'], None)
+
+
+
+class Attach(juice.Command):
+    commandName = 'attach'
+    arguments = [('name', juice.String()),
+                 ('image', juice.Binary()),
+                 ('thumbnail', juice.Binary(optional=True))]
+
+class BinaryArgumentTest(unittest.TestCase):
+    """
+    Tests for L{juice.Binary}.
+    """
+    objects = {'name': 'x', 'image': 'image\r\n\x00', 'thumbnail': 'th'}
+
+    def toBox(self, objects):
+        return Attach._compiledArguments.toStrings(objects, juice.Box(), None)
+
+    def received(self, box, **kw):
+        boxes = []
+        juice.JuiceFrameParser(boxes.append, **kw).dataReceived(
+            box.serialize())
+        return Attach._compiledArguments.toObjects(boxes[0], None)
+
+    def test_parts(self):
+        """
+        The values of L{juice.Binary} arguments are put in the body, one
+        after another, as they are, and their names and lengths in the
+        C{_parts} header.
+        """
+        box = self.toBox(self.objects)
+        self.assertEqual(box['body'], 'image\r\n\x00th')
+        self.assertEqual(box['_parts'], 'image 8, thumbnail 2')
+        self.assertEqual(box['name'], 'x')
+
+    def test_roundTrip(self):
+        """
+        L{juice.Binary} values are received as they were sent.
+        """
+        self.assertEqual(self.received(self.toBox(self.objects)),
+                         self.objects)
+
+    def test_memoryview(self):
+        """
+        L{juice.Binary} values are received as memoryviews of the body, if
+        the bodies of boxes are received as memoryviews.
+        """
+        objects = self.received(
+            self.toBox(dict(self.objects, image=memoryview('\xff' * 100))),
+            memoryviewBodies=True)
+        self.assertIsInstance(objects['image'], memoryview)
+        self.assertEqual(objects['image'].tobytes(), '\xff' * 100)
+        self.assertEqual(objects['thumbnail'].tobytes(), 'th')
+
+    def test_optional(self):
+        """
+        An optional L{juice.Binary} argument may be left out, and a required
+        one may not.
+        """
+        objects = dict(self.objects, thumbnail=None)
+        box = self.toBox(objects)
+        self.assertEqual(box['_parts'], 'image 8')
+        self.assertEqual(self.received(box), objects)
+        self.assertRaises(
+            KeyError, Attach._compiledArguments.toObjects,
+            juice.Box(name='x'), None)
+
+    def test_malformed(self):
+        """
+        A part which extends beyond the body, or a C{_parts} header which
+        cannot be parsed, is rejected with L{juice.MalformedJuiceBox}.
+        """
+        for parts, body in [('image 5', 'abc'), ('image 1', None),
+                            ('image', 'abc'), ('image x', 'abc'),
+                            ('image 1 2', 'abc'), ('thumbnail -1, image 1',
+                                                   'abc')]:
+            box = juice.Box(name='x', _parts=parts)
+            if body is not None:
+                box['body'] = body
+            self.assertRaises(
+                juice.MalformedJuiceBox,
+                Attach._compiledArguments.toObjects, box, None)
+
+
+
+class RecordingTransport(StringTransport):
+    """
+    A L{StringTransport} which records the calls made to its C{write},
+    C{writeSequence} and C{startTLS} methods.
+    """
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append(('write', data))
+        StringTransport.write(self, data)
+
+    def writeSequence(self, data):
+        self.calls.append(('writeSequence', ''.join(data)))
+        StringTransport.writeSequence(self, data)
+
+    def startTLS(self, options):
+        self.calls.append(('startTLS', options))
+
+class FakeCertificate:
+    def options(self, *verifyAuthorities):
+        return 'options'
+
+class CoalescedWriteTest(unittest.TestCase):
+    """
+    Tests for L{juice.Juice} with C{coalesceWrites} set.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = RecordingTransport()
+        self.proto = juice.Juice(True)
+        self.proto.coalesceWrites = True
+        self.proto.clock = self.clock
+        self.proto.makeConnection(self.transport)
+        self.boxes = [juice.Box(n=str(i)) for i in range(3)]
+
+    def test_heldUntilIterationEnds(self):
+        """
+        Boxes sent during one reactor iteration are written together, in
+        order, by one call to C{writeSequence} when it ends.
+        """
+        for box in self.boxes:
+            self.proto.sendPacket(box)
+        self.assertEqual(self.transport.calls, [])
+        self.clock.advance(0)
+        self.assertEqual(
+            self.transport.calls,
+            [('writeSequence',
+              ''.join([box.serialize() for box in self.boxes]))])
+
+    def test_maxCoalescedBoxes(self):
+        """
+        Once C{maxCoalescedBoxes} boxes are being held, they are written
+        immediately.
+        """
+        self.proto.maxCoalescedBoxes = 2
+        for box in self.boxes:
+            self.proto.sendPacket(box)
+        self.assertEqual(
+            self.transport.calls,
+            [('writeSequence',
+              self.boxes[0].serialize() + self.boxes[1].serialize())])
+        self.clock.advance(0)
+        self.assertEqual(
+            self.transport.calls[1:],
+            [('writeSequence', self.boxes[2].serialize())])
+
+    def test_maxCoalescedBytes(self):
+        """
+        Once C{maxCoalescedBytes} bytes are being held, they are written
+        immediately.
+        """
+        self.proto.maxCoalescedBytes = 1
+        self.proto.sendPacket(self.boxes[0])
+        self.assertEqual(
+            self.transport.calls,
+            [('writeSequence', self.boxes[0].serialize())])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_quit(self):
+        """
+        Boxes held back are written before the connection is dropped by a
+        L{juice.QuitBox}.
+        """
+        self.proto.sendPacket(self.boxes[0])
+        juice.QuitBox(n='quit').sendTo(self.proto)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(
+            self.transport.value(),
+            self.boxes[0].serialize() + juice.QuitBox(n='quit').serialize())
+
+    def test_startTLS(self):
+        """
+        Boxes sent before TLS is started are written before it is started,
+        and boxes buffered by L{juice.Juice.prepareTLS} after it.
+        """
+        self.proto.sendPacket(self.boxes[0])
+        self.proto.prepareTLS()
+        self.proto.sendPacket(self.boxes[1])
+        self.proto.startTLS(FakeCertificate())
+        self.clock.advance(0)
+        self.assertEqual(
+            self.transport.calls,
+            [('writeSequence', self.boxes[0].serialize()),
+             ('startTLS', 'options'),
+             ('writeSequence', self.boxes[1].serialize())])
+
+
+
+class OutstandingRequestTest(unittest.TestCase):
+    """
+    Tests for the limits, timeouts and counters applied to commands sent by
+    L{juice.JuiceParserBase}.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = StringTransport()
+        self.proto = juice.Juice(False)
+        self.proto.clock = self.clock
+        self.proto.makeConnection(self.transport)
+
+    def sent(self):
+        """
+        Return the boxes written to the transport since the last call.
+        """
+        boxes = []
+        juice.JuiceFrameParser(boxes.append).dataReceived(
+            self.transport.value())
+        self.transport.clear()
+        return boxes
+
+    def answer(self, box):
+        answer = juice.Box(result=box['n'])
+        answer[juice.ANSWER] = box[juice.ASK]
+        self.proto.dataReceived(answer.serialize())
+
+    def send(self, n, **kw):
+        return self.proto.sendBoxCommand('test', juice.Box(n=str(n)), **kw)
+
+    def test_limit(self):
+        """
+        Commands sent while C{maxOutstandingRequests} are awaiting answers are
+        sent, in order, as answers arrive.
+        """
+        self.proto.maxOutstandingRequests = 2
+        results = [self.send(i) for i in range(4)]
+        self.proto.sendBoxCommand('test', juice.Box(n='x'), False)
+        first, second = self.sent()
+        self.assertEqual([first['n'], second['n']], ['0', '1'])
+        self.assertEqual(self.proto.requestMetrics()['waiting'], 3)
+        self.answer(second)
+        [third] = self.sent()
+        self.assertEqual(third['n'], '2')
+        self.assertEqual(self.successResultOf(results[1])['result'], '1')
+        self.answer(first)
+        fourth, unanswered = self.sent()
+        self.assertEqual([fourth['n'], unanswered['n']], ['3', 'x'])
+        self.assertNotIn(juice.ASK, unanswered)
+        self.assertEqual(
+            self.proto.requestMetrics(),
+            {'inFlight': 2, 'waiting': 0, 'completed': 2, 'timedOut': 0,
+             'maxLatency': 0.0})
+
+    def test_connectionLost(self):
+        """
+        Commands still waiting to be sent fail when the connection is lost.
+        """
+        self.proto.maxOutstandingRequests = 1
+        self.send(0).addErrback(lambda f: None)
+        waiting = self.send(1)
+        self.proto.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(waiting).trap(ConnectionLost)
+
+    def test_timeout(self):
+        """
+        A command which is not answered within C{requestTimeout} seconds
+        fails with L{juice.RequestTimedOut}, and its late answer is ignored.
+        """
+        self.proto.requestTimeout = 5
+        failures = []
+        self.send(0).addErrback(failures.append)
+        [box] = self.sent()
+        self.clock.advance(4)
+        self.assertEqual(failures, [])
+        self.clock.advance(1)
+        failures.pop().trap(juice.RequestTimedOut)
+        self.answer(box)
+        self.assertEqual(self.proto.requestMetrics()['timedOut'], 1)
+        self.assertEqual(self.proto.requestMetrics()['inFlight'], 0)
+
+    def test_lateAnswerForgotten(self):
+        """
+        An answer to a command which timed out so long ago that its tag has
+        been forgotten is ignored, as is an answer to a command which was
+        never sent, and the connection is kept.
+        """
+        self.proto._maxTimedOutTags = 1
+        for i in range(3):
+            self.send(i, timeout=i + 1).addErrback(lambda f: None)
+        boxes = self.sent()
+        self.clock.pump([1] * 3)
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        for box in boxes:
+            self.answer(box)
+        self.answer(juice.Box(n='x', _ask='ffff'))
+        self.assertFalse(self.transport.disconnecting)
+        self.assertEqual(
+            [event['message'] for event in messages
+             if 'Ignoring' in ''.join(event['message'])],
+            [("Ignoring answer to unknown command '1'",),
+             ("Ignoring answer to unknown command '2'",),
+             ("Ignoring answer to unknown command 'ffff'",)])
+        self.assertEqual(self.proto.requestMetrics()['timedOut'], 3)
+
+
+    def test_timeoutStartsWhenSent(self):
+        """
+        The timeout of a command waiting for one of the
+        C{maxOutstandingRequests} starts when the command is sent.
+        """
+        self.proto.maxOutstandingRequests = 1
+        first = self.send(0, timeout=5)
+        second = self.send(1, timeout=5)
+        self.clock.advance(4)
+        [box] = self.sent()
+        self.answer(box)
+        self.successResultOf(first)
+        self.clock.advance(4)
+        [box] = self.sent()
+        self.answer(box)
+        self.successResultOf(second)
+
+
+    def test_answeredBeforeTimeout(self):
+        """
+        A command answered within its timeout succeeds, and the time it took
+        is reflected in C{maxLatency}.
+        """
+        result = self.send(0, timeout=5)
+        self.clock.advance(3)
+        [box] = self.sent()
+        self.answer(box)
+        self.successResultOf(result)
+        self.clock.advance(10)
+        self.assertEqual(
+            self.proto.requestMetrics(),
+            {'inFlight': 0, 'waiting': 0, 'completed': 1, 'timedOut': 0,
+             'maxLatency': 3.0})
+
+    def test_oneDelayedCall(self):
+        """
+        However many commands have timeouts, only one delayed call is
+        scheduled for them.
+        """
+        failures = []
+        for i in range(50):
+            self.send(i, timeout=i % 7 + 1).addErrback(failures.append)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.pump([1] * 6)
+        self.assertEqual(len(failures), 50 - 50 // 7)
+        self.clock.advance(1)
+        self.assertEqual(len(failures), 50)
+        for failure in failures:
+            failure.trap(juice.RequestTimedOut)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class BatchCommandTest(unittest.TestCase):
+    """
+    Tests for L{juice.JuiceParserBase.sendBoxCommands}.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = RecordingTransport()
+        self.proto = juice.Juice(False)
+        self.proto.clock = self.clock
+        self.proto.makeConnection(self.transport)
+        self.commands = [('hello', juice.Box(hello=str(i))) for i in range(3)]
+
+    def answer(self, tag, **kw):
+        self.proto.dataReceived(juice.Box(_answer=tag, **kw).serialize())
+
+    def error(self, tag):
+        self.proto.dataReceived(juice.Box(
+                _error=tag, _error_code='E', _error_description='bad'
+                ).serialize())
+
+    def sent(self):
+        boxes = []
+        juice.JuiceFrameParser(boxes.append).dataReceived(
+            self.transport.value())
+        return boxes
+
+    def test_oneWrite(self):
+        """
+        The commands are written together, in order, by one call to
+        C{writeSequence}.
+        """
+        self.proto.sendBoxCommands(self.commands)
+        self.assertEqual(len(self.transport.calls), 1)
+        self.assertEqual(
+            [(box['_command'], box['hello'], box['_ask'])
+             for box in self.sent()],
+            [('hello', '0', '1'), ('hello', '1', '2'), ('hello', '2', '3')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unordered(self):
+        """
+        Without C{ordered}, each command's L{Deferred} fires as soon as its
+        answer arrives.
+        """
+        results = self.proto.sendBoxCommands(self.commands)
+        self.answer('3', n='3')
+        self.assertNoResult(results[0])
+        self.assertEqual(self.successResultOf(results[2])['n'], '3')
+
+    def test_ordered(self):
+        """
+        With C{ordered}, the L{Deferred}s fire in the order the commands were
+        given, whatever order the answers arrive in.
+        """
+        results = self.proto.sendBoxCommands(self.commands, ordered=True)
+        fired = []
+        for d in results:
+            d.addCallback(lambda box: fired.append(box['n']))
+        self.answer('3', n='3')
+        self.answer('2', n='2')
+        self.assertEqual(fired, [])
+        self.answer('1', n='1')
+        self.assertEqual(fired, ['1', '2', '3'])
+
+    def test_orderedError(self):
+        """
+        With C{ordered}, an error is delivered in its turn, and one which is
+        not handled drops the connection.
+        """
+        results = self.proto.sendBoxCommands(self.commands, ordered=True)
+        results[0].addErrback(lambda f: f.trap(juice.RemoteJuiceError))
+        self.error('2')
+        self.assertFalse(self.transport.disconnecting)
+        self.error('1')
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(len(self.flushLoggedErrors(juice.RemoteJuiceError)),
+                         1)
+
+    def test_maxOutstandingRequests(self):
+        """
+        Commands beyond C{maxOutstandingRequests} wait, as they would if sent
+        one at a time.
+        """
+        self.proto.maxOutstandingRequests = 2
+        self.proto.sendBoxCommands(self.commands)
+        self.assertEqual(len(self.sent()), 2)
+        self.answer('1')
+        self.assertEqual(len(self.sent()), 3)
+
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    """
+    Tests for L{juice.LatencyHistogram}.
+    """
+    def test_buckets(self):
+        """
+        Each latency is counted in a bucket whose limit is no more than
+        C{1 + 1 / subBuckets} times greater than it.
+        """
+        histogram = juice.LatencyHistogram()
+        for latency in [0, 1e-7, 1e-6, 3e-6, 0.001, 0.5, 2.0, 1e9]:
+            histogram.reset()
+            histogram.record(latency)
+            [(limit, count)] = histogram.snapshot()['buckets']
+            self.assertEqual(count, 1)
+            if juice.LatencyHistogram.minimum <= latency < 1000:
+                self.assertTrue(latency < limit <= latency * 1.25,
+                                (latency, limit))
+
+    def test_snapshot(self):
+        """
+        L{juice.LatencyHistogram.snapshot} summarizes the latencies recorded.
+        """
+        histogram = juice.LatencyHistogram()
+        for i in range(1, 101):
+            histogram.record(i / 1000.0)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertAlmostEqual(snapshot['total'], 5.05)
+        self.assertEqual(snapshot['max'], 0.1)
+        self.assertTrue(0.05 <= snapshot['p50'] <= 0.05 * 1.25)
+        self.assertTrue(0.099 <= snapshot['p99'] <= 0.1)
+
+    def test_merge(self):
+        """
+        L{juice.LatencyHistogram.merge} adds another histogram's counts.
+        """
+        first = juice.LatencyHistogram()
+        first.record(0.1)
+        second = juice.LatencyHistogram()
+        second.record(0.2)
+        first.merge(second)
+        self.assertEqual(first.count, 2)
+        self.assertEqual(first.maximum, 0.2)
+        self.assertEqual(len(first.snapshot()['buckets']), 2)
+
+class LatencyJuice(juice.Juice):
+    recordLatencies = True
+
+    def juice_SLOW(self, box):
+        self.slow = defer.Deferred()
+        return self.slow
+
+class LatencyRecordingTest(unittest.TestCase):
+    """
+    Tests for the latencies recorded by L{juice.JuiceParserBase} when
+    C{recordLatencies} is set.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = LatencyJuice(False)
+        self.server = LatencyJuice(True)
+        for proto in self.client, self.server:
+            proto.clock = self.clock
+            proto.makeConnection(StringTransport())
+
+    def exchange(self, source, destination):
+        data = source.transport.value()
+        source.transport.clear()
+        destination.dataReceived(data)
+
+    def test_recorded(self):
+        """
+        The time each command takes is recorded by the side which sent it and
+        by the side which answered it.
+        """
+        result = self.client.sendBoxCommand('slow', juice.Box())
+        self.exchange(self.client, self.server)
+        self.clock.advance(0.25)
+        self.server.slow.callback(juice.Box())
+        self.exchange(self.server, self.client)
+        self.successResultOf(result)
+        sent = self.client.latencies.snapshot()['sent']['slow']
+        answered = self.server.latencies.snapshot()['answered']['SLOW']
+        for snapshot in sent, answered:
+            self.assertEqual(snapshot['count'], 1)
+            self.assertEqual(snapshot['max'], 0.25)
+
+    def test_answeredByHandler(self):
+        """
+        The latencies of answered commands are recorded under the normalized
+        name of their handler, and not at all for commands with no handler.
+        """
+        for cmd in ['slow', 'Slow', 'missing']:
+            self.client.sendBoxCommand(cmd, juice.Box()).addErrback(
+                lambda f: None)
+            self.exchange(self.client, self.server)
+            if cmd != 'missing':
+                self.server.slow.callback(juice.Box())
+        self.flushLoggedErrors(juice.UnhandledCommand)
+        answered = self.server.latencies.snapshot()['answered']
+        self.assertEqual(answered.keys(), ['SLOW'])
+        self.assertEqual(answered['SLOW']['count'], 2)
+
+
+    def test_processSnapshot(self):
+        """
+        L{juice.latencySnapshot} combines the latencies of every connection,
+        and can reset them.
+        """
+        for proto in self.client, self.server:
+            proto.latencies.recordSent('x', 1.0)
+        self.assertEqual(
+            juice.latencySnapshot(reset=True)['sent']['x']['count'], 2)
+        self.assertEqual(juice.latencySnapshot()['sent'], {})
+        self.assertEqual(self.client.latencies.snapshot()['sent'], {})
+
+
+
+class Upload(juice.Command):
+    commandName = 'upload'
+    arguments = [('name', juice.String())]
+    response = [('size', juice.Integer())]
+    errors = {ValueError: 'BAD_UPLOAD'}
+    streamBody = True
+
+class UploadProtocol(juice.Juice):
+    """
+    A Juice protocol which receives uploads without accumulating them.
+
+    @ivar uploads: a C{list} of (name, L{juice.BodyStream}) tuples, one for
+        each upload started.
+
+    @ivar consumeImmediately: if C{True}, each upload is written to a new
+        L{StringTransport} as soon as it starts.
+
+    @ivar refuse: C{None}, or an exception which the responder raises
+        instead of consuming the upload.
+    """
+    consumeImmediately = True
+    refuse = None
+
+    def __init__(self):
+        juice.Juice.__init__(self, True)
+        self.uploads = []
+
+    def command_UPLOAD(self, name, body):
+        self.uploads.append((name, body))
+        if self.refuse is not None:
+            raise self.refuse
+        if self.consumeImmediately:
+            return self.consume(body)
+        return defer.Deferred()
+    command_UPLOAD.command = Upload
+
+    def consume(self, body):
+        self.consumer = StringTransport()
+        return body.beginWriting(self.consumer).addCallback(
+            lambda consumer: dict(size=len(consumer.value())))
+
+class PausingConsumer(StringTransport):
+    """
+    A consumer which pauses its producer whenever it is written to.
+    """
+    def write(self, data):
+        StringTransport.write(self, data)
+        self.producer.pauseProducing()
+
+class StreamingBodyTest(unittest.TestCase):
+    """
+    Tests for commands with C{streamBody} set.
+    """
+    def setUp(self):
+        self.transport = StringTransport()
+        self.proto = UploadProtocol()
+        self.proto.makeConnection(self.transport)
+        box = juice.Box(name='data', body='x' * 1000)
+        box[juice.COMMAND] = 'upload'
+        box[juice.ASK] = '1'
+        self.data = box.serialize()
+
+    def _responses(self):
+        boxes = []
+        juice.JuiceFrameParser(boxes.append).dataReceived(
+            self.transport.value())
+        return boxes
+
+    def test_streamedAsItArrives(self):
+        """
+        The responder for a command with C{streamBody} set is called when the
+        command's headers arrive, and each following part of the body is
+        written to the consumer it chooses as it arrives.  The command is
+        answered once the whole body has been written.
+        """
+        headerLength = self.data.index('\r\n\r\n') + 4
+        self.proto.dataReceived(self.data[:headerLength + 10])
+        [(name, body)] = self.proto.uploads
+        self.assertEqual(name, 'data')
+        self.assertEqual(body.length, 1000)
+        self.assertEqual(self.proto.consumer.value(), 'x' * 10)
+        self.assertEqual(self._responses(), [])
+        self.proto.dataReceived(self.data[headerLength + 10:])
+        self.assertEqual(self.proto.consumer.value(), 'x' * 1000)
+        self.assertEqual(self._responses(), [{'size': '1000', '_answer': '1'}])
+
+    def test_pausedUntilConsumed(self):
+        """
+        Parts of the body which arrive before the responder has chosen a
+        consumer are held, and the transport is paused until it does.
+        """
+        self.proto.consumeImmediately = False
+        self.proto.dataReceived(self.data[:-100])
+        self.assertEqual(self.transport.producerState, 'paused')
+        [(name, body)] = self.proto.uploads
+        result = self.proto.consume(body)
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertEqual(self.proto.consumer.value(), 'x' * 900)
+        self.proto.dataReceived(self.data[-100:])
+        self.assertEqual(self.successResultOf(result), {'size': 1000})
+
+    def test_notPausedOnceComplete(self):
+        """
+        The transport is not paused by a body which has arrived completely
+        before the responder has chosen a consumer.
+        """
+        self.proto.consumeImmediately = False
+        self.proto.dataReceived(self.data)
+        self.assertEqual(self.transport.producerState, 'producing')
+        [(name, body)] = self.proto.uploads
+        self.assertEqual(self.successResultOf(self.proto.consume(body)),
+                         {'size': 1000})
+
+
+    def test_pausedByConsumer(self):
+        """
+        If the consumer pauses the body while its last part is written, the
+        transport is resumed when the body is unregistered from the
+        consumer, since the consumer will not resume it.
+        """
+        self.proto.consumeImmediately = False
+        self.proto.dataReceived(self.data)
+        [(name, body)] = self.proto.uploads
+        consumer = PausingConsumer()
+        result = body.beginWriting(consumer)
+        self.assertIdentical(self.successResultOf(result), consumer)
+        self.assertEqual(consumer.value(), 'x' * 1000)
+        self.assertIdentical(consumer.producer, None)
+        self.assertEqual(self.transport.producerState, 'producing')
+
+
+    def test_responderFailed(self):
+        """
+        If the responder fails without choosing a consumer, the error is
+        sent, the transport is resumed, the rest of the body is discarded,
+        and the following commands are handled.
+        """
+        self.proto.refuse = ValueError('no room')
+        self.proto.dataReceived(self.data[:-100])
+        self.assertEqual(self.transport.producerState, 'producing')
+        [response] = self._responses()
+        self.assertEqual(response[juice.ERROR_CODE], 'BAD_UPLOAD')
+        self.proto.dataReceived(self.data[-100:])
+        self.proto.refuse = None
+        self.transport.clear()
+        self.proto.dataReceived(self.data)
+        self.assertEqual(self.proto.consumer.value(), 'x' * 1000)
+        self.assertEqual(self._responses(), [{'size': '1000', '_answer': '1'}])
+
+
+    def test_responderIgnoredBody(self):
+        """
+        If the responder returns a result without choosing a consumer, the
+        transport is resumed and the rest of the body is discarded.
+        """
+        def command_UPLOAD(name, body):
+            return dict(size=0)
+        command_UPLOAD.command = Upload
+        self.proto.command_UPLOAD = command_UPLOAD
+        self.proto.dataReceived(self.data[:-100])
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertEqual(self._responses(), [{'size': '0', '_answer': '1'}])
+        self.proto.dataReceived(self.data[-100:] + self.data)
+        self.assertEqual(self._responses(), [{'size': '0', '_answer': '1'}] * 2)
+
+
+    def test_connectionLost(self):
+        """
+        If the connection is lost before the whole body arrives, the
+        L{Deferred} returned by L{juice.BodyStream.beginWriting} fails.
+        """
+        self.proto.consumeImmediately = False
+        self.proto.dataReceived(self.data[:-100])
+        [(name, body)] = self.proto.uploads
+        result = body.beginWriting(StringTransport())
+        self.proto.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(result).trap(ConnectionLost)
+
+
+
+class BenchmarkTest(unittest.TestCase):
+    """
+    Run each benchmark in L{epsilon.test.juicebench} briefly, so that they
+    keep working.
+    """
+    def test_parse(self):
+        """
+        L{juicebench.benchmarkParse} reports a rate for the line-based, the
+        frame-based, the binary and the header table parsers.
+        """
+        results = juicebench.benchmarkParse(boxes=10, bodySize=100)
+        self.assertEqual(
+            sorted(results),
+            ['binary', 'frame', 'frame-memoryview', 'line', 'table'])
+
+
+    def test_serialize(self):
+        """
+        L{juicebench.benchmarkSerialize} reports a rate for
+        L{juice.JuiceBox.serialize}, for L{juice.JuiceBoxSerializer}, for
+        L{juice.BinaryJuiceBoxSerializer} and for
+        L{juice.HeaderTableJuiceBoxSerializer}.
+        """
+        results = juicebench.benchmarkSerialize(boxes=10)
+        self.assertEqual(
+            sorted(results),
+            ['binary', 'serialize', 'serializeInto', 'serializer', 'table'])
+
+
+    def test_frameSizes(self):
+        """
+        L{juicebench.frameSizes} reports the size of a repeated box in each
+        framing, and the header table framing is the smallest.
+        """
+        results = juicebench.frameSizes(boxes=10)
+        self.assertEqual(sorted(results), ['binary', 'table', 'text'])
+        self.assertEqual(min(results.values()), results['table'])
+
+
+    def test_boxMemory(self):
+        """
+        L{juicebench.boxMemory} reports the size of a L{juice.JuiceBox} and of
+        a L{juice.CompactJuiceBox}, and the latter is smaller.
+        """
+        results = juicebench.boxMemory()
+        self.assertEqual(sorted(results), ['CompactJuiceBox', 'JuiceBox'])
+        self.assertTrue(
+            results['CompactJuiceBox'] < results['JuiceBox'], results)
+
+
+    def test_marshal(self):
+        """
+        L{juicebench.benchmarkMarshal} reports a rate for the generic and the
+        compiled argument conversions.
+        """
+        results = juicebench.benchmarkMarshal(calls=2000)
+        self.assertEqual(sorted(results), ['compiled', 'generic'])
+        for rate in results.values():
+            self.assertTrue(rate > 0, results)
+
+
+    def test_binary(self):
+        """
+        L{juicebench.benchmarkBinary} reports a rate and a size for
+        L{juice.Base64Binary} and L{juice.Binary} arguments, and the latter
+        is smaller.
+        """
+        results = juicebench.benchmarkBinary(size=16 * 1024, calls=20)
+        self.assertEqual(
+            sorted(results),
+            ['base64 bytes', 'base64 round trips/s',
+             'binary bytes', 'binary round trips/s'])
+        self.assertTrue(results['binary bytes'] < results['base64 bytes'])
+
+
+    def test_loopback(self):
+        """
+        L{juicebench.benchmarkLoopback} answers every command it sends, and
+        reports rates, latencies and objects kept.
+        """
+        results = juicebench.benchmarkLoopback(
+            boxSize=100, depth=4, requests=50)
+        self.assertEqual(
+            sorted(results),
+            ['boxesPerSecond', 'bytesPerSecond', 'latencyP50', 'latencyP99',
+             'objectsPerBox'])
+        self.assertTrue(results['bytesPerSecond'] >
+                        results['boxesPerSecond'] * 100, results)
+        self.assertTrue(results['latencyP99'] >= results['latencyP50'] > 0)
+
+
+    def test_loopbackSuite(self):
+        """
+        L{juicebench.loopbackSuite} gives a result for each box size and
+        depth, which can be written as JSON.
+        """
+        suite = juicebench.loopbackSuite(
+            boxSizes=(10, 1000), depths=(1, 8), requests=20, repeats=1)
+        self.assertEqual(json.loads(json.dumps(suite)), suite)
+        self.assertEqual(
+            [(result['boxSize'], result['depth'])
+             for result in suite['results']],
+            [(10, 1), (10, 8), (1000, 1), (1000, 8)])
+        self.assertEqual(suite['repeats'], 1)
+
+
+    def test_listOf(self):
+        """
+        L{juicebench.benchmarkListOf} reports a rate for converting lists of
+        each bulk type in bulk and item by item.
+        """
+        results = juicebench.benchmarkListOf(items=1000, calls=5)
+        self.assertEqual(len(results), 12)
+        for name in ['integer', 'float', 'string']:
+            for way in ['bulk', 'item']:
+                self.assertTrue(results[name + ' ' + way + ' decode'] > 0,
+                                results)
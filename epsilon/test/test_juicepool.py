@@ -0,0 +1,295 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{epsilon.juicepool}.
+"""
+
+import socket
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated, ProcessExitedAlready
+from twisted.protocols.policies import WrappingFactory
+
+from epsilon import juicepool
+
+
+class FakeProcessTransport:
+    """
+    A process transport which records the signals sent to it.
+
+    @ivar exited: if C{True}, signals raise L{ProcessExitedAlready}.
+    """
+    exited = False
+
+    def __init__(self):
+        self.signals = []
+
+
+    def signalProcess(self, signal):
+        if self.exited:
+            raise ProcessExitedAlready()
+        self.signals.append(signal)
+
+
+
+class RecordingPool(juicepool.JuiceWorkerPool):
+    """
+    A L{juicepool.JuiceWorkerPool} which records the workers it would start,
+    rather than starting them.
+    """
+    def __init__(self, *a, **kw):
+        juicepool.JuiceWorkerPool.__init__(self, *a, **kw)
+        self.spawned = []
+
+
+    def _spawn(self, proto):
+        proto.makeConnection(FakeProcessTransport())
+        self.spawned.append(proto)
+
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """
+    Tests for L{juicepool.JuiceWorkerPool}'s supervision of its workers.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = RecordingPool(
+            'epsilon.juice.JuiceServerFactory', 7000, 3, clock=self.clock)
+
+
+    def exit(self, proto):
+        proto.processEnded(Failure(ProcessTerminated(1)))
+
+
+    def test_start(self):
+        """
+        Starting the pool starts C{workers} worker processes.
+        """
+        self.pool.startService()
+        self.assertEqual(
+            [proto.slot for proto in self.pool.spawned], [0, 1, 2])
+
+
+    def test_arguments(self):
+        """
+        Workers are run with the factory, port, interface and drain timeout
+        of the pool.
+        """
+        spawned = []
+        def spawnPythonProcess(proto, args, env, packages):
+            spawned.append(args)
+        self.patch(juicepool.process, 'spawnPythonProcess',
+                   spawnPythonProcess)
+        pool = juicepool.JuiceWorkerPool(
+            'a.Factory', 7001, 1, '127.0.0.1', 5.0, clock=self.clock)
+        pool.startService()
+        options = juicepool.Options()
+        options.parseOptions(spawned[0][3:])
+        self.assertTrue(options['worker'])
+        self.assertEqual(
+            (options['factory'], options['port'], options['interface'],
+             options['drain-timeout']),
+            ('a.Factory', 7001, '127.0.0.1', 5.0))
+
+
+    def test_restart(self):
+        """
+        A worker which exits is restarted in the same slot after
+        C{restartDelay} seconds.
+        """
+        self.pool.startService()
+        self.exit(self.pool.spawned[1])
+        self.assertEqual(len(self.pool.spawned), 3)
+        self.clock.advance(self.pool.restartDelay)
+        self.assertEqual(len(self.pool.spawned), 4)
+        self.assertEqual(self.pool.spawned[-1].slot, 1)
+        self.assertEqual(self.pool.restarts, 1)
+
+
+    def test_backoff(self):
+        """
+        The delay before a worker is restarted doubles each time it exits
+        soon after starting, up to C{maxRestartDelay}, and is reset once a
+        worker has run for that long.
+        """
+        self.pool.startService()
+        delays = []
+        for i in range(7):
+            self.exit(self.pool.spawned[-1])
+            call, = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 30, 30])
+        self.clock.advance(self.pool.maxRestartDelay)
+        self.exit(self.pool.spawned[-1])
+        call, = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime() - self.clock.seconds(), 1)
+
+
+    def test_stop(self):
+        """
+        Stopping the pool asks each worker to stop, and returns a
+        L{Deferred} which fires once they all have, without restarting them.
+        """
+        self.pool.startService()
+        d = self.pool.stopService()
+        self.assertEqual(
+            [proto.transport.signals for proto in self.pool.spawned],
+            [['TERM']] * 3)
+        for proto in self.pool.spawned:
+            self.assertNoResult(d)
+            self.exit(proto)
+        self.successResultOf(d)
+        self.assertEqual(len(self.pool.spawned), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_stopKills(self):
+        """
+        A worker which has not exited C{stopTimeout} seconds after being
+        asked to is killed.
+        """
+        self.pool.startService()
+        self.pool.stopService()
+        self.clock.advance(self.pool.stopTimeout)
+        self.assertEqual(self.pool.spawned[0].transport.signals,
+                         ['TERM', 'KILL'])
+
+
+    def test_stopExitedAlready(self):
+        """
+        A worker which has exited, but whose exit has not yet been noticed,
+        is not signalled, and the pool is stopped once it is noticed.
+        """
+        self.pool.startService()
+        exited = self.pool.spawned[0]
+        exited.transport.exited = True
+        d = self.pool.stopService()
+        self.clock.advance(self.pool.stopTimeout)
+        for proto in self.pool.spawned:
+            self.exit(proto)
+        self.successResultOf(d)
+        self.assertEqual(exited.transport.signals, [])
+        self.assertEqual(self.pool.spawned[1].transport.signals,
+                         ['TERM', 'KILL'])
+
+
+    def test_stopCancelsRestart(self):
+        """
+        A worker waiting to be restarted when the pool is stopped is not
+        restarted.
+        """
+        self.pool.startService()
+        self.exit(self.pool.spawned[0])
+        self.pool.stopService()
+        self.clock.advance(self.pool.maxRestartDelay)
+        self.assertEqual(len(self.pool.spawned), 3)
+
+
+
+class FakePort:
+    listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+
+
+class FakeTransport:
+    """
+    A transport to a peer which is not reading, so that losing the connection
+    would wait forever for buffered data to be written, and only aborting it
+    closes it.
+    """
+    def __init__(self, factory, proto):
+        self.factory = factory
+        self.proto = proto
+
+
+    def loseConnection(self):
+        pass
+
+
+    def abortConnection(self):
+        self.factory.unregisterProtocol(self.proto)
+
+
+
+class DrainTest(unittest.TestCase):
+    """
+    Tests for L{juicepool.drain}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.port = FakePort()
+        self.factory = WrappingFactory(protocol.ServerFactory())
+        self.connections = []
+        for i in range(2):
+            proto = protocol.Protocol()
+            proto.transport = FakeTransport(self.factory, proto)
+            self.factory.registerProtocol(proto)
+            self.connections.append(proto)
+
+
+    def test_waitsForConnections(self):
+        """
+        L{juicepool.drain} stops listening and fires once the open
+        connections have closed.
+        """
+        d = juicepool.drain(self.clock, self.port, self.factory, 10)
+        self.assertFalse(self.port.listening)
+        self.factory.unregisterProtocol(self.connections[0])
+        self.clock.advance(1)
+        self.assertNoResult(d)
+        self.factory.unregisterProtocol(self.connections[1])
+        self.clock.advance(1)
+        self.successResultOf(d)
+
+
+    def test_timeout(self):
+        """
+        Connections still open after the timeout are aborted, even if they
+        would never finish writing to their peers.
+        """
+        d = juicepool.drain(self.clock, self.port, self.factory, 10)
+        self.clock.pump([1] * 9)
+        self.assertNoResult(d)
+        self.clock.pump([1] * 2)
+        self.successResultOf(d)
+        self.assertEqual(self.factory.protocols, {})
+
+
+
+class ListenReusePortTest(unittest.TestCase):
+    """
+    Tests for L{juicepool.listenReusePort}.
+    """
+    if getattr(socket, 'SO_REUSEPORT', None) is None:
+        skip = 'SO_REUSEPORT is not available'
+
+    def test_sharedPort(self):
+        """
+        Two listeners may share a port, and each accepts connections.
+        """
+        factory = protocol.ServerFactory()
+        factory.protocol = protocol.Protocol
+        first = juicepool.listenReusePort(
+            reactor, 0, factory, '127.0.0.1')
+        self.addCleanup(first.stopListening)
+        port = first.getHost().port
+        second = juicepool.listenReusePort(
+            reactor, port, factory, '127.0.0.1')
+        self.addCleanup(second.stopListening)
+        self.assertEqual(second.getHost().port, port)
+
+        connected = defer.Deferred()
+        class Client(protocol.Protocol):
+            def connectionMade(self):
+                self.transport.loseConnection()
+                connected.callback(None)
+        return protocol.ClientCreator(reactor, Client).connectTCP(
+            '127.0.0.1', port).addCallback(lambda ignored: connected)
@@ -0,0 +1,139 @@
+# Copyright 2005 Divmod, Inc.  See LICENSE file for details
+
+"""
+Tests for L{epsilon.liner}.
+"""
+
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+
+from epsilon.liner import LineReceiver
+
+
+class RecordingLineReceiver(LineReceiver):
+    """
+    A L{LineReceiver} which records what it receives, and switches to raw
+    mode for the number of bytes given by a line like C{'raw 5'}.
+    """
+    rawRemaining = 0
+
+    def __init__(self):
+        self.received = []
+
+    def lineReceived(self, line):
+        self.received.append(('line', line))
+        if line.startswith('raw '):
+            self.rawRemaining = int(line[4:])
+            self.setRawMode()
+        elif line == 'quit':
+            self.transport.loseConnection()
+
+    def rawDataReceived(self, data):
+        data, extra = data[:self.rawRemaining], data[self.rawRemaining:]
+        self.rawRemaining -= len(data)
+        self.received.append(('raw', data))
+        if not self.rawRemaining:
+            self.setLineMode(extra)
+
+    def lineLengthExceeded(self, line):
+        self.received.append(('too long', line))
+
+
+
+class LineReceiverTests(unittest.TestCase):
+    """
+    Tests for L{LineReceiver}.
+    """
+    def setUp(self):
+        self.proto = RecordingLineReceiver()
+        self.proto.makeConnection(StringTransport())
+
+
+    def test_lines(self):
+        """
+        Each delimited line is passed to C{lineReceived}, however the data is
+        split up, and an incomplete line is kept until it is finished.
+        """
+        data = 'first\r\nsecond\r\n\r\nfourth\r\nfif'
+        for i in range(len(data)):
+            self.proto.dataReceived(data[i])
+        self.assertEqual(
+            self.proto.received,
+            [('line', 'first'), ('line', 'second'), ('line', ''),
+             ('line', 'fourth')])
+        self.assertEqual(self.proto.buffer, 'fif')
+        self.proto.dataReceived('th\r\n')
+        self.assertEqual(self.proto.received[-1], ('line', 'fifth'))
+        self.assertEqual(self.proto.buffer, '')
+
+
+    def test_rawMode(self):
+        """
+        After C{setRawMode}, the rest of the data is passed to
+        C{rawDataReceived}, and after C{setLineMode(extra)}, C{extra} and
+        everything following it is split into lines again.
+        """
+        self.proto.dataReceived('a\r\nraw 5\r\nxy')
+        self.proto.dataReceived('z\r\n')
+        self.proto.dataReceived('\r\nb\r\nraw 1\r\n!c\r\n')
+        self.assertEqual(
+            self.proto.received,
+            [('line', 'a'), ('line', 'raw 5'), ('raw', 'xy'),
+             ('raw', 'z\r\n'), ('line', ''), ('line', 'b'),
+             ('line', 'raw 1'), ('raw', '!'), ('line', 'c')])
+
+
+    def test_setLineModeDeliversAtOnce(self):
+        """
+        The lines in the data passed to C{setLineMode} by C{rawDataReceived}
+        are delivered before C{setLineMode} returns, and what is left of
+        them is split into lines along with the data which follows.
+        """
+        class Marking(RecordingLineReceiver):
+            def rawDataReceived(self, data):
+                RecordingLineReceiver.rawDataReceived(self, data)
+                self.received.append(('returned', data))
+        proto = Marking()
+        proto.makeConnection(StringTransport())
+        proto.dataReceived('raw 2\r\nxyb\r\nc')
+        proto.dataReceived('\r\n')
+        self.assertEqual(
+            proto.received,
+            [('line', 'raw 2'), ('raw', 'xy'), ('line', 'b'),
+             ('returned', 'xyb\r\nc'), ('line', 'c')])
+
+
+    def test_disconnecting(self):
+        """
+        Nothing more is delivered once the transport is disconnecting.
+        """
+        self.proto.dataReceived('a\r\nquit\r\nb\r\n')
+        self.assertEqual(
+            self.proto.received, [('line', 'a'), ('line', 'quit')])
+
+
+    def test_maxLineLength(self):
+        """
+        A line longer than C{MAX_LINE_LENGTH}, complete or not, is passed to
+        C{lineLengthExceeded} and discarded.
+        """
+        self.proto.MAX_LINE_LENGTH = 5
+        self.proto.dataReceived('12345\r\n123')
+        self.proto.dataReceived('456')
+        self.assertEqual(
+            self.proto.received,
+            [('line', '12345'), ('too long', '123456')])
+        self.assertEqual(self.proto.buffer, '')
+        self.proto.dataReceived('123456\r\n')
+        self.assertEqual(self.proto.received[-1], ('too long', '123456\r\n'))
+
+
+    def test_defaultLineLengthExceeded(self):
+        """
+        By default, a line which is too long drops the connection.
+        """
+        proto = LineReceiver()
+        proto.makeConnection(StringTransport())
+        proto.MAX_LINE_LENGTH = 2
+        proto.dataReceived('abc')
+        self.assertTrue(proto.transport.disconnecting)